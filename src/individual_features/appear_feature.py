@@ -2,6 +2,7 @@ import sys
 import traceback
 
 from joblib import Parallel, delayed
+import numpy as np
 import pandas as pd
 import csv
 import os
@@ -47,6 +48,19 @@ def plot_appear_features(args, run, tag):
     # plt.show()
 
 
+def appear_disappear(label_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    :param label_df: tracking csv, one row per object instance and frame
+    :return: for each frame of label_df, the number of categories whose instance count increased
+    (appear) and decreased (disappear) since the previous frame of label_df, counts start at 0
+    """
+    # instance count of each category (columns) at each frame (rows), 0 if absent
+    counts = label_df.groupby(['frame', 'name']).size().unstack(fill_value=0).sort_index()
+    changes = np.diff(counts.to_numpy(), axis=0, prepend=0)
+    return pd.DataFrame(dict(frame=counts.index, appear=(changes > 0).sum(axis=1),
+                             disappear=(changes < 0).sum(axis=1)))
+
+
 @ray.remote
 def gen_appear_features(args, run, tag):
     try:
@@ -54,44 +68,13 @@ def gen_appear_features(args, run, tag):
         output_csv_appear = os.path.join(args.output_csv_appear, f"{run}_{tag}_appear.csv")
         input_csv_tracking = os.path.join(args.input_csv_tracking, run + '_r50.csv')
         csv_headers = ['frame', 'appear', 'disappear']
+        # read tracking csv
+        label_df = pd.read_csv(input_csv_tracking, usecols=['frame', 'name'])
+        appear_df = appear_disappear(label_df)
         with open(output_csv_appear, 'w') as g:
             writer = csv.writer(g)
             writer.writerow(csv_headers)
-        # read tracking csv
-        label_df = pd.read_csv(input_csv_tracking)
-        frames = sorted(label_df['frame'].unique())
-        # loop all frame
-        previous_types = set(label_df['name'].unique())
-        previous_types = {object_type: 0 for object_type in previous_types}
-        # all categories in the video
-        all_types = previous_types
-        for frame in frames:
-            appear = 0
-            disappear = 0
-            result_csv_row = [frame]
-            current_df = label_df[label_df['frame'] == frame]
-            current_types = set(current_df['name'].unique())
-            current_types = {object_type: len(current_df[current_df['name'] == object_type])
-                             for object_type in current_types}
-            # number of objects for all categories at current frame
-            current_types = {**all_types, **current_types}
-            logger.debug(f'all {all_types}')
-            logger.debug(f'prev {previous_types}')
-            logger.debug(f'cur {current_types}')
-            for object_type in all_types.keys():
-                if current_types[object_type] < previous_types[object_type]:
-                    disappear += 1
-                elif current_types[object_type] > previous_types[object_type]:
-                    appear += 1
-            # assign current to previous
-            previous_types = current_types
-            logger.debug(f'appear {appear}')
-            logger.debug(f'disappear {disappear}')
-            # write csv file
-            result_csv_row += [appear, disappear]
-            with open(output_csv_appear, 'a') as g:
-                writer = csv.writer(g)
-                writer.writerow(result_csv_row)
+            writer.writerows(appear_df[csv_headers].itertuples(index=False))
 
         # plot_appear_features(args, run, tag)
         logger.info(f'Done Appear {run}')
@@ -0,0 +1,99 @@
+"""
+Compare optical feature engines with the reference implementation (Farneback on the sampled
+frames, scipy pearsonr on each pair, see pair_features) before choosing a flow_engine and downscale
+for a feature_tag. Each run is decoded once (sampled_frames with the stabilize setting of the
+config) and every sampled pair goes through the reference and each engine (benchmark_engines,
+farneback,pyramid,dis by default) at each downscale (benchmark_downscales, 1,2 by default),
+pixel correlation being computed from cached frame moments.
+Reports pairs/second of each path (decoding excluded), speedup over the reference, and the
+Pearson correlation and mean ratio of optical_flow_avg and pixel_correlation with the reference.
+Results are written to {output_csv_path}/engine_benchmark/engine_report.csv
+
+python src/individual_features/benchmark_optical_engines.py -c configs/config_optical_features.ini \
+    --run 6.2.5_kinect,1.1.3_kinect
+"""
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.getcwd())
+from src.individual_features.optical_features import sampled_frames, shrink, get_flow_engine, \
+    frame_moments, pixel_correlation, pair_features, compensate_global_motion
+from src.utils import parse_config, logger
+
+
+def compare_engines(args, run: str, engines: list, downscales: list) -> list:
+    """
+    :param args: optical features config
+    :param run:
+    :param engines: flow engines, see FLOW_ENGINES
+    :param downscales:
+    :return: report rows of this run, one per engine and downscale
+    """
+    input_video_path = os.path.join(args.input_video_path, run + '_trim.mp4')
+    stabilize = getattr(args, 'stabilize', 'vidgear')
+    paths = [(engine, downscale) for engine in engines for downscale in downscales]
+    flow_engines = {path: get_flow_engine(args, path[0]) for path in paths}
+    features = {path: [] for path in ['reference'] + paths}
+    seconds = {path: 0.0 for path in ['reference'] + paths}
+    prev = dict()
+    for frame_id, gray in sampled_frames(input_video_path, int(args.skip_frame), stabilize=stabilize):
+        start = perf_counter()
+        prev_gray = prev.get('reference', gray)
+        if stabilize == 'global':
+            prev_gray = compensate_global_motion(prev_gray, gray)
+        features['reference'].append(pair_features(prev_gray, gray, args))
+        prev['reference'] = gray
+        seconds['reference'] += perf_counter() - start
+        for path in paths:
+            start = perf_counter()
+            engine, downscale = path
+            small = shrink(gray, downscale)
+            current = (small, flow_engines[path].prepare(small), frame_moments(small))
+            prev_small, prev_prepared, prev_moments = prev.get(path, current)
+            if stabilize == 'global':
+                aligned = compensate_global_motion(prev_small, small)
+                if aligned is not prev_small:
+                    prev_prepared = flow_engines[path].prepare(aligned)
+                    prev_moments = frame_moments(aligned)
+            features[path].append([flow_engines[path].flow_avg(prev_prepared, current[1]) * downscale,
+                                   pixel_correlation(prev_moments, current[2])])
+            prev[path] = current
+            seconds[path] += perf_counter() - start
+
+    reference = np.array(features['reference'], dtype=np.float64)
+    rows = []
+    for path in paths:
+        candidate = np.array(features[path], dtype=np.float64)
+        row = dict(run=run, engine=path[0], downscale=path[1], pairs=len(candidate),
+                   reference_pairs_per_second=len(reference) / seconds['reference'],
+                   pairs_per_second=len(candidate) / seconds[path],
+                   speedup=seconds['reference'] / seconds[path])
+        for column, name in enumerate(['optical_flow_avg', 'pixel_correlation']):
+            row[f'{name}_corr'] = np.corrcoef(reference[:, column], candidate[:, column])[0, 1]
+            row[f'{name}_ratio'] = candidate[:, column].mean() / reference[:, column].mean()
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    engines = str(getattr(args, 'benchmark_engines', 'farneback,pyramid,dis')).split(',')
+    downscales = [int(d) for d in str(getattr(args, 'benchmark_downscales', '1,2')).split(',')]
+    report_dir = os.path.join(args.output_csv_path, 'engine_benchmark')
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    rows = []
+    for run in args.run.split(','):
+        logger.info(f'Comparing {engines} x downscale {downscales} with the reference on {run}')
+        rows.extend(compare_engines(args, run, engines, downscales))
+        for row in rows[-len(engines) * len(downscales):]:
+            logger.info(f'{row}')
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(report_dir, 'engine_report.csv'), index=False)
+    with pd.option_context('display.float_format', '{:.3f}'.format, 'display.width', 200):
+        print(report.to_string(index=False))
@@ -0,0 +1,222 @@
+"""
+Depth of object boxes on key frames, for object_hand_features.py.
+Depth extraction writes two joblib arrays per key frame in {input_depth}{run}/ (run without
+_kinect): {frame_id}_pixel_array.joblib (depth in millimeters) and {frame_id}_mask_array.joblib
+(valid depth pixels). The converter below consolidates them once per run into a depth store,
+{input_depth}{run}/depth_store/, holding integral images (summed-area tables) of depth and mask
+of all key frames in .npy files that are memory-mapped when read: the depth and number of valid
+pixels of any box, and of each enlargement step of a box without valid pixels, are then
+4 lookups instead of sums over the box.
+
+python src/individual_features/depth_store.py -c configs/config_objhand_features.ini
+"""
+import glob
+import os
+import sys
+
+import joblib
+import numpy as np
+
+sys.path.append(os.getcwd())
+from src.utils import parse_config, contain_substr, logger
+
+DEPTH_STORE = 'depth_store'
+
+
+def get_depth_region_sparse(pixelwise_matrix, mask_matrix, xmin, xmax, ymin, ymax):
+    # Coordinates range from 0-1079
+    xmin = round(xmin)
+    xmax = round(xmax)
+    ymin = round(ymin)
+    ymax = round(ymax)
+    sum_depth = np.sum(pixelwise_matrix[ymin: ymax + 1, xmin: xmax + 1])
+    n_pixels = np.sum(mask_matrix[ymin: ymax + 1, xmin: xmax + 1])
+    if n_pixels == 0:
+        xmin_enlarged = xmin
+        ymin_enlarged = ymin
+        xmax_enlarged = xmax
+        ymax_enlarged = ymax
+        while n_pixels == 0:
+            xmin_enlarged = max(xmin_enlarged - 10, 0)
+            ymin_enlarged = max(ymin_enlarged - 10, 0)
+            xmax_enlarged = min(xmax_enlarged + 10, mask_matrix.shape[1] - 1)
+            ymax_enlarged = min(ymax_enlarged + 10, mask_matrix.shape[0] - 1)
+            n_pixels = np.sum(mask_matrix[ymin_enlarged: ymax_enlarged + 1, xmin_enlarged:xmax_enlarged + 1])
+        logger.debug(f'Enlarge box from [xmin, ymin, xmax, ymax]={[xmin, ymin, xmax, ymax]} to '
+                     f'{[xmin_enlarged, ymin_enlarged, xmax_enlarged, ymax_enlarged]}')
+        sum_depth = np.sum(pixelwise_matrix[ymin_enlarged: ymax_enlarged + 1, xmin_enlarged:xmax_enlarged + 1])
+        return sum_depth / n_pixels
+    else:
+        return sum_depth / n_pixels
+
+
+def joblib_frame_ids(depth_dir: str) -> list:
+    """
+    :param depth_dir: {input_depth}{run}/
+    :return: key frames with both a pixel and a mask array, sorted
+    """
+    pixel_ids = set(int(os.path.basename(arr).split('_')[0])
+                    for arr in glob.glob(os.path.join(depth_dir, '*_pixel_array.joblib')))
+    mask_ids = set(int(os.path.basename(arr).split('_')[0])
+                   for arr in glob.glob(os.path.join(depth_dir, '*_mask_array.joblib')))
+    logger.info(f"{depth_dir} Intersection over Union: {len(pixel_ids & mask_ids)} / "
+                f"{len(pixel_ids | mask_ids)}")
+    return sorted(pixel_ids & mask_ids)
+
+
+def integral_image(array, dtype) -> np.ndarray:
+    """
+    :param array: H x W
+    :param dtype:
+    :return: (H + 1) x (W + 1) summed-area table, integral[y, x] = array[:y, :x].sum()
+    """
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=dtype)
+    np.cumsum(array, axis=0, dtype=dtype, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def convert_depth_run(depth_dir: str) -> str:
+    """
+    Consolidate the joblib arrays of a run into a depth store
+    :param depth_dir: {input_depth}{run}/
+    :return: path of the depth store
+    """
+    frame_ids = joblib_frame_ids(depth_dir)
+    if not frame_ids:
+        raise ValueError(f'{depth_dir}: no key frame with both pixel and mask arrays')
+    store_dir = os.path.join(depth_dir, DEPTH_STORE)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    depth_integral = mask_integral = None
+    for i, frame_id in enumerate(frame_ids):
+        pixel_array = joblib.load(os.path.join(depth_dir, f'{frame_id}_pixel_array.joblib'))
+        mask_array = joblib.load(os.path.join(depth_dir, f'{frame_id}_mask_array.joblib'))
+        if depth_integral is None:
+            shape = (len(frame_ids), pixel_array.shape[0] + 1, pixel_array.shape[1] + 1)
+            # float64 sums of millimeter depths are exact, int32 counts up to 2^31 pixels
+            depth_integral = np.lib.format.open_memmap(
+                os.path.join(store_dir, 'depth_integral.npy'), mode='w+', dtype=np.float64,
+                shape=shape)
+            mask_integral = np.lib.format.open_memmap(
+                os.path.join(store_dir, 'mask_integral.npy'), mode='w+', dtype=np.int32,
+                shape=shape)
+        frame_shape = (depth_integral.shape[1] - 1, depth_integral.shape[2] - 1)
+        if pixel_array.shape != frame_shape or mask_array.shape != frame_shape:
+            raise ValueError(f'{depth_dir}: frame {frame_id} has shapes {pixel_array.shape} and '
+                             f'{mask_array.shape}, expected {frame_shape}')
+        depth_integral[i] = integral_image(pixel_array, np.float64)
+        mask_integral[i] = integral_image(mask_array, np.int32)
+    depth_integral.flush()
+    mask_integral.flush()
+    # written last, an interrupted conversion leaves no usable store
+    np.save(os.path.join(store_dir, 'frame_ids.npy'), np.array(frame_ids, dtype=np.int64))
+    logger.info(f'{depth_dir}: {len(frame_ids)} key frames converted into {store_dir}')
+    return store_dir
+
+
+def box_slice(start: int, stop: int, size: int) -> tuple:
+    """
+    :return: bounds of array[start: stop] on an axis of this size, with python slicing semantics
+    (negative bounds count from the end, empty if stop <= start)
+    """
+    start, stop, _ = slice(start, stop).indices(size)
+    return start, max(start, stop)
+
+
+class DepthStore:
+    """
+    Depth store of a run written by convert_depth_run, integral images are memory-mapped
+    """
+
+    def __init__(self, store_dir: str):
+        self.frame_ids = np.load(os.path.join(store_dir, 'frame_ids.npy')).tolist()
+        self.frame_index = {frame_id: i for i, frame_id in enumerate(self.frame_ids)}
+        self.depth_integral = np.load(os.path.join(store_dir, 'depth_integral.npy'), mmap_mode='r')
+        self.mask_integral = np.load(os.path.join(store_dir, 'mask_integral.npy'), mmap_mode='r')
+        self.height, self.width = self.mask_integral.shape[1] - 1, self.mask_integral.shape[2] - 1
+
+    def box_sums(self, i: int, xmin: int, xmax: int, ymin: int, ymax: int) -> tuple:
+        """
+        :param i: index of the key frame
+        :return: sum of depth and number of valid pixels in [ymin: ymax + 1, xmin: xmax + 1]
+        """
+        y0, y1 = box_slice(ymin, ymax + 1, self.height)
+        x0, x1 = box_slice(xmin, xmax + 1, self.width)
+        depth, mask = self.depth_integral[i], self.mask_integral[i]
+        return (depth[y1, x1] - depth[y0, x1] - depth[y1, x0] + depth[y0, x0],
+                int(mask[y1, x1]) - int(mask[y0, x1]) - int(mask[y1, x0]) + int(mask[y0, x0]))
+
+    def region_depth(self, frame_id: int, xmin, xmax, ymin, ymax) -> float:
+        """
+        Same as get_depth_region_sparse: mean depth of valid pixels in the box, the box is
+        enlarged 10 pixels at a time until it has valid pixels
+        :param frame_id: key frame
+        :return: depth in millimeters, nan if the frame has no valid pixel
+        """
+        i = self.frame_index[frame_id]
+        xmin, xmax, ymin, ymax = round(xmin), round(xmax), round(ymin), round(ymax)
+        sum_depth, n_pixels = self.box_sums(i, xmin, xmax, ymin, ymax)
+        if n_pixels:
+            return sum_depth / n_pixels
+        if self.mask_integral[i, -1, -1] == 0:
+            logger.warning(f'Key frame {frame_id} has no valid depth pixel')
+            return np.nan
+        xmin_enlarged, xmax_enlarged, ymin_enlarged, ymax_enlarged = xmin, xmax, ymin, ymax
+        while n_pixels == 0:
+            xmin_enlarged = max(xmin_enlarged - 10, 0)
+            ymin_enlarged = max(ymin_enlarged - 10, 0)
+            xmax_enlarged = min(xmax_enlarged + 10, self.width - 1)
+            ymax_enlarged = min(ymax_enlarged + 10, self.height - 1)
+            sum_depth, n_pixels = self.box_sums(i, xmin_enlarged, xmax_enlarged, ymin_enlarged,
+                                                ymax_enlarged)
+        logger.debug(f'Enlarge box from [xmin, ymin, xmax, ymax]={[xmin, ymin, xmax, ymax]} to '
+                     f'{[xmin_enlarged, ymin_enlarged, xmax_enlarged, ymax_enlarged]}')
+        return sum_depth / n_pixels
+
+
+class JoblibDepth:
+    """
+    Same interface as DepthStore on the joblib arrays of a run not converted yet
+    """
+
+    def __init__(self, depth_dir: str):
+        self.depth_dir = depth_dir
+        self.frame_ids = joblib_frame_ids(depth_dir)
+        self.frame_id = None
+
+    def region_depth(self, frame_id: int, xmin, xmax, ymin, ymax) -> float:
+        # arrays of the last key frame are kept, boxes are queried frame by frame
+        if frame_id != self.frame_id:
+            self.pixel_array = joblib.load(os.path.join(self.depth_dir, f'{frame_id}_pixel_array.joblib'))
+            self.mask_array = joblib.load(os.path.join(self.depth_dir, f'{frame_id}_mask_array.joblib'))
+            self.frame_id = frame_id
+        return get_depth_region_sparse(self.pixel_array, self.mask_array, xmin, xmax, ymin, ymax)
+
+
+def open_depth(depth_dir: str):
+    """
+    :param depth_dir: {input_depth}{run}/
+    :return: DepthStore if the run was converted, JoblibDepth otherwise
+    """
+    store_dir = os.path.join(depth_dir, DEPTH_STORE)
+    if os.path.exists(os.path.join(store_dir, 'frame_ids.npy')):
+        return DepthStore(store_dir)
+    logger.info(f'{depth_dir}: no depth store, reading joblib arrays '
+                f'(convert with src/individual_features/depth_store.py)')
+    return JoblibDepth(depth_dir)
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    if '.txt' in args.run:
+        with open(args.run, 'r') as f:
+            runs = [run.strip() for run in f.readlines() if contain_substr(run, ['kinect'])]
+    else:
+        runs = args.run.split(',')
+    for run in runs:
+        depth_dir = f"{args.input_depth}{run.replace('_kinect', '')}"
+        try:
+            convert_depth_run(depth_dir)
+        except Exception as e:
+            logger.error(f'{run}: {repr(e)}')
@@ -5,13 +5,12 @@ from matplotlib import animation as animation, pyplot as plt
 import traceback
 
 from src.utils import parse_config, contain_substr
+from src.individual_features.depth_store import open_depth
 import pandas as pd
 import numpy as np
 from scipy.ndimage import gaussian_filter1d
 import os
 from joblib import Parallel, delayed
-import glob
-import joblib
 import cv2
 import logging
 import warnings
@@ -31,33 +30,6 @@ c_handler.setFormatter(logging.Formatter(LOGFORMAT))
 logger.addHandler(c_handler)
 
 
-def get_depth_region_sparse(pixelwise_matrix, mask_matrix, xmin, xmax, ymin, ymax):
-    # Coordinates range from 0-1079
-    xmin = round(xmin)
-    xmax = round(xmax)
-    ymin = round(ymin)
-    ymax = round(ymax)
-    sum_depth = np.sum(pixelwise_matrix[ymin: ymax + 1, xmin: xmax + 1])
-    n_pixels = np.sum(mask_matrix[ymin: ymax + 1, xmin: xmax + 1])
-    if n_pixels == 0:
-        xmin_enlarged = xmin
-        ymin_enlarged = ymin
-        xmax_enlarged = xmax
-        ymax_enlarged = ymax
-        while n_pixels == 0:
-            xmin_enlarged = max(xmin_enlarged - 10, 0)
-            ymin_enlarged = max(ymin_enlarged - 10, 0)
-            xmax_enlarged = min(xmax_enlarged + 10, mask_matrix.shape[1] - 1)
-            ymax_enlarged = min(ymax_enlarged + 10, mask_matrix.shape[0] - 1)
-            n_pixels = np.sum(mask_matrix[ymin_enlarged: ymax_enlarged + 1, xmin_enlarged:xmax_enlarged + 1])
-        logger.debug(f'Enlarge box from [xmin, ymin, xmax, ymax]={[xmin, ymin, xmax, ymax]} to '
-                     f'{[xmin_enlarged, ymin_enlarged, xmax_enlarged, ymax_enlarged]}')
-        sum_depth = np.sum(pixelwise_matrix[ymin_enlarged: ymax_enlarged + 1, xmin_enlarged:xmax_enlarged + 1])
-        return sum_depth / n_pixels
-    else:
-        return sum_depth / n_pixels
-
-
 def sample_joints(df, ptimes):
     '''
     # Get skeleton 3D (objectPoints) and 2D (cameraPoints) coordinates to estimate camera parameters:
@@ -109,6 +81,32 @@ def find_3D_point(cameraPoint, depthPoint, mtx, rvecs, tvecs):
     return spacePoint
 
 
+def back_project(cameraPoints, depthPoints, mtx, rvecs, tvecs):
+    '''
+    # find_3D_point for many points at once, rotation and camera matrices are inverted once:
+    Input:
+        cameraPoints : N x 2 numpy array of (x,y) coordinates in camera pixel space
+        depthPoints : (1D array of floats) Z distance corresponding to each camera point
+        mtx : 3 x 3 numpy array of camera matrix
+        rvecs : (list of a numpy array) camera rotational vector
+        tvecs : (list of a numpy array) camera translation vector
+    Output:
+        spacePoints : N x 3 numpy array of estimated X, Y, and Z object coordinates
+    '''
+    points = np.hstack([np.asarray(cameraPoints, dtype=np.float64).reshape(-1, 2),
+                        np.ones((len(depthPoints), 1))])
+    rmat, _ = cv2.Rodrigues(rvecs[0])
+    inv_rmat = np.linalg.inv(rmat)
+    inv_mtx = np.linalg.inv(mtx)
+    tvec = np.ravel(tvecs[0])
+    # rows of inv_mtx.p, then inv_rmat.inv_mtx.p and inv_rmat.tvec for every point
+    rays = points.dot(inv_mtx.T)
+    leftSideMat = rays.dot(inv_rmat.T)
+    rightSideMat = inv_rmat.dot(tvec)
+    s = (np.asarray(depthPoints, dtype=np.float64) + rightSideMat[2]) / leftSideMat[:, 2]
+    return (s[:, None] * rays - tvec).dot(inv_rmat.T)
+
+
 def screen_distance(x1, y1, x2, y2):
     """
     Calculate distance xy plane
@@ -183,34 +181,23 @@ def gen_objhand_feature(args, run, tag):
                                                            flags=cv2.CALIB_USE_INTRINSIC_GUESS)
 
         # ------Iterate through key frames and calculate 3D coordinates for objects------
-        all_arrays_pixel = glob.glob(f"{args.input_depth}{run.replace('_kinect', '')}/*_mask_array.joblib")
-        all_arrays_mask = glob.glob(f"{args.input_depth}{run.replace('_kinect', '')}/*_pixel_array.joblib")
-        pixel_ids = list(set([int(os.path.basename(arr).split('_')[0]) for arr in all_arrays_pixel]))
-        mask_ids = list(set([int(os.path.basename(arr).split('_')[0]) for arr in all_arrays_mask]))
-        intersection_ids = list(set(pixel_ids).intersection(set(mask_ids)))
-        assert len(intersection_ids) > 0, "{run}: No intersection!! (1.3.2 has no depth)"
-        union_ids = list(set(pixel_ids).union(set(mask_ids)))
-        logger.info(f"Intersection over Union: {len(intersection_ids)} / {len(union_ids)}")
-        depth_df = pd.DataFrame(index=track_df.index, columns=['3D_x', '3D_y', 'z'], dtype=np.float)
-        for frame_id in sorted(intersection_ids):
-            pixel_array = joblib.load(f"{args.input_depth}{run.replace('_kinect', '')}/{frame_id}_pixel_array.joblib")
-            mask_array = joblib.load(f"{args.input_depth}{run.replace('_kinect', '')}/{frame_id}_mask_array.joblib")
-            # For each key frame, select existing objects and calculate depth
-            for line, row in track_df[track_df['frame'] == frame_id].iterrows():
-                xmin, ymin, xmax, ymax = row['x'], row['y'], row['x'] + row['w'], row['y'] + row['h']
-                # Already tested, using accumulated matrix or pixelwise matrix yield the exactly same result. Summing pixelwise
-                # matrix is less time-consuming, relative to calculating accumulated matrix. #objects in a frame is small.
-                # region_depth = get_depth_region(accu_array, mask_array, xmin, xmax, ymin, ymax)
-                region_depth = get_depth_region_sparse(pixel_array, mask_array, xmin, xmax, ymin, ymax)
-                # skeleton depth values is in meter while kinect extracted values (to calculate objects) is in millimeter
-                region_depth /= 1000
-                x_cent = (xmin + xmax) / 2
-                y_cent = (ymin + ymax) / 2
-                # returned values can be null, making dist_z (later) null. One reason is null is camera calibration
-                xyz_3d = find_3D_point(cameraPoint=(x_cent, y_cent), depthPoint=region_depth, mtx=mtx, rvecs=rvecs, tvecs=tvecs)
-                if np.any(pd.notnull(depth_df.iloc[line, :])):
-                    logger.warning('the same object at a particular frame is assigned twice!!')
-                depth_df.iloc[line, :] = xyz_3d[0]  # xyz_3d is a 2d-array
+        # depth store of the run (see depth_store.py), or its joblib arrays if not converted
+        depth = open_depth(f"{args.input_depth}{run.replace('_kinect', '')}")
+        assert len(depth.frame_ids) > 0, f"{run}: No intersection!! (1.3.2 has no depth)"
+        # For each key frame, select existing objects and calculate depth
+        key_df = track_df[track_df['frame'].isin(depth.frame_ids)].sort_values('frame', kind='stable')
+        xmin, ymin = key_df['x'].to_numpy(), key_df['y'].to_numpy()
+        xmax, ymax = xmin + key_df['w'].to_numpy(), ymin + key_df['h'].to_numpy()
+        # Already tested, using accumulated matrix or pixelwise matrix yield the exactly same result.
+        # skeleton depth values is in meter while kinect extracted values (to calculate objects) is in millimeter
+        region_depth = np.array([depth.region_depth(frame_id, *box) for frame_id, box in
+                                 zip(key_df['frame'], zip(xmin, xmax, ymin, ymax))],
+                                dtype=np.float64) / 1000
+        # returned values can be null, making dist_z (later) null. One reason is null is camera calibration
+        xyz_3d = back_project(cameraPoints=np.stack([(xmin + xmax) / 2, (ymin + ymax) / 2], axis=1),
+                              depthPoints=region_depth, mtx=mtx, rvecs=rvecs, tvecs=tvecs)
+        depth_df = pd.DataFrame(xyz_3d, index=key_df.index, columns=['3D_x', '3D_y', 'z']).reindex(
+            track_df.index)
         track_df = pd.concat([track_df, depth_df], axis=1)
 
         # -----Read skeleton result and set index by frame to merge tracking and skeleton-----
@@ -254,42 +241,22 @@ def gen_objhand_feature(args, run, tag):
         logger.info('Interpolate Joints and Depth value')
         logger.info('For Joints, limit_area is inside (interpolate inside only), for Depth, limit_direction is both '
                     '(interpolate and extrapolate in both directions, but within a bound inferred by x existing)')
-        for obj in objs:
-            # frames where this object is existing
-            bound_index = objhand_df[obj + '_x'].dropna().index
-            # Interestingly, changing supposed_a_view does NOT change objhand_df[obj + '_z'] -> supposed_a_view is a copy
-            # supposed_a_view = objhand_df[obj + '_z'].iloc[bound_index]
-            # supposed_a_view.interpolate(limit_direction='both', inplace=True)
-            # Interpolate and extrapolate both direction within the bound
-            objhand_df[obj + '_z'].iloc[bound_index] = objhand_df[obj + '_z'].iloc[bound_index].interpolate(
-                limit_direction='both')
-            objhand_df[obj + '_3D_x'].iloc[bound_index] = objhand_df[obj + '_3D_x'].iloc[bound_index].interpolate(
-                limit_direction='both')
-            objhand_df[obj + '_3D_y'].iloc[bound_index] = objhand_df[obj + '_3D_y'].iloc[bound_index].interpolate(
-                limit_direction='both')
-        objhand_df['J11_2D_X'] = objhand_df['J11_2D_X'].interpolate(limit_area='inside')
-        objhand_df['J11_2D_Y'] = objhand_df['J11_2D_Y'].interpolate(limit_area='inside')
-        objhand_df['J11_3D_X'] = objhand_df['J11_3D_X'].interpolate(limit_area='inside')
-        objhand_df['J11_3D_Y'] = objhand_df['J11_3D_Y'].interpolate(limit_area='inside')
-        objhand_df['J11_3D_Z'] = objhand_df['J11_3D_Z'].interpolate(limit_area='inside')
+        # The index of objhand_df is consecutive frames, rows are frames and columns are objects x coordinates
+        # frames where each object is existing
+        bound = objhand_df[object_columns(objs, ['_x'])].notnull().to_numpy()
+        depth_columns = object_columns(objs, ['_z', '_3D_x', '_3D_y'])
+        # Interpolate and extrapolate both direction within the bound
+        objhand_df[depth_columns] = interpolate_time(objhand_df[depth_columns].to_numpy(dtype=np.float64),
+                                                     bound=np.repeat(bound, 3, axis=1), extrapolate=True)
+        hand_columns = ['J11_2D_X', 'J11_2D_Y', 'J11_3D_X', 'J11_3D_Y', 'J11_3D_Z']
+        objhand_df[hand_columns] = interpolate_time(objhand_df[hand_columns].to_numpy(dtype=np.float64))
 
         # Smooth movements
         logger.info('Gaussian filtering')
-        for obj in objs:
-            objhand_df[obj + '_x_cent'] = gaussian_filter1d(objhand_df[obj + '_x_cent'], 3)
-            objhand_df[obj + '_y_cent'] = gaussian_filter1d(objhand_df[obj + '_y_cent'], 3)
-            objhand_df[obj + '_x'] = gaussian_filter1d(objhand_df[obj + '_x'], 3)
-            objhand_df[obj + '_y'] = gaussian_filter1d(objhand_df[obj + '_y'], 3)
-            objhand_df[obj + '_z'] = gaussian_filter1d(objhand_df[obj + '_z'], 3)
-            objhand_df[obj + '_3D_x'] = gaussian_filter1d(objhand_df[obj + '_3D_x'], 3)
-            objhand_df[obj + '_3D_y'] = gaussian_filter1d(objhand_df[obj + '_3D_y'], 3)
-            objhand_df[obj + '_w'] = gaussian_filter1d(objhand_df[obj + '_w'], 3)
-            objhand_df[obj + '_h'] = gaussian_filter1d(objhand_df[obj + '_h'], 3)
-        objhand_df['J11_2D_X'] = gaussian_filter1d(objhand_df['J11_2D_X'], 3)
-        objhand_df['J11_2D_Y'] = gaussian_filter1d(objhand_df['J11_2D_Y'], 3)
-        objhand_df['J11_3D_X'] = gaussian_filter1d(objhand_df['J11_3D_X'], 3)
-        objhand_df['J11_3D_Y'] = gaussian_filter1d(objhand_df['J11_3D_Y'], 3)
-        objhand_df['J11_3D_Z'] = gaussian_filter1d(objhand_df['J11_3D_Z'], 3)
+        smooth_columns = object_columns(objs, ['_x_cent', '_y_cent', '_x', '_y', '_z', '_3D_x', '_3D_y', '_w',
+                                               '_h']) + hand_columns
+        objhand_df[smooth_columns] = gaussian_filter1d(objhand_df[smooth_columns].to_numpy(dtype=np.float64), 3,
+                                                       axis=0)
         # Let do resampling when combining with other features while running SEM, not here
         # objhand_df.loc[:, 'sync_time'] = objhand_df.index / fps
         # objhand_df.loc[:, 'frame'] = objhand_df.index
@@ -299,16 +266,17 @@ def gen_objhand_feature(args, run, tag):
         resampledf['frame'] = resampledf.index  # To concatenate with other features
         # Calculate distances between all objects and hand
         logger.info('Calculate object-hand distances')
-        # condition np.all(pd.notnull(x))) to ensure a valid row, e.g. J11_3D_Z have more values than J11_2D_X
-        for obj in objs:
-            resampledf[obj + '_dist'] = resampledf[
-                [obj + '_x_cent', obj + '_y_cent', 'J11_2D_X', 'J11_2D_Y']].apply(
-                lambda x: screen_distance(x[0], x[1], x[2], x[3])
-                if (np.all(pd.notnull(x))) else np.nan, axis=1)
-            resampledf[obj + '_dist_z'] = resampledf[
-                [obj + '_3D_x', obj + '_3D_y', obj + '_z', 'J11_3D_X', 'J11_3D_Y', 'J11_3D_Z']].apply(
-                lambda x: depth_distance(x[0], x[1], x[2], x[3], x[4], x[5])
-                if (np.all(pd.notnull(x))) else np.nan, axis=1)
+        # null if a coordinate is null, e.g. J11_3D_Z have more values than J11_2D_X
+        n_frames = len(resampledf)
+        dist = hand_distances(
+            resampledf[object_columns(objs, ['_x_cent', '_y_cent'])].to_numpy().reshape(n_frames, len(objs), 2),
+            resampledf[['J11_2D_X', 'J11_2D_Y']].to_numpy())
+        dist_z = hand_distances(
+            resampledf[object_columns(objs, ['_3D_x', '_3D_y', '_z'])].to_numpy().reshape(n_frames, len(objs), 3),
+            resampledf[['J11_3D_X', 'J11_3D_Y', 'J11_3D_Z']].to_numpy())
+        dist_df = pd.DataFrame(np.stack([dist, dist_z], axis=2).reshape(n_frames, -1), index=resampledf.index,
+                               columns=object_columns(objs, ['_dist', '_dist_z']))
+        resampledf = pd.concat([resampledf, dist_df], axis=1)
         resampledf.to_csv(output_csv, index=False)
         logger.info(f'Done Objhand {run}')
         with open(f'output/objhand_complete_{tag}.txt', 'a') as f:
@@ -322,6 +290,64 @@ def gen_objhand_feature(args, run, tag):
         return None, None, None
 
 
+def object_columns(objs, suffixes):
+    """
+    :param objs: object instances, e.g. bowl0
+    :param suffixes: e.g. ['_x_cent', '_y_cent']
+    :return: columns of all objects, object-major, to be reshaped into (T, n_objects, n_suffixes)
+    """
+    return [obj + suffix for obj in objs for suffix in suffixes]
+
+
+def interpolate_time(values, bound=None, extrapolate=False):
+    """
+    Linear interpolation of missing values along the time axis of all columns at once, same as
+    Series.interpolate on each column (restricted to its bound rows)
+    :param values: T x k array
+    :param bound: T x k boolean array, each column is interpolated over its bound rows only, taken as
+    consecutive, other rows are left untouched. None: all rows
+    :param extrapolate: also fill values before the first and after the last value of a column
+    with those values (limit_direction='both'), otherwise only inside (limit_area='inside')
+    :return: interpolated copy of values
+    """
+    n_rows = len(values)
+    if bound is None:
+        bound = np.ones(values.shape, dtype=bool)
+    missing = bound & np.isnan(values)
+    # rank of each row among the bound rows of its column
+    position = np.cumsum(bound, axis=0)
+    rows = np.arange(n_rows)[:, None]
+    known = bound & ~missing
+    prev_row = np.maximum.accumulate(np.where(known, rows, -1), axis=0)
+    next_row = np.minimum.accumulate(np.where(known, rows, n_rows)[::-1], axis=0)[::-1]
+    has_prev, has_next = prev_row >= 0, next_row < n_rows
+    columns = np.arange(values.shape[1])
+    prev_row, next_row = np.clip(prev_row, 0, n_rows - 1), np.clip(next_row, 0, n_rows - 1)
+    prev_value, next_value = values[prev_row, columns], values[next_row, columns]
+    prev_position, next_position = position[prev_row, columns], position[next_row, columns]
+    result = values.copy()
+    inside = missing & has_prev & has_next
+    # as np.interp, which pandas uses
+    slope = (next_value[inside] - prev_value[inside]) / (next_position[inside] - prev_position[inside])
+    result[inside] = slope * (position[inside] - prev_position[inside]) + prev_value[inside]
+    if extrapolate:
+        result[missing & has_prev & ~has_next] = prev_value[missing & has_prev & ~has_next]
+        result[missing & ~has_prev & has_next] = next_value[missing & ~has_prev & has_next]
+    return result
+
+
+def hand_distances(objects, hand):
+    """
+    Distances between objects and the hand at each frame
+    :param objects: T x n_objects x k array of object coordinates
+    :param hand: T x k array of hand coordinates
+    :return: T x n_objects array, null if a coordinate of the object or the hand is null
+    """
+    distances = np.linalg.norm(objects - hand[:, None, :], axis=2)
+    distances[np.isnan(objects).any(axis=2) | np.isnan(hand).any(axis=1)[:, None]] = np.nan
+    return distances
+
+
 def calculateDistance(x1, y1, x2, y2):
     if (x1, y1, x2, y2):
         distance = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
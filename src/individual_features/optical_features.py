@@ -1,3 +1,4 @@
+import math
 import sys
 import traceback
 
@@ -9,61 +10,311 @@ import ray
 ray.init(num_cpus=16)
 from joblib import Parallel, delayed
 from scipy.stats.stats import pearsonr
-from src.utils import parse_config, contain_substr, logger
+from src.utils import parse_config, contain_substr, logger, CV2VideoReader
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
 
+def sampled_frames(input_video_path, skip_frame: int, stabilize='vidgear', downscale=1,
+                   first_frame=1, last_frame=None):
+    """
+    Grayscale frames used for optical features: every skip_frame-th frame (frame ids start at 1)
+    :param input_video_path:
+    :param skip_frame:
+    :param stabilize: vidgear: decode and stabilize every frame with VideoGear,
+    otherwise frames in between are grabbed without being decoded to images
+    :param downscale: frames are shrunk by this factor
+    :param first_frame: seek to this frame id first (not with vidgear)
+    :param last_frame: stop after this frame id, None: end of the video
+    :return: generator of frame_id, gray
+    """
+    import cv2
+    if stabilize == 'vidgear':
+        from vidgear.gears import VideoGear
+        video_reader = VideoGear(source=input_video_path, stabilize=True).start()
+        first_frame = 1
+    else:
+        video_reader = CV2VideoReader(input_video_path)
+        if first_frame > 1:
+            video_reader.capture.set(cv2.CAP_PROP_POS_FRAMES, first_frame - 1)
+    frame_id = first_frame - 1
+    try:
+        while last_frame is None or frame_id < last_frame:
+            frame_id += 1
+            if stabilize == 'vidgear':
+                frame = video_reader.read()
+            elif frame_id % skip_frame:
+                # skipped frames are not retrieved nor converted
+                frame = np.empty(0) if video_reader.skip_frame() else None
+            else:
+                ret, frame = video_reader.read_frame()
+            if frame is None:
+                logger.info('End of video stream, frame is None!')
+                break
+            if frame_id % skip_frame:
+                continue
+            logger.debug(f'Processing frame {frame_id}')
+            yield frame_id, shrink(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), downscale)
+    finally:
+        if stabilize == 'vidgear':
+            video_reader.stop()
+        else:
+            video_reader.release()
+
+
+def shrink(gray, downscale=1):
+    """
+    :param gray:
+    :param downscale:
+    :return: gray shrunk by downscale (area interpolation)
+    """
+    import cv2
+    if downscale == 1:
+        return gray
+    return cv2.resize(gray, (gray.shape[1] // downscale, gray.shape[0] // downscale),
+                      interpolation=cv2.INTER_AREA)
+
+
+def compensate_global_motion(prev_gray, gray, min_shift=0.5):
+    """
+    Cheap replacement of stabilization on a sampled pair: shift prev_gray by the global translation
+    between the two frames (phase correlation), if the shift is large enough and aligning
+    actually reduces the difference between the frames (e.g. not locked on a moving object)
+    :param prev_gray:
+    :param gray:
+    :param min_shift: pixels
+    :return: prev_gray, aligned to gray if the camera moved
+    """
+    import cv2
+    (dx, dy), response = cv2.phaseCorrelate(prev_gray.astype(np.float32), gray.astype(np.float32))
+    if np.hypot(dx, dy) < min_shift:
+        return prev_gray
+    shift = np.float32([[1, 0, dx], [0, 1, dy]])
+    aligned = cv2.warpAffine(prev_gray, shift, (gray.shape[1], gray.shape[0]),
+                             borderMode=cv2.BORDER_REPLICATE)
+    if cv2.norm(aligned, gray, cv2.NORM_L1) < cv2.norm(prev_gray, gray, cv2.NORM_L1):
+        return aligned
+    return prev_gray
+
+
+class FarnebackFlow:
+    """
+    Dense Farneback flow at the resolution of the sampled frames
+    """
+
+    def __init__(self, args):
+        self.params = (float(args.pyr_scale), int(args.levels), int(args.winsize),
+                       int(args.iterations), int(args.poly_n), float(args.poly_sigma),
+                       int(args.flags))
+
+    def prepare(self, gray):
+        """
+        :param gray: sampled frame
+        :return: what flow_avg needs of this frame, computed once per frame
+        """
+        return gray
+
+    def flow_avg(self, prev_prepared, prepared):
+        """
+        :param prev_prepared: prepare of the previous sampled frame
+        :param prepared: prepare of the current sampled frame
+        :return: mean flow magnitude, in pixels of the sampled frames
+        """
+        import cv2
+        flow = cv2.calcOpticalFlowFarneback(prev_prepared, prepared, None, *self.params)
+        magnitude, angle = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+        return np.mean(magnitude)
+
+
+class PyramidFlow(FarnebackFlow):
+    """
+    Farneback flow on frames shrunk pyramid_levels times by cv2.pyrDown, magnitudes are
+    scaled back. Pixel correlation is still computed on the sampled frames
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.pyramid_levels = int(getattr(args, 'pyramid_levels', 1))
+
+    def prepare(self, gray):
+        import cv2
+        for _ in range(self.pyramid_levels):
+            gray = cv2.pyrDown(gray)
+        return gray
+
+    def flow_avg(self, prev_prepared, prepared):
+        return super().flow_avg(prev_prepared, prepared) * 2 ** self.pyramid_levels
+
+
+class DISFlow(FarnebackFlow):
+    """
+    Dense Inverse Search flow (OpenCV), dis_preset: ultrafast, fast or medium
+    """
+
+    def __init__(self, args):
+        import cv2
+        preset = getattr(args, 'dis_preset', 'fast')
+        self.dis = cv2.DISOpticalFlow_create(
+            getattr(cv2, f'DISOPTICAL_FLOW_PRESET_{preset.upper()}'))
+
+    def flow_avg(self, prev_prepared, prepared):
+        import cv2
+        flow = self.dis.calc(prev_prepared, prepared, None)
+        magnitude, angle = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+        return np.mean(magnitude)
+
+
+FLOW_ENGINES = dict(farneback=FarnebackFlow, pyramid=PyramidFlow, dis=DISFlow)
+
+
+def get_flow_engine(args, flow_engine=None):
+    """
+    :param args: optical features config
+    :param flow_engine: one of FLOW_ENGINES, None: args.flow_engine (farneback by default)
+    :return:
+    """
+    flow_engine = flow_engine or getattr(args, 'flow_engine', 'farneback')
+    if flow_engine not in FLOW_ENGINES:
+        raise ValueError(f'Unknown flow_engine {flow_engine}, expected one of {list(FLOW_ENGINES)}')
+    return FLOW_ENGINES[flow_engine](args)
+
+
+def frame_moments(gray) -> tuple:
+    """
+    Computed once per sampled frame, so that each pair only costs a dot product
+    :param gray:
+    :return: pixels as float64, their sum and sum of squares (exact integers)
+    """
+    pixels = gray.ravel().astype(np.float64)
+    return pixels, int(pixels.sum()), int(pixels @ pixels)
+
+
+def pixel_correlation(prev_moments, moments) -> float:
+    """
+    1 - Pearson correlation between the pixels of two frames, from their frame_moments
+    :param prev_moments:
+    :param moments:
+    :return: pixel_correlation, nan if a frame is uniform
+    """
+    prev_pixels, prev_sum, prev_sum_sq = prev_moments
+    pixels, pixel_sum, sum_sq = moments
+    n = len(pixels)
+    # integer arithmetic, products of uint8 pixels are summed exactly in float64
+    covariance = n * int(prev_pixels @ pixels) - prev_sum * pixel_sum
+    variance = (n * prev_sum_sq - prev_sum ** 2) * (n * sum_sq - pixel_sum ** 2)
+    if variance == 0:
+        return np.nan
+    return 1.0 - covariance / math.sqrt(variance)
+
+
+def pair_features(prev_gray, gray, args, downscale=1) -> list:
+    """
+    Reference implementation (Farneback, scipy pearsonr on each pair), the baseline of
+    benchmark_optical_engines.py
+    :param prev_gray: previous sampled frame
+    :param gray: current sampled frame
+    :param args: Farneback parameters
+    :param downscale: flow magnitudes are scaled back to full resolution pixels
+    :return: optical_flow_avg, pixel_correlation
+    """
+    import cv2
+    # compute dense optical flow:
+    flow = cv2.calcOpticalFlowFarneback(prev_gray, gray, None, float(args.pyr_scale),
+                                        int(args.levels), int(args.winsize),
+                                        int(args.iterations),
+                                        int(args.poly_n), float(args.poly_sigma),
+                                        int(args.flags))
+    magnitude, angle = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+    cor, p = pearsonr(gray.flatten(), prev_gray.flatten())
+    flow_avg = np.mean(magnitude)
+    if downscale != 1:
+        flow_avg = flow_avg * downscale
+    return [flow_avg, 1.0 - cor]
+
+
+def optical_chunk(args, input_video_path, first_frame=None, last_frame=None) -> list:
+    """
+    Optical features of the sampled frames between first_frame and last_frame
+    :param args: optical features config
+    :param input_video_path:
+    :param first_frame: first sampled frame id to output, None: from the start. The sampled frame
+    before it is read too, as the previous frame of the first pair
+    :param last_frame: last frame id, None: end of the video
+    :return: csv rows: frame, optical_flow_avg, pixel_correlation
+    """
+    skip_frame = int(args.skip_frame)
+    stabilize = getattr(args, 'stabilize', 'vidgear')
+    downscale = int(getattr(args, 'downscale', 1))
+    flow_engine = get_flow_engine(args)
+    rows = []
+    prev_gray = None
+    read_from = 1 if first_frame is None else max(first_frame - skip_frame, 1)
+    for frame_id, gray in sampled_frames(input_video_path, skip_frame, stabilize=stabilize,
+                                         downscale=downscale, first_frame=read_from,
+                                         last_frame=last_frame):
+        # per-frame work is shared by the two pairs of each frame
+        prepared, moments = flow_engine.prepare(gray), frame_moments(gray)
+        if prev_gray is None:
+            prev_gray, prev_prepared, prev_moments = gray, prepared, moments
+            # overlap with the previous chunk, only the previous frame of the first pair
+            if first_frame is not None and frame_id < first_frame:
+                continue
+        if stabilize == 'global':
+            aligned = compensate_global_motion(prev_gray, gray)
+            if aligned is not prev_gray:
+                prev_prepared, prev_moments = flow_engine.prepare(aligned), frame_moments(aligned)
+        flow_avg = flow_engine.flow_avg(prev_prepared, prepared)
+        if downscale != 1:
+            flow_avg = flow_avg * downscale
+        rows.append([str(frame_id), str(flow_avg), str(pixel_correlation(prev_moments, moments))])
+        prev_gray, prev_prepared, prev_moments = gray, prepared, moments
+    return rows
+
+
+optical_chunk_remote = ray.remote(optical_chunk)
+
+
+def chunk_ranges(n_frames: int, skip_frame: int, chunk_frames: int) -> list:
+    """
+    :param n_frames: number of frames of the video (approximate, the last chunk reads to the end)
+    :param skip_frame:
+    :param chunk_frames: frames per chunk, rounded up to a multiple of skip_frame
+    :return: (first_frame, last_frame) of each chunk
+    """
+    chunk_frames = -(-chunk_frames // skip_frame) * skip_frame
+    firsts = list(range(skip_frame, max(n_frames, skip_frame) + 1, chunk_frames))
+    return [(first, next_first - 1) for first, next_first in zip(firsts, firsts[1:])] + \
+           [(firsts[-1], None)]
+
+
 @ray.remote
 def gen_optical_features(args, run, tag):
     try:
         logger.info(f'Config {args}')
-        import cv2
         csv_headers = ['frame', 'optical_flow_avg', 'pixel_correlation']
         input_video_path = os.path.join(args.input_video_path, run + '_trim.mp4')
         output_csv_path = os.path.join(args.output_csv_path, f'{run}_{tag}_video_features.csv')
+        chunk_frames = int(getattr(args, 'chunk_frames', 0))
+        if chunk_frames and getattr(args, 'stabilize', 'vidgear') == 'vidgear':
+            logger.warning(f'{run}: VideoGear stabilization depends on all previous frames, '
+                           f'not splitting the video into chunks')
+            chunk_frames = 0
+        if chunk_frames:
+            # pairs only depend on two frames, chunks overlap by one sampled frame
+            video_reader = CV2VideoReader(input_video_path)
+            n_frames = int(video_reader.total_frames)
+            video_reader.release()
+            chunks = chunk_ranges(n_frames, int(args.skip_frame), chunk_frames)
+            logger.info(f'{run}: {len(chunks)} chunks of {chunk_frames} frames')
+            chunk_rows = ray.get([optical_chunk_remote.remote(args, input_video_path, first, last)
+                                  for first, last in chunks])
+            rows = [row for rows in chunk_rows for row in rows]
+        else:
+            rows = optical_chunk(args, input_video_path)
         with open(output_csv_path, 'w') as g:
             writer = csv.writer(g)
             writer.writerow(csv_headers)
-        # cv2_video_reader = CV2VideoReader(input_video_path=input_video_path)
-        from vidgear.gears import VideoGear
-        vg_video_reader = VideoGear(source=input_video_path, stabilize=True).start()
-        frame_id = 0
-        # ret, frame = cv2_video_reader.read_frame()
-        prev_gray = None
-        # while cv2_video_reader.capture.isOpened():
-        # for frame in mvp_video_reader.iter_frames():
-        while True:
-            frame_id += 1
-            frame = vg_video_reader.read()
-            if frame is None:
-                logger.info('End of video stream, frame is None!')
-                break
-            # ret, frame = cv2_video_reader.read_frame()
-            # if not ret:
-            #     logger.info('End of video stream, ret is False!')
-            #     break
-            if frame_id % int(args.skip_frame):
-                continue
-
-            logger.debug(f'Processing frame {frame_id}')
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            # compute dense optical flow:
-            if prev_gray is None:
-                prev_gray = gray
-            flow = cv2.calcOpticalFlowFarneback(prev_gray, gray, None, float(args.pyr_scale),
-                                                int(args.levels), int(args.winsize),
-                                                int(args.iterations),
-                                                int(args.poly_n), float(args.poly_sigma),
-                                                int(args.flags))
-            magnitude, angle = cv2.cartToPolar(flow[..., 0], flow[..., 1])
-            cor, p = pearsonr(gray.flatten(), prev_gray.flatten())
-            with open(output_csv_path, 'a') as g:
-                writer = csv.writer(g)
-                writer.writerow([str(frame_id), str(np.mean(magnitude)), str(1.0 - cor)])
-            prev_gray = gray
-        # cv2_video_reader.capture.release()
-        vg_video_reader.stop()
+            writer.writerows(rows)
         logger.info(f'Done Vid {run}')
         with open(f'output/optical_complete_{tag}.txt', 'a') as f:
             f.write(run + '\n')
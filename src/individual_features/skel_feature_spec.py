@@ -0,0 +1,102 @@
+"""
+Column groups of skeleton feature csvs ({run}_{feature_tag}_skel_features.csv), shared by the
+extractor (skel_features.py, which computes and writes only the groups it is asked for) and
+its consumers (preprocess_skel, pool_features, which read only the groups they declare).
+J1 (spine mid) is the origin of dist and rel, its constant columns are not written.
+"""
+# smoothed input coordinates, distance from J1, speed and acceleration of joints,
+# distance/speed/acceleration between hands, coordinates relative to J1 with shoulders aligned
+SKEL_GROUPS = ['2D', '3D', 'dist', 'speed', 'accel', 'interhand', 'rel']
+# groups used as SEM inputs (preprocess_skel with use_position=0) and pooled for global stats
+MODEL_GROUPS = ['dist', 'speed', 'accel', 'interhand', 'rel']
+# written with every group
+INDEX_COLUMNS = ['sync_time', 'frame']
+ALL_JOINTS = list(range(25))
+
+
+def group_joints(group: str, joints=ALL_JOINTS) -> list:
+    """
+    :param group: one of SKEL_GROUPS
+    :param joints: joints of dist, speed and accel (the extractor's joints setting)
+    :return: joints with columns in this group
+    """
+    if group in ['2D', '3D']:
+        return ALL_JOINTS
+    if group == 'interhand':
+        return []
+    if group == 'rel':
+        return [j for j in ALL_JOINTS if j != 1]
+    if group == 'dist':
+        return [j for j in joints if j != 1]
+    return list(joints)
+
+
+def joint_columns(group: str, joint: int) -> list:
+    """
+    :param group: one of SKEL_GROUPS but interhand
+    :param joint:
+    :return: columns of this joint in this group
+    """
+    if group == '2D':
+        return [f'J{joint}_2D_{dim}' for dim in ['X', 'Y']]
+    if group == '3D':
+        return [f'J{joint}_3D_{dim}' for dim in ['X', 'Y', 'Z']]
+    if group == 'rel':
+        return [f'J{joint}_3D_rel_{dim}' for dim in ['X', 'Y', 'Z']]
+    suffix = dict(dist='dist_from_J1', speed='speed', accel='acceleration')[group]
+    return [f'J{joint}_{suffix}']
+
+
+def group_columns(group: str, joints=ALL_JOINTS) -> list:
+    """
+    :param group: one of SKEL_GROUPS
+    :param joints: joints of dist, speed and accel
+    :return: columns of this group
+    """
+    if group == 'interhand':
+        return ['interhand_dist', 'interhand_speed', 'interhand_acceleration']
+    return [column for j in group_joints(group, joints) for column in joint_columns(group, j)]
+
+
+def spec_columns(groups: list, joints=ALL_JOINTS) -> list:
+    """
+    :param groups:
+    :param joints: joints of dist, speed and accel
+    :return: feature columns of these groups in the order of the original csv layout, whatever the
+    order of groups: positions, then dist/speed/accel interleaved per joint, interhand and rel
+    """
+    columns = group_columns('2D') if '2D' in groups else []
+    columns += group_columns('3D') if '3D' in groups else []
+    motion_groups = [group for group in ['dist', 'speed', 'accel'] if group in groups]
+    for j in joints:
+        columns += [joint_columns(group, j)[0] for group in motion_groups
+                    if j in group_joints(group, joints)]
+    for group in ['interhand', 'rel']:
+        columns += group_columns(group) if group in groups else []
+    return columns
+
+
+def parse_groups(groups: str) -> list:
+    """
+    :param groups: comma separated groups of SKEL_GROUPS, 'model' stands for MODEL_GROUPS
+    (e.g. model,2D)
+    :return: groups, in order and without duplicates
+    """
+    parsed = []
+    for group in groups.split(','):
+        group = group.strip()
+        for name in (MODEL_GROUPS if group == 'model' else [group]):
+            if name not in SKEL_GROUPS:
+                raise ValueError(f'Unknown skeleton feature group {name}, expected one of '
+                                 f'{SKEL_GROUPS} or model')
+            if name not in parsed:
+                parsed.append(name)
+    return parsed
+
+
+def consumer_groups(use_position=0) -> list:
+    """
+    :param use_position: preprocess_skel also uses 2D joint positions
+    :return: groups read by preprocess_skel
+    """
+    return MODEL_GROUPS + (['2D'] if use_position else [])
@@ -10,89 +10,194 @@ import pandas as pd
 from joblib import Parallel, delayed
 from src.utils import logger, parse_config, contain_substr
 from scipy.spatial.transform import Rotation as R
-import math
+from src.individual_features.skel_feature_spec import ALL_JOINTS, INDEX_COLUMNS, group_columns, \
+    group_joints, joint_columns, parse_groups, spec_columns
 
 
-def calc_joint_dist(df, joint):
+def joint_array(df, kind='3D'):
     # df : skeleton tracking dataframe with 3D joint coordinates
-    # joint : integer 0 to 24 corresponding to a Kinect skeleton joint
-    # returns df with column of distance between the joint and spine mid:
-    # some key joints are spine_mid:J1,left hand:J7,right hand: J11, foot left J15, foot right: J19
-    j = str(joint)
-    jx = 'J' + j + '_3D_X'
-    jy = 'J' + j + '_3D_Y'
-    jz = 'J' + j + '_3D_Z'
-    jout = 'J' + j + '_dist_from_J1'
-    df[jout] = np.sqrt(
-        (df[jx] - df.J1_3D_X) ** 2 + (df[jy] - df.J1_3D_Y) ** 2 + (df[jz] - df.J1_3D_Z) ** 2)
-    return df
-
-
-def calc_joint_speed(df, joint):
-    j = str(joint)
-    jx = 'J' + j + '_3D_X'
-    jy = 'J' + j + '_3D_Y'
-    jz = 'J' + j + '_3D_Z'
-    jout = 'J' + j + '_speed'
-    df[jout] = np.sqrt((df[jx] - df[jx].shift(1)) ** 2 + (df[jy] - df[jy].shift(1)) ** 2 + (
-            df[jz] - df[jz].shift(1)) ** 2) / (df.sync_time - df.sync_time.shift(1))
-    return df
-
-
-def calc_joint_acceleration(df, joint):
-    j = str(joint)
-    js = 'J' + j + '_speed'
-    if js not in df.columns:
-        df = calc_joint_speed(df, joint)
-    jout = 'J' + j + '_acceleration'
-    df[jout] = (df[js] - df[js].shift(1)) / (df.sync_time - df.sync_time.shift(1))
-    return df
-
-
-def calc_interhand_dist(df):
-    df['interhand_dist'] = np.sqrt(
-        (df.J11_3D_X - df.J7_3D_X) ** 2 + (df.J11_3D_Y - df.J7_3D_Y) ** 2 + (
-                df.J11_3D_Z - df.J7_3D_Z) ** 2)
-    return df
-
-
-def calc_interhand_speed(df):
-    # Values are positive when hands moving away negative when hands get closer
-    if 'interhand_dist' not in df.columns:
-        df = calc_interhand_dist(df)
-    df['interhand_speed'] = (df['interhand_dist'] - df['interhand_dist'].shift(1)) / (
-            df.sync_time - df.sync_time.shift(1))
-    return df
-
-
-def calc_interhand_acceleration(df):
-    # Values are positive when interhand speed is increasing and negative when decreasing
-    if 'interhand_speed' not in df.columns:
-        df = calc_interhand_speed(df)
-    df['interhand_acceleration'] = (df['interhand_speed'] - df['interhand_speed'].shift(1)) / (
-            df.sync_time - df.sync_time.shift(1))
-    return df
+    # returns (T, 25, 3) array of the joints' X, Y, Z columns (e.g. J0_3D_X ... J24_3D_Z)
+    columns = [f'J{j}_{kind}_{dim}' for j in range(25) for dim in ['X', 'Y', 'Z']]
+    return df[columns].to_numpy(dtype=float).reshape(len(df), 25, 3)
 
 
-def calc_joint_rel_position(df):
+def rolling_mean(values, window):
+    # values : (T, ...) array
+    # returns the mean of each row and the window - 1 rows before it, NaN on the first
+    # window - 1 rows and for windows with a NaN, as DataFrame.rolling(window).mean()
+    smoothed = np.full(values.shape, np.nan)
+    n_windows = len(values) - window + 1
+    if n_windows > 0:
+        smoothed[window - 1:] = sum(values[i: i + n_windows] for i in range(window)) / window
+    return smoothed
+
+
+def norm(vectors):
+    # vectors : (..., 3) array
+    # returns euclidean norms, (...) array
+    return np.sqrt((vectors ** 2).sum(axis=-1))
+
+
+def per_second(values, sync_time):
+    # values : (T, ...) array, sync_time : (T,) seconds of each row
+    # returns change of values between consecutive rows divided by elapsed time, NaN on the first row
+    rates = np.full(values.shape, np.nan)
+    elapsed = np.diff(sync_time).reshape((-1,) + (1,) * (values.ndim - 1))
+    rates[1:] = np.diff(values, axis=0) / elapsed
+    return rates
+
+
+def rel_positions(joints):
     # left shoulder : J4
     # right shoulder : J8
-    # df : skeleton tracking dataframe with 3D joint coordinates
-    # returns df with columns for joints translated to SpineMid as origin and shoulders rotated to same Z value
+    # joints : (T, 25, 3) array of 3D joint coordinates
+    # returns joints translated to SpineMid as origin and shoulders rotated to same Z value
     # Translate all joints to J1 as origin:
+    rel = joints - joints[:, [1], :]
+    # calculate angle of each frame for rotation and rotate around the Y-axis:
+    rotation_radians = np.arctan2(rel[:, 4, 2] - rel[:, 8, 2], rel[:, 4, 0] - rel[:, 8, 0])
+    rotation_vectors = rotation_radians[:, np.newaxis] * np.array([0, 1, 0])  # Y-axis
+    rotation = R.from_rotvec(rotation_vectors)
     for j in range(25):
-        for dim in ['X', 'Y', 'Z']:
-            df[f'J{j}_3D_rel_{dim}'] = df[f'J{j}_3D_{dim}'] - df[f'J1_3D_{dim}']
-    # calculate angle for rotation and rotate around the Y-axis:
-    rotation_radians = math.atan2(df['J4_3D_rel_Z'] - df['J8_3D_rel_Z'], df['J4_3D_rel_X'] - df['J8_3D_rel_X'])
-    rotation_vector = rotation_radians * np.array([0, 1, 0])  # Y-axis
-    rotation = R.from_rotvec(rotation_vector)
-    for j in range(25):
-        jxout = 'J' + str(j) + '_3D_rel_X'
-        jyout = 'J' + str(j) + '_3D_rel_Y'
-        jzout = 'J' + str(j) + '_3D_rel_Z'
-        df[jxout], df[jyout], df[jzout] = rotation.apply((df[jxout], df[jyout], df[jzout]))
-    return df
+        rel[:, j, :] = rotation.apply(rel[:, j, :])
+    return rel
+
+
+def calc_joint_rel_position(df):
+    # df : skeleton tracking dataframe with 3D joint coordinates
+    # returns df with columns for joints translated to SpineMid as origin and shoulders rotated to same Z value
+    rel = rel_positions(joint_array(df))
+    columns = [f'J{j}_3D_rel_{dim}' for j in range(25) for dim in ['X', 'Y', 'Z']]
+    rel_df = pd.DataFrame(rel.reshape(len(df), 75), columns=columns, index=df.index)
+    return pd.concat([df.drop(columns=columns, errors='ignore'), rel_df], axis=1)
+
+
+class SkeletonFeatures:
+    """
+    Skeleton features of a run computed on whole arrays: joints are smoothed and parsed once into
+    a contiguous (T, 25, 3) array, columns of the requested groups (see skel_feature_spec) are
+    collected and the output dataframe is built once by to_frame
+    """
+
+    def __init__(self, skeldf: pd.DataFrame, window=7, dtype=np.float64):
+        """
+        :param skeldf: skeleton tracking dataframe with 2D/3D joint coordinates and sync_time
+        :param window: rolling mean window (frames) of joint coordinates
+        :param dtype: dtype of joint coordinates and features computed from them. With float32,
+        accelerations (second differences of smoothed coordinates) are off by up to a few percent
+        """
+        self.skeldf = skeldf
+        self.window = window
+        self.sync_time = skeldf['sync_time'].to_numpy(dtype=float)
+        self.columns = dict(sync_time=self.sync_time)
+        self.joints = rolling_mean(joint_array(skeldf), window).astype(dtype)
+
+    def add_groups(self, groups: list, joints=ALL_JOINTS) -> None:
+        """
+        :param groups: groups of SKEL_GROUPS
+        :param joints: joints of dist, speed and accel
+        :return:
+        """
+        motion_groups = [group for group in groups if group in ['dist', 'speed', 'accel']]
+        if motion_groups:
+            self.add_joint_motion(motion_groups, joints)
+        if '2D' in groups:
+            self.add_positions('2D')
+        if '3D' in groups:
+            self.add_positions('3D')
+        if 'interhand' in groups:
+            self.add_interhand()
+        if 'rel' in groups:
+            self.add_rel_position()
+
+    def add_positions(self, kind: str) -> None:
+        """
+        Smoothed input coordinates
+        :param kind: 2D or 3D
+        :return:
+        """
+        if kind == '3D':
+            positions = self.joints
+        else:
+            positions = rolling_mean(self.skeldf[group_columns('2D')].to_numpy(dtype=float),
+                                     self.window).reshape(len(self.skeldf), 25, 2)
+        for j in group_joints(kind):
+            for d, column in enumerate(joint_columns(kind, j)):
+                self.columns[column] = positions[:, j, d]
+
+    def add_joint_motion(self, groups=('dist', 'speed', 'accel'), joints=ALL_JOINTS) -> None:
+        """
+        Distance from spine mid (J1), speed and acceleration of joints
+        some key joints are spine_mid:J1,left hand:J7,right hand: J11, foot left J15, foot right: J19
+        :param groups: some of dist, speed and accel
+        :param joints: integers 0 to 24 corresponding to Kinect skeleton joints
+        :return:
+        """
+        motion = dict()
+        if 'dist' in groups:
+            motion['dist'] = norm(self.joints - self.joints[:, [1], :])
+        if 'speed' in groups or 'accel' in groups:
+            speed = np.full(self.joints.shape[:2], np.nan)
+            speed[1:] = norm(np.diff(self.joints, axis=0)) / np.diff(self.sync_time)[:, np.newaxis]
+            motion['speed'] = speed
+            if 'accel' in groups:
+                motion['accel'] = per_second(speed, self.sync_time)
+        for group in groups:
+            for j in group_joints(group, joints):
+                self.columns[joint_columns(group, j)[0]] = motion[group][:, j]
+
+    def add_interhand(self) -> None:
+        """
+        Distance between hands (J7, J11), its speed (positive when hands move away, negative when
+        they get closer) and acceleration (positive when interhand speed increases)
+        :return:
+        """
+        self.columns['interhand_dist'] = norm(self.joints[:, 11, :] - self.joints[:, 7, :])
+        self.columns['interhand_speed'] = per_second(self.columns['interhand_dist'], self.sync_time)
+        self.columns['interhand_acceleration'] = per_second(self.columns['interhand_speed'],
+                                                            self.sync_time)
+
+    def add_rel_position(self) -> None:
+        """
+        Joints relative to spine mid, shoulders rotated to the same Z value, see rel_positions
+        :return:
+        """
+        rel = rel_positions(self.joints)
+        for j in group_joints('rel'):
+            for d, column in enumerate(joint_columns('rel', j)):
+                self.columns[column] = rel[:, j, d]
+
+    def to_frame(self, fps) -> pd.DataFrame:
+        """
+        :param fps: frame rate of the video the skeleton is synced to
+        :return: collected columns and the frame of each row, one row per frame (the first one)
+        """
+        frame = np.round(self.sync_time * fps).astype(int)
+        _, first_rows = np.unique(frame, return_index=True)
+        keep = np.sort(first_rows)
+        skeldf = pd.DataFrame({name: values[keep] for name, values in self.columns.items()})
+        skeldf['frame'] = frame[keep]
+        return skeldf
+
+
+def load_skel_features(skel_csvs: list, groups: list, joints=ALL_JOINTS) -> tuple:
+    """
+    Columns of groups already computed in an existing skeleton feature csv
+    :param skel_csvs: candidate csvs, the first existing one is used
+    :param groups: groups of SKEL_GROUPS
+    :param joints: joints of dist, speed and accel
+    :return: dataframe of INDEX_COLUMNS and the present groups' columns (None if no csv exists),
+    present groups
+    """
+    for skel_csv in skel_csvs:
+        if skel_csv and os.path.exists(skel_csv):
+            columns = set(pd.read_csv(skel_csv, nrows=0).columns)
+            present = [group for group in groups
+                       if set(group_columns(group, joints)).issubset(columns)]
+            skeldf = pd.read_csv(skel_csv, usecols=INDEX_COLUMNS + spec_columns(present, joints),
+                                 float_precision='round_trip')
+            return skeldf, present
+    return None, []
 
 
 import ray
@@ -116,22 +221,33 @@ def gen_skel_feature(args, run, tag):
         # Load skeleton dataframe
         skel_csv_out = os.path.join(args.skel_csv_out,
                                     f'{run}_{tag}_skel_features.csv')
-        skeldf = pd.read_csv(skel_csv_in)
-        sync_time = skeldf['sync_time'].copy()
-        skeldf = skeldf.rolling(7).mean()
-        skeldf['sync_time'] = sync_time
         if args.joints == "all":
             joints = list(range(25))
-        for j in joints:
-            skeldf = calc_joint_dist(skeldf, j)
-            skeldf = calc_joint_speed(skeldf, j)
-            skeldf = calc_joint_acceleration(skeldf, j)
-        skeldf = calc_interhand_dist(skeldf)
-        skeldf = calc_interhand_speed(skeldf)
-        skeldf = calc_interhand_acceleration(skeldf)
-        skeldf = skeldf.apply(calc_joint_rel_position, axis=1)
-        skeldf['frame'] = (skeldf['sync_time'] * fps).apply(round).astype(int)
-        skeldf = skeldf[~skeldf['frame'].duplicated(keep='first')]
+        else:
+            joints = [int(j) for j in args.joints.split(',')]
+        # only columns of the groups consumers declared, groups already in the csv of this tag
+        # (or of base_feature_tag) are reused
+        groups = parse_groups(getattr(args, 'skel_groups', 'model'))
+        base_tag = getattr(args, 'base_feature_tag', '')
+        skel_csv_base = os.path.join(args.skel_csv_out, f'{run}_{base_tag}_skel_features.csv') \
+            if base_tag else ''
+        previous, present = load_skel_features([skel_csv_out, skel_csv_base], groups, joints)
+        missing = [group for group in groups if group not in present]
+        logger.info(f'{run}: reusing skeleton features {present}, computing {missing}')
+        if not missing:
+            skeldf = previous
+        else:
+            features = SkeletonFeatures(pd.read_csv(skel_csv_in), window=7)
+            features.add_groups(missing, joints)
+            skeldf = features.to_frame(fps)
+        if missing and len(present):
+            if np.array_equal(previous['frame'].to_numpy(), skeldf['frame'].to_numpy()):
+                skeldf = pd.concat([skeldf, previous.drop(columns=INDEX_COLUMNS)], axis=1)
+            else:
+                logger.warning(f'{run}: frames of existing skeleton features differ, recomputing')
+                features.add_groups(present, joints)
+                skeldf = features.to_frame(fps)
+        skeldf = skeldf[INDEX_COLUMNS + spec_columns(groups, joints)]
         skeldf.to_csv(skel_csv_out, index=False)
 
         logger.info(f'Done Skel {run}')
@@ -178,4 +294,4 @@ if __name__ == '__main__':
 
     pool_features(complete_skel_path=f'output/skel_complete_{args.feature_tag}.txt',
                   output_stats_path=f'{args.skel_stats_out}sampled_skel_features_{args.feature_tag}.csv',
-                  tag=args.feature_tag)
+                  tag=args.feature_tag, skel_dir=args.skel_csv_out)
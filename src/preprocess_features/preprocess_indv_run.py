@@ -6,7 +6,8 @@ import pickle as pkl
 import re
 import traceback
 from copy import deepcopy
-from src.utils import parse_config, logger, contain_substr
+from src.utils import parse_config, logger
+from src.individual_features.skel_feature_spec import consumer_groups, spec_columns
 
 
 def preprocess_appear(appear_csv):
@@ -30,19 +31,9 @@ def preprocess_optical(vid_csv, standardize=True):
 
 def preprocess_skel(skel_csv, use_position=0, standardize=True, feature_tag='',
                     ratio_features=0.8, ratio_samples=0.8, stats_skel_csv='') -> (pd.DataFrame, bool):
-    skel_df = pd.read_csv(skel_csv, index_col='frame')
-    skel_df.drop(['sync_time', 'raw_time', 'body', 'J1_dist_from_J1', 'J1_3D_rel_X', 'J1_3D_rel_Y', 'J1_3D_rel_Z'], axis=1,
-                 inplace=True)
-    if use_position:
-        keeps = ['accel', 'speed', 'dist', 'interhand', '2D', 'rel']
-    else:
-        keeps = ['accel', 'speed', 'dist', 'interhand', 'rel']
-
-    for c in skel_df.columns:
-        if contain_substr(c, keeps):
-            continue
-        else:
-            skel_df.drop([c], axis=1, inplace=True)
+    # only columns of the skeleton feature groups used as inputs (see skel_feature_spec)
+    columns = spec_columns(consumer_groups(use_position))
+    skel_df = pd.read_csv(skel_csv, index_col='frame', usecols=['frame'] + columns)[columns]
 
     # Using global statistics to filter skeleton-defective runs
     defective = 0
@@ -0,0 +1,73 @@
+"""
+Compare adaptive tracking (adaptive_tracking=1) with the full per-frame run on the same videos:
+wall time, number of tracker predictions, and IoU drift of adaptive boxes against full-run boxes
+(matched by frame and track name). Both runs use the other settings of the config.
+Results are written to {output_csv_dir}/adaptive_benchmark/adaptive_report.csv
+
+python src/tracking/benchmark_adaptive_tracking.py -c configs/config_tracking_to_correct_label.ini \
+    --run 6.2.5_kinect,1.1.3_kinect
+"""
+import os
+import sys
+from copy import copy
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.getcwd())
+from src.tracking.tracking_to_correct_label import track_video, bbox_iou_array
+from src.utils import parse_config, logger
+
+
+def box_drift(full_df: pd.DataFrame, adaptive_df: pd.DataFrame) -> dict:
+    """
+    IoU between boxes of the full run and the adaptive run, on (frame, name) present in both
+    :param full_df: _r50.csv of the full run
+    :param adaptive_df: _r50.csv of the adaptive run
+    :return:
+    """
+    merged = full_df.merge(adaptive_df, on=['frame', 'name'], suffixes=('_full', '_adaptive'))
+    if not len(merged):
+        return dict(matched_boxes=0, mean_iou=np.nan, p5_iou=np.nan, below_05=np.nan)
+    boxes = dict()
+    for suffix in ['_full', '_adaptive']:
+        x, y = merged['x' + suffix].to_numpy(), merged['y' + suffix].to_numpy()
+        boxes[suffix] = np.stack([x, y, x + merged['w' + suffix].to_numpy(),
+                                  y + merged['h' + suffix].to_numpy()], axis=-1)
+    iou = bbox_iou_array(boxes['_full'], boxes['_adaptive'])
+    return dict(matched_boxes=len(merged), mean_iou=iou.mean(), p5_iou=np.percentile(iou, 5),
+                below_05=(iou < 0.5).mean())
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    report_dir = os.path.join(args.output_csv_dir, 'adaptive_benchmark')
+    rows = []
+    for run in args.run.split(','):
+        results = dict()
+        for adaptive in ['0', '1']:
+            run_args = copy(args)
+            run_args.run = run
+            run_args.adaptive_tracking = adaptive
+            run_args.output_csv_dir = run_args.output_video_dir = os.path.join(
+                report_dir, f'adaptive_{adaptive}')
+            logger.info(f'Tracking {run} with adaptive_tracking={adaptive}')
+            start = perf_counter()
+            stats = track_video(run_args)
+            results[adaptive] = dict(
+                time=perf_counter() - start, n_tracker_calls=stats['n_tracker_calls'],
+                df=pd.read_csv(os.path.join(run_args.output_csv_dir, f'{run}_r50.csv')))
+        full, adaptive = results['0'], results['1']
+        rows.append(dict(run=run,
+                         full_time=full['time'], adaptive_time=adaptive['time'],
+                         speedup=full['time'] / adaptive['time'],
+                         full_tracker_calls=full['n_tracker_calls'],
+                         adaptive_tracker_calls=adaptive['n_tracker_calls'],
+                         full_boxes=len(full['df']), adaptive_boxes=len(adaptive['df']),
+                         **box_drift(full['df'], adaptive['df'])))
+        logger.info(f'{rows[-1]}')
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(report_dir, 'adaptive_report.csv'), index=False)
+    print(report.to_string(index=False))
@@ -0,0 +1,92 @@
+"""
+Benchmark tracking throughput (frames/sec) against the number of simultaneous tracks,
+running each track's forward pass separately vs one batched forward pass per frame.
+
+python src/tracking/benchmark_batched_tracking.py --model_config configs/r50_l234_dwxcorr.yaml \
+    --model_path resources/r50_l234_dwxcorr.pth --video data/small_videos/6.2.5_kinect_trim.mp4
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+from src.tracking.tracking_to_correct_label import Context
+from src.utils import BoxWrapper, FrameWrapper, CV2VideoReader, ColorRef, logger
+
+
+def load_frames(video_path: str, n_frames: int, height=540, width=960) -> list:
+    if video_path:
+        cv2_video_reader = CV2VideoReader(video_path)
+        frames = []
+        while len(frames) < n_frames:
+            ret, frame = cv2_video_reader.read_frame()
+            if not ret:
+                break
+            frames.append(frame)
+        return frames
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 255, size=(height, width, 3), dtype=np.uint8) for _ in range(n_frames)]
+
+
+def init_context(track_kwargs: dict, frame: np.ndarray, n_tracks: int, seed=0) -> Context:
+    rng = np.random.RandomState(seed)
+    context = Context(track_kwargs=track_kwargs, color_reference=ColorRef(ColorRef.forward_set))
+    frame_wrapper = FrameWrapper(frame=frame.copy(), frame_id=0)
+    context.frame_results[0] = dict()
+    boxes = []
+    for _ in range(n_tracks):
+        w, h = rng.randint(20, 120, size=2)
+        x, y = rng.randint(0, frame.shape[1] - w), rng.randint(0, frame.shape[0] - h)
+        boxes.append([x, y, x + w, y + h])
+    context.matching(np.array(boxes, dtype=float), 'object', frame_wrapper)
+    return context
+
+
+def run_tracking(context: Context, frames: list, batched: bool) -> float:
+    start = perf_counter()
+    for frame_id, frame in enumerate(frames[1:], start=1):
+        frame_wrapper = FrameWrapper(frame=frame.copy(), frame_id=frame_id)
+        context.frame_results[frame_id] = dict()
+        if batched:
+            context.tracking_batched(frame_wrapper)
+        else:
+            context.tracking('object', frame_wrapper)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_config', default='configs/r50_l234_dwxcorr.yaml')
+    parser.add_argument('--model_path', default='resources/r50_l234_dwxcorr.pth')
+    parser.add_argument('--video', default='', help='video to read frames from, random frames if empty')
+    parser.add_argument('--n_frames', type=int, default=51)
+    parser.add_argument('--n_tracks', default='1,2,4,8,16,32')
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.n_frames)
+    track_kwargs = dict(model_config=args.model_config, model_path=args.model_path,
+                        tracker_type='siam')
+    # load the shared network before timing
+    init_context(track_kwargs, frames[0], 1)
+    results = []
+    for n_tracks in map(int, args.n_tracks.split(',')):
+        # never deactivate tracks, every frame should run all n_tracks trackers
+        sequential_context = init_context(track_kwargs, frames[0], n_tracks)
+        batched_context = init_context(track_kwargs, frames[0], n_tracks)
+        for context in [sequential_context, batched_context]:
+            for track_wrapper in context.tracks['object'].values():
+                track_wrapper.no_hit_threshold = np.inf
+        sequential_time = run_tracking(sequential_context, frames, batched=False)
+        batched_time = run_tracking(batched_context, frames, batched=True)
+        results.append((n_tracks, (len(frames) - 1) / sequential_time,
+                        (len(frames) - 1) / batched_time))
+        logger.info(f'{n_tracks} tracks: sequential {results[-1][1]:.2f} fps, '
+                    f'batched {results[-1][2]:.2f} fps')
+
+    print(f'{"n_tracks":>8} {"sequential_fps":>15} {"batched_fps":>12} {"speedup":>8}')
+    for n_tracks, sequential_fps, batched_fps in results:
+        print(f'{n_tracks:>8} {sequential_fps:>15.2f} {batched_fps:>12.2f} '
+              f'{batched_fps / sequential_fps:>8.2f}')
@@ -0,0 +1,137 @@
+"""
+Accuracy guard for reduced-precision / traced inference (inference_precision, inference_trace):
+on every labeled interval of the runs, trackers initialized from the labels are run forward with
+the fp32 network and with the configured backend on the same frames (tracks never deactivate).
+Reports IoU between fp32 and backend boxes, how well each path's last box of an interval overlaps
+a label box of its category on the next labeled frame, and tracking time of each path.
+Results are written to {output_csv_dir}/inference_benchmark/inference_report.csv
+
+python src/tracking/benchmark_inference_backend.py -c configs/config_tracking_to_correct_label.ini \
+    --run 6.2.5_kinect,1.1.3_kinect
+"""
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.getcwd())
+from src.tracking.tracking_to_correct_label import Context, bbox_iou_array
+from src.utils import FrameWrapper, CV2VideoReader, ColorRef, parse_config, logger
+
+
+def init_context(track_kwargs: dict, frame_wrapper: FrameWrapper, df_current: pd.DataFrame) -> Context:
+    """
+    One track per label box, tracks never deactivate so that both paths track the same objects
+    :param track_kwargs:
+    :param frame_wrapper: labeled frame
+    :param df_current: labels of this frame
+    :return:
+    """
+    context = Context(track_kwargs=track_kwargs, color_reference=ColorRef(ColorRef.forward_set))
+    context.frame_results[frame_wrapper.frame_id] = dict()
+    for object_type in sorted(df_current['class'].unique()):
+        boxes = df_current[df_current['class'] == object_type][
+            ['xmin', 'ymin', 'xmax', 'ymax']].to_numpy()
+        context.matching(boxes, object_type, frame_wrapper)
+        for track_wrapper in context.tracks[object_type].values():
+            track_wrapper.no_hit_threshold = np.inf
+    return context
+
+
+def label_overlap(context: Context, df_current: pd.DataFrame) -> list:
+    """
+    :param context: after tracking an interval
+    :param df_current: labels of the closing labeled frame
+    :return: for each track, IoU of its last box with the closest label box of its category
+    """
+    overlaps = []
+    for object_type, category_track in context.tracks.items():
+        boxes = df_current[df_current['class'] == object_type][
+            ['xmin', 'ymin', 'xmax', 'ymax']].to_numpy()
+        for track_wrapper in category_track.values():
+            if len(boxes):
+                overlaps.append(bbox_iou_array(boxes, track_wrapper.boxes.xyxy[-1]).max())
+            else:
+                overlaps.append(0.0)
+    return overlaps
+
+
+def compare_backends(args, run: str) -> dict:
+    """
+    :param args: tracking config, inference_precision and inference_trace select the backend
+    :param run:
+    :return: report row of this run
+    """
+    cv2_video_reader = CV2VideoReader(os.path.join(args.input_video_dir, run + f'_trim.mp4'),
+                                      prefetch=int(args.prefetch_frames))
+    label_df = pd.read_csv(os.path.join(args.input_label_dir, run + f'_labels.csv'))
+    labeled_seconds = np.array(sorted(label_df['index'].unique()))
+    labeled_frames = list(map(round, labeled_seconds * cv2_video_reader.fps))
+    base_kwargs = dict(model_config=args.model_config, model_path=args.model_path,
+                       tracker_type='siam')
+    track_kwargs = dict(fp32=dict(base_kwargs, precision='fp32', trace=False),
+                        backend=dict(base_kwargs, precision=args.inference_precision,
+                                     trace=bool(int(args.inference_trace))))
+    contexts = dict()
+    times = dict(fp32=0.0, backend=0.0)
+    overlaps = dict(fp32=[], backend=[])
+    ious = []
+    n_frames = 0
+    frame_id = 0 - 1
+    while frame_id < labeled_frames[-1]:
+        frame_id += 1
+        ret, frame = cv2_video_reader.read_frame()
+        if not ret:
+            break
+        frame_wrapper = FrameWrapper(frame=frame, frame_id=frame_id)
+        if frame_id in labeled_frames:
+            df_current = label_df[label_df['index'] == round(frame_id / cv2_video_reader.fps)]
+            for name, context in contexts.items():
+                overlaps[name].extend(label_overlap(context, df_current))
+            contexts = {name: init_context(kwargs, frame_wrapper, df_current)
+                        for name, kwargs in track_kwargs.items()}
+            continue
+        if not contexts:
+            continue
+        for name, context in contexts.items():
+            context.frame_results[frame_id] = dict()
+            start = perf_counter()
+            context.tracking_batched(frame_wrapper)
+            times[name] += perf_counter() - start
+        for object_type, category_track in contexts['fp32'].tracks.items():
+            for object_id, track_wrapper in category_track.items():
+                ious.append(bbox_iou_array(
+                    track_wrapper.boxes.xyxy[-1],
+                    contexts['backend'].tracks[object_type][object_id].boxes.xyxy[-1]))
+        n_frames += 1
+    cv2_video_reader.release()
+    ious = np.array(ious)
+    return dict(run=run, precision=args.inference_precision, trace=args.inference_trace,
+                tracked_frames=n_frames, tracked_boxes=len(ious),
+                fp32_fps=n_frames / times['fp32'], backend_fps=n_frames / times['backend'],
+                speedup=times['fp32'] / times['backend'],
+                mean_iou=ious.mean(), p5_iou=np.percentile(ious, 5), below_05=(ious < 0.5).mean(),
+                fp32_label_iou=np.mean(overlaps['fp32']),
+                backend_label_iou=np.mean(overlaps['backend']))
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    if args.inference_precision == 'fp32' and not int(args.inference_trace):
+        logger.error('Set inference_precision or inference_trace to the backend to compare with fp32')
+        sys.exit(1)
+    report_dir = os.path.join(args.output_csv_dir, 'inference_benchmark')
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    rows = []
+    for run in args.run.split(','):
+        logger.info(f'Comparing fp32 with {args.inference_precision} '
+                    f'(trace={args.inference_trace}) on {run}')
+        rows.append(compare_backends(args, run))
+        logger.info(f'{rows[-1]}')
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(report_dir, 'inference_report.csv'), index=False)
+    print(report.to_string(index=False))
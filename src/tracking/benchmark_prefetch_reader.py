@@ -0,0 +1,93 @@
+"""
+Measure end-to-end fps of tracking and of optical flow extraction with synchronous decoding
+(prefetch_frames=0) and with CV2VideoReader decoding ahead in a background thread.
+Tracking runs headless with the other settings of the config. Optical flow repeats the per-frame
+work of src/individual_features/optical_features.py (grayscale, Farneback, pixel correlation)
+with the parameters of optical_config, without stabilization; with prefetching, frames are
+converted to grayscale in the decoding thread.
+Results are written to {output_csv_dir}/prefetch_benchmark/prefetch_report.csv
+
+python src/tracking/benchmark_prefetch_reader.py -c configs/config_tracking_to_correct_label.ini \
+    --run 6.2.5_kinect,1.1.3_kinect
+"""
+import configparser
+import os
+import sys
+from copy import copy
+from time import perf_counter
+
+import cv2
+import pandas as pd
+from scipy.stats import pearsonr
+
+sys.path.append(os.getcwd())
+from src.tracking.tracking_to_correct_label import track_video
+from src.utils import CV2VideoReader, parse_config, logger
+
+
+def optical_flow_fps(video_path: str, prefetch: int, optical_args: dict) -> float:
+    """
+    :param video_path:
+    :param prefetch: see CV2VideoReader
+    :param optical_args: Farneback parameters and skip_frame, as in config_optical_features.ini
+    :return: frames per second
+    """
+    cv2_video_reader = CV2VideoReader(video_path, prefetch=prefetch, grayscale=bool(prefetch))
+    start = perf_counter()
+    frame_id = 0
+    prev_gray = None
+    while True:
+        ret, frame = cv2_video_reader.read_frame()
+        if not ret:
+            break
+        frame_id += 1
+        if frame_id % int(optical_args['skip_frame']):
+            continue
+        gray = frame if prefetch else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if prev_gray is None:
+            prev_gray = gray.copy()
+        flow = cv2.calcOpticalFlowFarneback(prev_gray, gray, None, float(optical_args['pyr_scale']),
+                                            int(optical_args['levels']),
+                                            int(optical_args['winsize']),
+                                            int(optical_args['iterations']),
+                                            int(optical_args['poly_n']),
+                                            float(optical_args['poly_sigma']),
+                                            int(optical_args['flags']))
+        magnitude, angle = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+        cor, p = pearsonr(gray.flatten(), prev_gray.flatten())
+        # prefetched frames are reused by the reader
+        prev_gray = gray.copy()
+    elapsed = perf_counter() - start
+    cv2_video_reader.release()
+    return frame_id / elapsed
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    report_dir = os.path.join(args.output_csv_dir, 'prefetch_benchmark')
+    config_parser = configparser.ConfigParser()
+    config_parser.read(getattr(args, 'optical_config', 'configs/config_optical_features.ini'))
+    optical_args = dict(config_parser.items(config_parser.sections()[0]))
+    prefetch = int(args.prefetch_frames) or 16
+    rows = []
+    for run in args.run.split(','):
+        for prefetch_frames in [0, prefetch]:
+            run_args = copy(args)
+            run_args.run = run
+            run_args.prefetch_frames = str(prefetch_frames)
+            run_args.render_video = run_args.resume = '0'
+            run_args.output_csv_dir = run_args.output_video_dir = os.path.join(
+                report_dir, f'prefetch_{prefetch_frames}')
+            logger.info(f'Tracking {run} with prefetch_frames={prefetch_frames}')
+            start = perf_counter()
+            stats = track_video(run_args)
+            tracking_fps = stats['n_frames'] / (perf_counter() - start)
+            video_path = os.path.join(args.input_video_dir, run + f'_trim.mp4')
+            rows.append(dict(run=run, prefetch_frames=prefetch_frames, tracking_fps=tracking_fps,
+                             optical_flow_fps=optical_flow_fps(video_path, prefetch_frames,
+                                                               optical_args)))
+            logger.info(f'{rows[-1]}')
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(report_dir, 'prefetch_report.csv'), index=False)
+    print(report.to_string(index=False))
@@ -0,0 +1,128 @@
+"""
+Track a long synthetic video (memory_minutes, 30 by default) headless and sample the process's
+resident memory while tracking, to check that memory stays flat over long runs.
+The video has textured boxes moving over a textured background, labeled every 10 seconds.
+Tracking runs in this process (concurrent_passes=0, segment_workers=0) with the other settings of
+the config. Samples are written to {output_csv_dir}/memory_benchmark/memory_report.csv
+
+python src/tracking/benchmark_tracking_memory.py -c configs/config_tracking_to_correct_label.ini
+"""
+import os
+import sys
+import threading
+from copy import copy
+from time import perf_counter
+
+import cv2
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.getcwd())
+from src.tracking.tracking_to_correct_label import track_video
+from src.utils import parse_config, logger
+
+
+def current_rss_mb() -> float:
+    """
+    :return: resident memory of this process in MB (Linux)
+    """
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def make_synthetic_video(output_dir: str, run: str, minutes: float, fps=25, width=640, height=360,
+                         n_objects=6, label_seconds=10, seed=0) -> None:
+    """
+    Write {run}_trim.mp4 to output_dir/videos and {run}_labels.csv to output_dir/labels
+    :param output_dir:
+    :param run:
+    :param minutes:
+    :param fps:
+    :param width:
+    :param height:
+    :param n_objects: objects move at constant speed and bounce on borders
+    :param label_seconds: seconds between labeled frames
+    :param seed:
+    :return:
+    """
+    for sub_dir in ['videos', 'labels']:
+        os.makedirs(os.path.join(output_dir, sub_dir), exist_ok=True)
+    rng = np.random.RandomState(seed)
+    background = cv2.GaussianBlur(rng.randint(0, 255, (height, width, 3)).astype(np.uint8),
+                                  (21, 21), 0)
+    sizes = rng.randint(20, 60, size=(n_objects, 2))
+    textures = [rng.randint(0, 255, (h, w, 3)).astype(np.uint8) for w, h in sizes]
+    positions = rng.uniform(0, 1, size=(n_objects, 2)) * ([width, height] - sizes)
+    velocities = rng.uniform(-2, 2, size=(n_objects, 2))
+    names = [f'object{i % 3}' for i in range(n_objects)]
+    writer = cv2.VideoWriter(os.path.join(output_dir, 'videos', f'{run}_trim.mp4'),
+                             cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    rows = []
+    for frame_id in range(int(minutes * 60 * fps)):
+        frame = background.copy()
+        for i, ((x, y), (w, h)) in enumerate(zip(positions.astype(int), sizes)):
+            frame[y:y + h, x:x + w] = textures[i]
+            if frame_id % (label_seconds * fps) == 0:
+                rows.append(dict(index=frame_id // fps, xmin=x, ymin=y, xmax=x + w, ymax=y + h,
+                                 width=width, height=height, **{'class': names[i]}))
+        writer.write(frame)
+        positions += velocities
+        bounce = (positions < 0) | (positions > [width, height] - sizes)
+        velocities[bounce] *= -1
+        positions = np.clip(positions, 0, [width, height] - sizes)
+    writer.release()
+    pd.DataFrame(rows).to_csv(os.path.join(output_dir, 'labels', f'{run}_labels.csv'), index=False)
+
+
+class RssSampler(threading.Thread):
+    """
+    Sample current_rss_mb every interval seconds until stopped
+    """
+
+    def __init__(self, interval=1.0):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        start = perf_counter()
+        while not self.stopped.is_set():
+            self.samples.append(dict(time=perf_counter() - start, rss_mb=current_rss_mb()))
+            self.stopped.wait(self.interval)
+
+    def stop(self) -> pd.DataFrame:
+        self.stopped.set()
+        self.join()
+        return pd.DataFrame(self.samples)
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    minutes = float(getattr(args, 'memory_minutes', 30))
+    report_dir = os.path.join(args.output_csv_dir, 'memory_benchmark')
+    run = 'synthetic_kinect'
+    logger.info(f'Writing a {minutes} minutes synthetic video to {report_dir}')
+    make_synthetic_video(report_dir, run, minutes)
+
+    run_args = copy(args)
+    run_args.run = run
+    run_args.input_video_dir = os.path.join(report_dir, 'videos')
+    run_args.input_label_dir = os.path.join(report_dir, 'labels')
+    run_args.output_csv_dir = run_args.output_video_dir = report_dir
+    run_args.render_video = run_args.resume = '0'
+    run_args.concurrent_passes = run_args.segment_workers = '0'
+    sampler = RssSampler()
+    sampler.start()
+    stats = track_video(run_args)
+    samples = sampler.stop()
+    samples.to_csv(os.path.join(report_dir, 'memory_report.csv'), index=False)
+
+    # after the first quarter (models loaded, buffers allocated), memory should not grow
+    progress = [samples['rss_mb'].iloc[int(q * (len(samples) - 1))] for q in [0.25, 0.5, 0.75, 1]]
+    print(f'Tracked {stats["n_frames"]} frames in {samples["time"].iloc[-1]:.0f}s')
+    print('RSS (MB) at 25/50/75/100% of tracking time: ' +
+          ' / '.join(f'{rss:.0f}' for rss in progress))
+    print(f'Peak RSS {samples["rss_mb"].max():.0f} MB, '
+          f'growth after the first quarter {progress[-1] - progress[0]:+.0f} MB')
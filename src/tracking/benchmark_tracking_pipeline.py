@@ -0,0 +1,66 @@
+"""
+Tracking throughput without the real videos or a pysot checkpoint: synthetic videos (textured
+boxes moving over a textured background, labeled every 10 seconds, see make_synthetic_video) are
+tracked by track_video with a tiny randomly initialized SiamRPN (benchmark_model_config,
+configs/alex_dwxcorr.yaml by default; set benchmark_model_path to use a checkpoint).
+One video of benchmark_minutes (1 by default) per number of objects in benchmark_objects
+(3,6,12 by default), tracked with the other settings of the config. Reports the time of each stage:
+decode, tracking (tracker calls), matching (label boxes), merging, csv, render, checkpoint,
+and workers (waiting for backward/segment workers, if concurrent_passes or segment_workers).
+Results are written to {output_csv_dir}/pipeline_benchmark/pipeline_report.csv
+
+python src/tracking/benchmark_tracking_pipeline.py -c configs/config_tracking_to_correct_label.ini
+"""
+import os
+import sys
+from copy import copy
+from time import perf_counter
+
+import pandas as pd
+
+sys.path.append(os.getcwd())
+from src.tracking.tracking_to_correct_label import track_video
+from src.tracking.benchmark_tracking_memory import make_synthetic_video
+from src.utils import parse_config, logger
+
+STAGES = ['decode', 'tracking', 'matching', 'merging', 'csv', 'render', 'checkpoint', 'workers']
+
+if __name__ == '__main__':
+    args = parse_config()
+    minutes = float(getattr(args, 'benchmark_minutes', 1))
+    object_counts = [int(n) for n in str(getattr(args, 'benchmark_objects', '3,6,12')).split(',')]
+    report_dir = os.path.join(args.output_csv_dir, 'pipeline_benchmark')
+    rows = []
+    for n_objects in object_counts:
+        run = f'synthetic{n_objects}_kinect'
+        logger.info(f'Writing a {minutes} minutes synthetic video with {n_objects} objects')
+        make_synthetic_video(report_dir, run, minutes, n_objects=n_objects, seed=n_objects)
+
+        run_args = copy(args)
+        run_args.run = run
+        run_args.input_video_dir = os.path.join(report_dir, 'videos')
+        run_args.input_label_dir = os.path.join(report_dir, 'labels')
+        run_args.output_csv_dir = run_args.output_video_dir = report_dir
+        run_args.model_config = getattr(args, 'benchmark_model_config', 'configs/alex_dwxcorr.yaml')
+        run_args.model_path = getattr(args, 'benchmark_model_path', '')
+        run_args.resume = '0'
+        start = perf_counter()
+        stats = track_video(run_args)
+        seconds = perf_counter() - start
+        stage_seconds = stats['stage_seconds']
+        row = dict(run=run, objects=n_objects, frames=stats['n_frames'],
+                   tracker_calls=stats['n_tracker_calls'], seconds=seconds,
+                   fps=stats['n_frames'] / seconds)
+        for stage in STAGES:
+            row[f'{stage}_ms_per_frame'] = 1000 * stage_seconds.get(stage, 0.0) / stats['n_frames']
+        # model loading, bookkeeping between stages
+        row['other_ms_per_frame'] = 1000 * (seconds - sum(stage_seconds.values())) / stats['n_frames']
+        row['ms_per_tracker_call'] = 1000 * stage_seconds.get('tracking', 0.0) / max(
+            stats['n_tracker_calls'], 1)
+        rows.append(row)
+        logger.info(f'{row}')
+
+    report = pd.DataFrame(rows)
+    report.to_csv(os.path.join(report_dir, 'pipeline_report.csv'), index=False)
+    with pd.option_context('display.float_format', '{:.2f}'.format, 'display.width', 200):
+        print(report.set_index('run').T.to_string())
@@ -0,0 +1,191 @@
+import zlib
+from multiprocessing import shared_memory
+
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+
+from src.utils import logger
+
+
+class FrameRingBuffer:
+    """
+    This class stores decoded frames of a labeled interval in one preallocated uint8 array.
+    Frames are indexed by frame_id and handed out as read-only views, so tracking passes
+    share frames instead of copying them. Slots are reused after clear(); if an interval
+    is longer than the capacity, the array grows.
+    With shared=True the array lives in shared memory, and pickling the buffer (e.g. to send it
+    to a worker process) only sends the segment's name and the frame index.
+    """
+
+    def __init__(self, height: int, width: int, capacity: int = 512, channels: int = 3,
+                 shared: bool = False):
+        """
+        :param height: frame height
+        :param width: frame width
+        :param capacity: number of frames to preallocate, should cover a labeled interval
+        :param channels:
+        :param shared: allocate frames in a shared memory segment
+        """
+        self.shared = shared
+        self.owner = True
+        self.shm = None
+        # segments replaced by _grow, kept until release() because views may still point to them
+        self._retired_shms = []
+        self.frames = self._allocate((capacity, height, width, channels))
+        self._read_only = self._make_read_only(self.frames)
+        # frame_id -> slot, insertion order is decoding order
+        self.index = dict()
+        self.start = 0
+
+    def _allocate(self, shape: Tuple) -> np.ndarray:
+        if not self.shared:
+            return np.empty(shape, dtype=np.uint8)
+        if self.shm is not None:
+            self._retired_shms.append(self.shm)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    def __getstate__(self) -> Dict:
+        if not self.shared:
+            return self.__dict__.copy()
+        return dict(shm_name=self.shm.name, shape=self.frames.shape,
+                    index=self.index, start=self.start)
+
+    def __setstate__(self, state: Dict) -> None:
+        if 'shm_name' not in state:
+            self.__dict__.update(state)
+            return
+        self.shared = True
+        # the unpickled buffer only reads frames written by the owner
+        self.owner = False
+        self._retired_shms = []
+        self.shm = _attach_shared_memory(state['shm_name'])
+        self.frames = np.ndarray(state['shape'], dtype=np.uint8, buffer=self.shm.buf)
+        self._read_only = self._make_read_only(self.frames)
+        self.index = state['index']
+        self.start = state['start']
+
+    @staticmethod
+    def _make_read_only(frames: np.ndarray) -> np.ndarray:
+        read_only = frames.view()
+        read_only.flags.writeable = False
+        return read_only
+
+    @property
+    def capacity(self) -> int:
+        return self.frames.shape[0]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, frame_id: int) -> bool:
+        return frame_id in self.index
+
+    def __getitem__(self, frame_id: int) -> np.ndarray:
+        """
+        :param frame_id:
+        :return: a read-only view of the frame
+        """
+        return self._read_only[self.index[frame_id]]
+
+    def keys(self) -> List[int]:
+        return list(self.index.keys())
+
+    def items(self, reverse=False) -> Iterator[Tuple[int, np.ndarray]]:
+        frame_ids = reversed(self.keys()) if reverse else self.keys()
+        for frame_id in frame_ids:
+            yield frame_id, self[frame_id]
+
+    def _grow(self) -> None:
+        """
+        Double the capacity, keeping stored frames in order. Views handed out before growing
+        still point to the old array and stay valid.
+        :return:
+        """
+        logger.info(f'Growing frame buffer from {self.capacity} to {2 * self.capacity} frames')
+        frames = self._allocate((2 * self.capacity,) + self.frames.shape[1:])
+        for new_slot, (frame_id, slot) in enumerate(self.index.items()):
+            frames[new_slot] = self.frames[slot]
+            self.index[frame_id] = new_slot
+        self.frames = frames
+        self._read_only = self._make_read_only(self.frames)
+        self.start = 0
+
+    def next_slot(self) -> np.ndarray:
+        """
+        Writable slot for the next frame, e.g. to decode into with cv2.VideoCapture.read(slot).
+        The slot is only committed by append().
+        :return:
+        """
+        if len(self) == self.capacity:
+            self._grow()
+        return self.frames[(self.start + len(self)) % self.capacity]
+
+    def append(self, frame_id: int, frame: np.ndarray) -> None:
+        """
+        Commit the next slot as frame_id, copying frame into it unless it was decoded in place
+        :param frame_id:
+        :param frame:
+        :return:
+        """
+        slot_frame = self.next_slot()
+        if not np.shares_memory(slot_frame, frame):
+            slot_frame[...] = frame
+        self.index[frame_id] = (self.start + len(self)) % self.capacity
+
+    def checksum(self, frame_id: int) -> int:
+        """
+        :param frame_id:
+        :return: crc32 of the frame's pixels, to check that two decoders produced the same frame
+        """
+        return zlib.crc32(self.frames[self.index[frame_id]])
+
+    def popleft(self) -> None:
+        """
+        Forget the oldest frame
+        :return:
+        """
+        del self.index[next(iter(self.index))]
+        self.start = (self.start + 1) % self.capacity
+
+    def clear(self) -> None:
+        """
+        Forget stored frames, the next interval is written after the last stored frame
+        :return:
+        """
+        self.start = (self.start + len(self)) % self.capacity
+        self.index = dict()
+
+    def release(self) -> None:
+        """
+        Free shared memory segments, the buffer can't be used afterwards
+        :return:
+        """
+        if not self.shared or not self.owner:
+            return
+        self.index = dict()
+        self.frames = self._read_only = None
+        for shm in self._retired_shms + [self.shm]:
+            try:
+                shm.close()
+            except BufferError:
+                # a view is still alive, the mapping goes away with the process
+                logger.debug(f'Frames in {shm.name} are still referenced')
+            shm.unlink()
+        self._retired_shms = []
+        self.shm = None
+
+
+# shared memory segments attached by this (worker) process, by name
+_attached_shms = dict()
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to a segment created by another process, once per process
+    :param name:
+    :return:
+    """
+    if name not in _attached_shms:
+        _attached_shms[name] = shared_memory.SharedMemory(name=name)
+    return _attached_shms[name]
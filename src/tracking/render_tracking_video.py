@@ -0,0 +1,124 @@
+"""
+Render the merged tracking video of runs from their {run}_r50.csv and source video, after tracking
+(e.g. tracking ran with render_video=0). Boxes on labeled frames are drawn with the init color,
+other boxes with the track color; box intensity reflects confidence as in the tracking video.
+Runs are rendered in parallel, one process per run.
+
+python src/tracking/render_tracking_video.py -c configs/config_tracking_to_correct_label.ini \
+    --run 6.2.5_kinect,1.1.3_kinect --track_tag default
+"""
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+sys.path.append(os.getcwd())
+from src.utils import BoxWrapper, FrameWrapper, CV2VideoWriter, CV2VideoReader, ColorBGR, \
+    ColorRef, logger, parse_config
+
+
+def draw_tracked_frame(canvas: np.ndarray, frame_id: int, box_wrappers: List[BoxWrapper],
+                       labeled_frames=[]) -> None:
+    """
+    Draw boxes and frame information of a tracked frame, in place
+    :param canvas: a writable copy of the frame
+    :param frame_id:
+    :param box_wrappers: boxes on this frame
+    :param labeled_frames:
+    :return:
+    """
+    frame_wrapper = FrameWrapper(canvas, frame_id=frame_id)
+    for box_wrapper in box_wrappers:
+        frame_wrapper.put_bbox(box_wrapper, color=box_wrapper.color)
+    frame_wrapper.put_text(f'FrameID {frame_id}')
+    frame_wrapper.put_text(f'Second {frame_id // 30}')
+    if frame_id in labeled_frames:
+        frame_wrapper.put_text(f'LABEL!!!', color=ColorBGR.cyan)
+
+
+def boxes_by_frame(track_df: pd.DataFrame, labeled_frames: List[int]) -> Dict[int, List[BoxWrapper]]:
+    """
+    :param track_df: content of {run}_r50.csv
+    :param labeled_frames:
+    :return: frame_id -> boxes on this frame
+    """
+    color_dict = ColorRef.forward_set
+    frame_ids = track_df['frame'].to_numpy()
+    x, y = track_df['x'].to_numpy(), track_df['y'].to_numpy()
+    xmax, ymax = x + track_df['w'].to_numpy(), y + track_df['h'].to_numpy()
+    is_labeled = np.isin(frame_ids, labeled_frames)
+    frame_to_boxes = dict()
+    for i, (frame_id, name, conf) in enumerate(zip(frame_ids, track_df['name'],
+                                                   track_df['confidence'])):
+        state = 'init' if is_labeled[i] else 'track'
+        frame_to_boxes.setdefault(int(frame_id), []).append(
+            BoxWrapper(xmin=x[i], xmax=xmax[i], ymin=y[i], ymax=ymax[i], frame_id=int(frame_id),
+                       object_name=name, conf_score=conf, state=state, color=color_dict[state]))
+    return frame_to_boxes
+
+
+def render_run(args, run: str) -> str:
+    """
+    Draw {run}_r50.csv on the run's video, frames after the last labeled frame are not tracked
+    and not written, as in the tracking video
+    :param args: tracking config
+    :param run:
+    :return: path to the merged video
+    """
+    input_video_path = os.path.join(args.input_video_dir, run + f'_trim.mp4')
+    input_label_path = os.path.join(args.input_label_dir, run + f'_labels.csv')
+    track_csv_path = os.path.join(args.output_csv_dir, run + f'_r50.csv')
+    output_video_path = os.path.join(args.output_video_dir, f"{run}_{args.track_tag}_merged.avi")
+    cv2_video_reader = CV2VideoReader(input_video_path, prefetch=int(args.prefetch_frames))
+    label_df = pd.read_csv(input_label_path)
+    labeled_seconds = np.array(sorted(label_df['index'].unique()))
+    labeled_frames = list(map(round, labeled_seconds * cv2_video_reader.fps))
+    frame_to_boxes = boxes_by_frame(pd.read_csv(track_csv_path), labeled_frames)
+    cv2_video_writer = CV2VideoWriter(output_video_path=output_video_path,
+                                      width=cv2_video_reader.width,
+                                      height=cv2_video_reader.height, fps=120)
+    try:
+        frame_id = 0 - 1
+        while frame_id < labeled_frames[-1]:
+            frame_id += 1
+            ret, frame = cv2_video_reader.read_frame()
+            if not ret:
+                logger.info(f'{run}: end of video stream at frame {frame_id}')
+                break
+            draw_tracked_frame(frame, frame_id, frame_to_boxes.get(frame_id, []),
+                               labeled_frames=labeled_frames)
+            cv2_video_writer.write_frame(frame)
+    finally:
+        cv2_video_writer.writer.release()
+        cv2_video_reader.release()
+    return output_video_path
+
+
+def render_run_safe(args, run: str) -> str:
+    try:
+        output_video_path = render_run(args, run)
+        logger.info(f'Rendered {run} to {output_video_path}')
+        return output_video_path
+    except Exception as e:
+        logger.error(f'Error rendering {run}: {repr(e)}\n{traceback.format_exc()}')
+        return ''
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    if '.txt' in args.run:
+        with open(args.run, 'r') as f:
+            runs = [run.strip() for run in f.readlines() if run.strip()]
+    else:
+        runs = args.run.split(',')
+    if not os.path.exists(args.output_video_dir):
+        os.makedirs(args.output_video_dir)
+    render_workers = int(getattr(args, 'render_workers', 0)) or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=min(render_workers, len(runs))) as executor:
+        output_paths = list(executor.map(render_run_safe, [args] * len(runs), runs))
+    failed = [run for run, path in zip(runs, output_paths) if not path]
+    logger.info(f'Rendered {len(runs) - len(failed)} runs, failed: {failed}')
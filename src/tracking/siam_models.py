@@ -0,0 +1,281 @@
+"""
+Process-wide pool of SiamRPN networks shared by all TrackerWrapper instances.
+Each network is built and loaded from disk once per process, then used read-only;
+per-object template features (zf) live in the TrackerWrapper, not in the network.
+"""
+import os
+import sys
+from typing import Tuple
+
+import numpy as np
+import torch
+
+sys.path.append(os.getcwd())
+sys.path.append('../pysot')
+from pysot.core.config import cfg
+from pysot.models.model_builder import ModelBuilder
+from src.utils import logger
+
+# (model_config, model_path, cuda_id, precision, trace) -> (model, device)
+_siam_model_pool = dict()
+# pysot's cfg is global, remember which yaml it currently holds
+_merged_config = None
+
+PRECISIONS = dict(fp32=torch.float32, bf16=torch.bfloat16, fp16=torch.float16)
+
+
+class CastInput(torch.nn.Module):
+    """
+    Run a module in the network's precision on float32 crops
+    """
+
+    def __init__(self, module: torch.nn.Module, dtype: torch.dtype):
+        super().__init__()
+        self.module = module
+        self.dtype = dtype
+
+    def forward(self, x):
+        return self.module(x.to(self.dtype))
+
+
+class FloatOutputs(torch.nn.Module):
+    """
+    Return scores and regressions of a reduced-precision rpn head in float32, as pysot expects
+    """
+
+    def __init__(self, module: torch.nn.Module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, z_f, x_f):
+        cls, loc = self.module(z_f, x_f)
+        return cls.float(), loc.float()
+
+
+def supports_precision(precision: str, device: torch.device) -> bool:
+    """
+    Whether convolutions run in this precision on the device (e.g. fp16 is not implemented on
+    most CPU builds)
+    :param precision: fp32, bf16 or fp16
+    :param device:
+    :return:
+    """
+    dtype = PRECISIONS[precision]
+    try:
+        conv = torch.nn.Conv2d(3, 4, 3).to(device=device, dtype=dtype)
+        with torch.no_grad():
+            conv(torch.zeros(1, 3, 8, 8, device=device, dtype=dtype))
+        return True
+    except RuntimeError:
+        return False
+
+
+def set_inference_backend(model: ModelBuilder, device: torch.device, precision='fp32',
+                          trace=False) -> ModelBuilder:
+    """
+    Convert a loaded network for inference: weights in a reduced precision (crops are cast on the
+    way in, scores on the way out) and/or the backbone traced and frozen by TorchScript.
+    :param model:
+    :param device:
+    :param precision: fp32, bf16 or fp16
+    :param trace: trace the backbone, the neck is not traced because it crops template
+    features depending on their size
+    :return: model
+    """
+    dtype = PRECISIONS[precision]
+    if dtype != torch.float32:
+        model.to(dtype)
+        model.backbone = CastInput(model.backbone, dtype)
+        model.rpn_head = FloatOutputs(model.rpn_head)
+    if trace:
+        example = torch.zeros(1, 3, cfg.TRACK.INSTANCE_SIZE, cfg.TRACK.INSTANCE_SIZE, device=device)
+        with torch.no_grad():
+            model.backbone = torch.jit.freeze(torch.jit.trace(model.backbone.eval(), example))
+    return model
+
+
+def get_siam_model(model_config: str, model_path: str, precision='fp32',
+                   trace=False) -> Tuple[ModelBuilder, torch.device]:
+    """
+    Return a shared SiamRPN network, building it the first time it is requested in this process.
+    With several GPUs, a device is drawn at random for each request (as before), so there is at most
+    one network per device.
+    :param model_config: path to pysot yaml config
+    :param model_path: path to pysot checkpoint, empty: randomly initialized weights (seeded),
+    e.g. a tiny network (configs/alex_dwxcorr.yaml) to benchmark the pipeline without a checkpoint
+    :param precision: fp32, bf16 or fp16, see set_inference_backend. Falls back to fp32 if the
+    device doesn't support it
+    :param trace: trace the backbone with TorchScript
+    :return: model, device
+    """
+    global _merged_config
+    if _merged_config != model_config:
+        cfg.merge_from_file(model_config)
+        cfg.CUDA = torch.cuda.is_available() and cfg.CUDA
+        _merged_config = model_config
+    cuda_id = np.random.randint(torch.cuda.device_count()) if cfg.CUDA else None
+    key = (model_config, model_path, cuda_id, precision, bool(trace))
+    if key not in _siam_model_pool:
+        logger.info(f'Loading siamrpn {model_path} on {"cpu" if cuda_id is None else f"cuda:{cuda_id}"}'
+                    f' ({precision}{", traced" if trace else ""})')
+        device = torch.device('cpu') if cuda_id is None else torch.device(f'cuda:{cuda_id}')
+        if model_path:
+            model = ModelBuilder()
+            model.load_state_dict(torch.load(model_path, map_location=device))
+        else:
+            logger.warning(f'No checkpoint, {model_config} has random weights')
+            with torch.random.fork_rng():
+                torch.manual_seed(0)
+                model = ModelBuilder()
+        model.eval().to(device)
+        # weights are shared by every track, no track should ever update them
+        model.requires_grad_(False)
+        if precision != 'fp32' and not supports_precision(precision, device):
+            logger.warning(f'{precision} convolutions are not supported on {device}, using fp32')
+            precision = 'fp32'
+        _siam_model_pool[key] = (set_inference_backend(model, device, precision, trace), device)
+    return _siam_model_pool[key]
+
+
+def features_to_device(features, device: torch.device):
+    """
+    Move template features (a tensor, or a list of tensors per level if ADJUST) to a device
+    :param features:
+    :param device:
+    :return:
+    """
+    if features is None:
+        return None
+    if isinstance(features, (list, tuple)):
+        return [level.to(device) for level in features]
+    return features.to(device)
+
+
+def crop_template(tracker, frame: np.ndarray, bbox: list) -> dict:
+    """
+    First half of pysot's SiamRPNTracker.init: tracker state for bbox and its exemplar crop.
+    The crop is a few KB, tracks keep it to re-initialize later instead of the whole frame.
+    :param tracker: a pysot SiamRPNTracker
+    :param frame:
+    :param bbox: x, y, w, h
+    :return: template: center_pos, size, channel_average and z_crop (uint8, as cropped)
+    """
+    center_pos = np.array([bbox[0] + (bbox[2] - 1) / 2, bbox[1] + (bbox[3] - 1) / 2])
+    size = np.array([bbox[2], bbox[3]])
+    w_z = size[0] + cfg.TRACK.CONTEXT_AMOUNT * np.sum(size)
+    h_z = size[1] + cfg.TRACK.CONTEXT_AMOUNT * np.sum(size)
+    s_z = round(np.sqrt(w_z * h_z))
+    channel_average = np.mean(frame, axis=(0, 1))
+    z_crop = tracker.get_subwindow(frame, center_pos, cfg.TRACK.EXEMPLAR_SIZE, s_z,
+                                   channel_average)
+    # get_subwindow crops uint8 pixels and casts them to float, casting back is lossless
+    return dict(center_pos=center_pos, size=size, channel_average=channel_average,
+                z_crop=z_crop.cpu().numpy().astype(np.uint8))
+
+
+def set_template(tracker, template: dict) -> None:
+    """
+    Second half of pysot's SiamRPNTracker.init: set tracker state and compute template features
+    :param tracker: a pysot SiamRPNTracker
+    :param template: see crop_template
+    :return:
+    """
+    tracker.center_pos = template['center_pos']
+    tracker.size = template['size']
+    tracker.channel_average = template['channel_average']
+    z_crop = torch.from_numpy(template['z_crop'].astype(np.float32))
+    if cfg.CUDA:
+        z_crop = z_crop.cuda()
+    tracker.model.template(z_crop)
+
+
+def get_search_crop(tracker, frame: np.ndarray) -> Tuple[torch.Tensor, float]:
+    """
+    First half of pysot's SiamRPNTracker.track: crop the search region around the last position
+    :param tracker: a pysot SiamRPNTracker
+    :param frame:
+    :return: x_crop, scale_z
+    """
+    w_z = tracker.size[0] + cfg.TRACK.CONTEXT_AMOUNT * np.sum(tracker.size)
+    h_z = tracker.size[1] + cfg.TRACK.CONTEXT_AMOUNT * np.sum(tracker.size)
+    s_z = np.sqrt(w_z * h_z)
+    scale_z = cfg.TRACK.EXEMPLAR_SIZE / s_z
+    s_x = s_z * (cfg.TRACK.INSTANCE_SIZE / cfg.TRACK.EXEMPLAR_SIZE)
+    x_crop = tracker.get_subwindow(frame, tracker.center_pos,
+                                   cfg.TRACK.INSTANCE_SIZE,
+                                   round(s_x), tracker.channel_average)
+    return x_crop, scale_z
+
+
+def batched_track(model: ModelBuilder, x_crops: list, zfs: list) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Run search crops of several tracks through the shared network in one forward pass.
+    The depthwise cross-correlation of the rpn head correlates sample i with template i.
+    :param model:
+    :param x_crops: list of (1, 3, INSTANCE_SIZE, INSTANCE_SIZE) tensors
+    :param zfs: list of template features, one per crop (a list of tensors per level if ADJUST)
+    :return: cls, loc with one row per crop
+    """
+    with torch.no_grad():
+        xf = model.backbone(torch.cat(x_crops, dim=0))
+        if cfg.MASK.MASK:
+            xf = xf[-1]
+        if cfg.ADJUST.ADJUST:
+            xf = model.neck(xf)
+        if isinstance(zfs[0], (list, tuple)):
+            zf = [torch.cat(level, dim=0) for level in zip(*zfs)]
+        else:
+            zf = torch.cat(zfs, dim=0)
+        cls, loc = model.rpn_head(zf, xf)
+    return cls, loc
+
+
+def update_from_outputs(tracker, cls: torch.Tensor, loc: torch.Tensor, scale_z: float,
+                        frame_shape: Tuple) -> dict:
+    """
+    Second half of pysot's SiamRPNTracker.track: pick the best anchor, smooth and clip the box,
+    then update the tracker state
+    :param tracker: a pysot SiamRPNTracker
+    :param cls: (1, 2K, S, S) scores of this tracker's crop
+    :param loc: (1, 4K, S, S) regressions of this tracker's crop
+    :param scale_z:
+    :param frame_shape:
+    :return: outputs: object's coordinates and confidence score, same as SiamRPNTracker.track
+    """
+    score = tracker._convert_score(cls)
+    pred_bbox = tracker._convert_bbox(loc, tracker.anchors)
+
+    def change(r):
+        return np.maximum(r, 1. / r)
+
+    def sz(w, h):
+        pad = (w + h) * 0.5
+        return np.sqrt((w + pad) * (h + pad))
+
+    # scale penalty
+    s_c = change(sz(pred_bbox[2, :], pred_bbox[3, :]) /
+                 (sz(tracker.size[0] * scale_z, tracker.size[1] * scale_z)))
+    # aspect ratio penalty
+    r_c = change((tracker.size[0] / tracker.size[1]) /
+                 (pred_bbox[2, :] / pred_bbox[3, :]))
+    penalty = np.exp(-(r_c * s_c - 1) * cfg.TRACK.PENALTY_K)
+    pscore = penalty * score
+    # window penalty
+    pscore = pscore * (1 - cfg.TRACK.WINDOW_INFLUENCE) + \
+        tracker.window * cfg.TRACK.WINDOW_INFLUENCE
+    best_idx = np.argmax(pscore)
+
+    bbox = pred_bbox[:, best_idx] / scale_z
+    lr = penalty[best_idx] * score[best_idx] * cfg.TRACK.LR
+    cx = bbox[0] + tracker.center_pos[0]
+    cy = bbox[1] + tracker.center_pos[1]
+    # smooth bbox
+    width = tracker.size[0] * (1 - lr) + bbox[2] * lr
+    height = tracker.size[1] * (1 - lr) + bbox[3] * lr
+    # clip boundary
+    cx, cy, width, height = tracker._bbox_clip(cx, cy, width, height, frame_shape[:2])
+    # update state
+    tracker.center_pos = np.array([cx, cy])
+    tracker.size = np.array([width, height])
+    bbox = [cx - width / 2, cy - height / 2, width, height]
+    return {'bbox': bbox, 'best_score': score[best_idx]}
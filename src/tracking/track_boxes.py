@@ -0,0 +1,123 @@
+import numpy as np
+from typing import Iterable, Iterator, List, Union
+
+from src.utils import BoxWrapper
+
+
+class TrackBoxes:
+    """
+    This class stores the boxes of a track, in the order they were tracked.
+    Boxes are kept as BoxWrapper records (csv rows and drawing use them as they are) and their
+    frame_id, coordinates and confidence are mirrored in numpy columns, so that tracks can be
+    compared over frame ranges without going through records one by one.
+    Records must not change frame_id, coordinates or confidence after they are added;
+    name, state and color can change.
+    """
+
+    def __init__(self, box_wrappers: Iterable[BoxWrapper] = ()):
+        self.records = []
+        self._frame_ids = np.empty(16, dtype=np.int64)
+        self._xyxy = np.empty((16, 4), dtype=np.float64)
+        self._conf = np.empty(16, dtype=np.float64)
+        self.extend(box_wrappers)
+
+    def __getstate__(self) -> dict:
+        # columns are rebuilt from records
+        return dict(records=self.records)
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['records'])
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[BoxWrapper]:
+        return iter(self.records)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[BoxWrapper, 'TrackBoxes']:
+        if isinstance(index, slice):
+            return TrackBoxes(self.records[index])
+        return self.records[index]
+
+    def __setitem__(self, index: int, box_wrapper: BoxWrapper) -> None:
+        if index < 0:
+            index += len(self)
+        self.records[index] = box_wrapper
+        self._set_row(index, box_wrapper)
+
+    @property
+    def frame_ids(self) -> np.ndarray:
+        return self._frame_ids[:len(self)]
+
+    @property
+    def xyxy(self) -> np.ndarray:
+        return self._xyxy[:len(self)]
+
+    @property
+    def conf(self) -> np.ndarray:
+        return self._conf[:len(self)]
+
+    def _set_row(self, index: int, box_wrapper: BoxWrapper) -> None:
+        self._frame_ids[index] = box_wrapper.frame_id
+        self._xyxy[index] = box_wrapper.get_xyxy()
+        self._conf[index] = box_wrapper.conf_score
+
+    def _reserve(self, size: int) -> None:
+        capacity = len(self._frame_ids)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        n = len(self)
+        for name in ['_frame_ids', '_xyxy', '_conf']:
+            column = getattr(self, name)
+            grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:n] = column[:n]
+            setattr(self, name, grown)
+
+    def append(self, box_wrapper: BoxWrapper) -> None:
+        self._reserve(len(self) + 1)
+        self.records.append(box_wrapper)
+        self._set_row(len(self) - 1, box_wrapper)
+
+    def extend(self, box_wrappers: Iterable[BoxWrapper]) -> None:
+        for box_wrapper in box_wrappers:
+            self.append(box_wrapper)
+
+    def replace(self, indices: np.ndarray, box_wrappers: List[BoxWrapper]) -> None:
+        """
+        Replace boxes at several positions
+        :param indices:
+        :param box_wrappers: one record per index
+        :return:
+        """
+        for index, box_wrapper in zip(indices, box_wrappers):
+            self[int(index)] = box_wrapper
+
+    def take(self, indices: np.ndarray) -> List[BoxWrapper]:
+        return [self.records[index] for index in indices]
+
+    def sort(self) -> None:
+        """
+        Sort boxes by frame_id, keeping the order of boxes on the same frame
+        :return:
+        """
+        order = np.argsort(self.frame_ids, kind='stable')
+        self.records = [self.records[index] for index in order]
+        n = len(self)
+        self._frame_ids[:n] = self._frame_ids[order]
+        self._xyxy[:n] = self._xyxy[order]
+        self._conf[:n] = self._conf[order]
+
+    def drop_before(self, frame_id: int) -> None:
+        """
+        Forget boxes before frame_id (e.g. already written to csv), the last box is always kept
+        :param frame_id:
+        :return:
+        """
+        keep = np.flatnonzero(self.frame_ids >= frame_id)
+        if not len(keep):
+            keep = np.array([len(self) - 1])
+        if len(keep) == len(self):
+            return
+        self.__init__(self.take(keep))
@@ -0,0 +1,150 @@
+"""
+Track many runs on one machine: runs are packed onto tracking_workers processes, longest video
+first, each process limited to tracking_threads torch/OpenCV/BLAS threads so that workers don't
+oversubscribe the cores. Each run tracks in its worker's process (concurrent_passes=0,
+segment_workers=0), output/track_complete.txt and output/track_error.txt are appended as with
+tracking_to_correct_label.py. Per-run timing is appended to {output_csv_dir}/track_timing.csv
+as runs finish, throughput (videos/hour) is logged at the end.
+
+python src/tracking/track_runs.py -c configs/config_tracking_to_correct_label.ini \
+    --run output/track_kinect_complete.txt
+"""
+import os
+import sys
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import copy
+from time import perf_counter
+
+import cv2
+
+sys.path.append(os.getcwd())
+from src.utils import logger, parse_config
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+
+def read_runs(run: str) -> list:
+    """
+    :param run: a .txt file with one run per line, or a comma separated list of runs
+    :return: runs, in order and without duplicates
+    """
+    if '.txt' in run:
+        with open(run, 'r') as f:
+            runs = [line.strip() for line in f.readlines()]
+    else:
+        runs = run.split(',')
+    return list(dict.fromkeys(run for run in runs if run))
+
+
+def video_length(args, run: str) -> int:
+    """
+    :param args: tracking config
+    :param run:
+    :return: number of frames of the run's video, 0 if it can't be opened
+    """
+    capture = cv2.VideoCapture(os.path.join(args.input_video_dir, run + f'_trim.mp4'))
+    n_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) if capture.isOpened() else 0
+    capture.release()
+    return n_frames
+
+
+def plan_workers(n_runs: int, tracking_workers: int, tracking_threads: int) -> tuple:
+    """
+    :param n_runs:
+    :param tracking_workers: runs tracked at the same time, 0: cores // tracking_threads
+    :param tracking_threads: threads per worker, 0: cores // tracking_workers
+    :return: number of workers and threads per worker
+    """
+    n_cores = os.cpu_count()
+    if tracking_workers == 0:
+        tracking_workers = max(1, n_cores // (tracking_threads or 1))
+    tracking_workers = min(tracking_workers, n_runs)
+    if tracking_threads == 0:
+        tracking_threads = max(1, n_cores // tracking_workers)
+    return tracking_workers, tracking_threads
+
+
+def init_run_worker(n_threads: int) -> None:
+    """
+    Limit intra-op threads of torch and OpenCV in a worker process
+    :param n_threads:
+    :return:
+    """
+    import torch
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+    cv2.setNumThreads(n_threads)
+
+
+def track_run(args) -> dict:
+    """
+    Track args.run in a worker process
+    :param args: tracking config of this run
+    :return: timing of the run
+    """
+    from src.tracking.tracking_to_correct_label import track_and_record
+    logger.info(f'Tracking {args.run} in process {os.getpid()}')
+    timing = track_and_record(args)
+    timing['pid'] = os.getpid()
+    return timing
+
+
+if __name__ == '__main__':
+    args = parse_config()
+    runs = read_runs(args.run)
+    n_frames = {run: video_length(args, run) for run in runs}
+    # longest runs first, so that short runs fill the workers at the end
+    runs = sorted(runs, key=lambda run: n_frames[run], reverse=True)
+    tracking_workers, tracking_threads = plan_workers(len(runs),
+                                                      int(getattr(args, 'tracking_workers', 0)),
+                                                      int(getattr(args, 'tracking_threads', 0)))
+    logger.info(f'Tracking {len(runs)} runs with {tracking_workers} workers x '
+                f'{tracking_threads} threads')
+    # inherited by spawned workers, before their BLAS/OpenMP runtimes start
+    for env_var in THREAD_ENV_VARS:
+        os.environ[env_var] = str(tracking_threads)
+    if not os.path.exists(args.output_csv_dir):
+        os.makedirs(args.output_csv_dir)
+    timing_path = os.path.join(args.output_csv_dir, 'track_timing.csv')
+    write_header = not os.path.exists(timing_path)
+
+    start = perf_counter()
+    n_complete = 0
+    with open(timing_path, 'a', newline='') as f, \
+            ProcessPoolExecutor(max_workers=tracking_workers,
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=init_run_worker,
+                                initargs=(tracking_threads,)) as executor:
+        writer = csv.DictWriter(f, fieldnames=['run', 'video_frames', 'n_frames', 'seconds',
+                                               'fps', 'status', 'pid', 'workers', 'threads'])
+        if write_header:
+            writer.writeheader()
+        futures = dict()
+        for run in runs:
+            run_args = copy(args)
+            run_args.run = run
+            # parallelism is across runs
+            run_args.concurrent_passes = run_args.segment_workers = '0'
+            futures[executor.submit(track_run, run_args)] = run
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                timing = future.result()
+            except Exception as e:
+                # the worker died, track_and_record records errors raised while tracking
+                logger.error(f'Worker failed on {run}: {repr(e)}')
+                timing = dict(run=run, n_frames=0, seconds=0.0, status='error', pid=-1)
+            n_complete += timing['status'] == 'complete'
+            writer.writerow(dict(timing, video_frames=n_frames[run],
+                                 fps=round(timing['n_frames'] / max(timing['seconds'], 1e-6), 2),
+                                 seconds=round(timing['seconds'], 1),
+                                 workers=tracking_workers, threads=tracking_threads))
+            f.flush()
+            logger.info(f'{run}: {timing["status"]} in {timing["seconds"]:.0f}s')
+
+    hours = (perf_counter() - start) / 3600
+    logger.info(f'Tracked {n_complete}/{len(runs)} runs in {hours:.2f} hours, '
+                f'{n_complete / hours:.1f} videos/hour')
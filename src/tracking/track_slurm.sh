@@ -13,4 +13,4 @@ echo $tag
 #echo "track_v100.sh"
 cd /scratch/n.tan/extended-event-modeling/
 source activate pt-37
-python src/tracking/tracking_to_correct_label.py -c configs/config_tracking_to_correct_label.ini --run $run --track_tag $tag 2>&1 | tee "logs/$run$tag.log"
+python src/tracking/tracking_to_correct_label.py -c configs/config_tracking_to_correct_label.ini --run $run --track_tag $tag --resume 2>&1 | tee -a "logs/$run$tag.log"
@@ -11,17 +11,24 @@ import os
 
 sys.path.append(os.getcwd())
 sys.path.append('../pysot')
-from pysot.core.config import cfg
-from pysot.models.model_builder import ModelBuilder
 from pysot.tracker.tracker_builder import build_tracker
 from scipy.optimize import linear_sum_assignment
 
 import csv
+import pickle
 import pandas as pd
 from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import multiprocessing
 from copy import deepcopy
 from src.utils import BoxWrapper, FrameWrapper, CV2VideoWriter, CV2VideoReader, \
-    ColorBGR, logger, parse_config, ColorRef
+    ColorBGR, logger, parse_config, ColorRef, StageTimer
+from src.tracking.siam_models import get_siam_model, get_search_crop, batched_track, \
+    update_from_outputs, features_to_device, crop_template, set_template
+from src.tracking.frame_buffer import FrameRingBuffer
+from src.tracking.track_boxes import TrackBoxes
+from src.tracking.render_tracking_video import draw_tracked_frame, boxes_by_frame
 
 
 class TrackerWrapper:
@@ -31,44 +38,74 @@ class TrackerWrapper:
     """
 
     def __init__(self, box_wrapper: BoxWrapper, frame: np.ndarray,
-                 tracker_type: str = 'notrack', model_config: str = '', model_path: str = ''):
+                 tracker_type: str = 'notrack', model_config: str = '', model_path: str = '',
+                 precision: str = 'fp32', trace: bool = False):
         tracker_type = tracker_type
+        # kept to rebuild the tracker when this track is unpickled in another process
+        self.tracker_type = tracker_type
+        self.model_config = model_config
+        self.model_path = model_path
+        # inference backend of the shared network, see set_inference_backend
+        self.precision = precision
+        self.trace = trace
+        # adaptive tracking: (frame_id, center, conf) of the last predicted boxes since
+        # (re-)initialization, and frames skipped since the last prediction
+        self.recent_boxes = []
+        self.skipped_frames = []
         if tracker_type == 'siam':
-            # init siamrpn tracker
+            # init siamrpn tracker, the network is shared by all tracks in this process,
+            # only template features (self.zf) and tracker state belong to this track
             logger.debug(f'Building siamrpn')
-            cfg.merge_from_file(model_config)
-            cfg.CUDA = torch.cuda.is_available() and cfg.CUDA
-            if cfg.CUDA:
-                cuda_id = np.random.randint(torch.cuda.device_count())
-                self.cuda_id = cuda_id
-                self.device = torch.device(f'cuda:{self.cuda_id}')
-                with torch.cuda.device(self.cuda_id):
-                    model = ModelBuilder()
-                    model.load_state_dict(torch.load(model_path, map_location=self.device))
-                    model.eval().to(self.device)
-                    siam_tracker = build_tracker(model)
-                    siam_tracker.init(frame, box_wrapper.get_xywh())
-            else:
-                self.device = torch.device('cpu')
-                model = ModelBuilder()
-                model.load_state_dict(torch.load(model_path, map_location=self.device))
-                model.eval().to(self.device)
-                siam_tracker = build_tracker(model)
-                siam_tracker.init(frame, box_wrapper.get_xywh())
-
-            self.tracker = siam_tracker
+            model, self.device = get_siam_model(model_config, model_path, precision, trace)
+            self.cuda_id = self.device.index
+            self.tracker = build_tracker(model)
+            self.zf = None
+            # template crop of the first box, to re-initialize other tracks after merging
+            self.first_template = self.init_template(frame, box_wrapper)
         else:
             self.tracker = None
+            self.first_template = None
             logger.error(f'Unknown tracker type: {tracker_type}')
-        self.boxes = [box_wrapper]
+        self.boxes = TrackBoxes([box_wrapper])
         self.active = True
         self.terminate = False
-        self.first_frame = frame
         self.no_hit = 0
         self.no_hit_threshold = 30
         self.no_match_intervals = 0
         self.no_match_threshold = 1
 
+    def __getstate__(self) -> Dict:
+        """
+        Pickle this track without its pysot tracker, the network stays in the process's model pool.
+        Only the tracker's state and this track's template features are sent.
+        :return:
+        """
+        state = self.__dict__.copy()
+        state['tracker'] = None
+        if self.tracker is not None:
+            state['tracker_state'] = dict(center_pos=self.tracker.center_pos,
+                                          size=self.tracker.size,
+                                          channel_average=self.tracker.channel_average)
+            state['zf'] = features_to_device(self.zf, torch.device('cpu'))
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        """
+        Rebuild the tracker on this process's shared network and restore its state
+        :param state:
+        :return:
+        """
+        tracker_state = state.pop('tracker_state', None)
+        self.__dict__.update(state)
+        if tracker_state is not None:
+            model, self.device = get_siam_model(self.model_config, self.model_path,
+                                                self.precision, self.trace)
+            self.cuda_id = self.device.index
+            self.tracker = build_tracker(model)
+            for name, value in tracker_state.items():
+                setattr(self.tracker, name, value)
+            self.zf = features_to_device(self.zf, self.device)
+
     def __str__(self) -> str:
         return f'track_name={self.get_track_name()}, active={self.active}, ' \
                f'terminate={self.terminate}'
@@ -82,6 +119,8 @@ class TrackerWrapper:
         :param frame:
         :return: outputs: object's coordinates and confidence score
         """
+        # bind this track's template to the shared network before searching
+        self.tracker.model.zf = self.zf
         if self.device != torch.device('cpu'):
             with torch.cuda.device(self.cuda_id):
                 outputs = self.tracker.track(frame)
@@ -89,6 +128,76 @@ class TrackerWrapper:
             outputs = self.tracker.track(frame)
         return outputs
 
+    def search_crop(self, frame: np.ndarray) -> Tuple:
+        """
+        Crop the search region of this track, to be batched with other tracks' crops
+        :param frame:
+        :return: x_crop, scale_z
+        """
+        if self.device != torch.device('cpu'):
+            with torch.cuda.device(self.cuda_id):
+                return get_search_crop(self.tracker, frame)
+        return get_search_crop(self.tracker, frame)
+
+    def apply_outputs(self, cls: torch.Tensor, loc: torch.Tensor, scale_z: float,
+                      frame: np.ndarray) -> Dict:
+        """
+        Update this track from its slice of a batched forward pass
+        :param cls:
+        :param loc:
+        :param scale_z:
+        :param frame:
+        :return: outputs: object's coordinates and confidence score
+        """
+        return update_from_outputs(self.tracker, cls, loc, scale_z, frame.shape)
+
+    def init_template(self, frame: np.ndarray, box_wrapper: BoxWrapper,
+                      template: dict = None) -> dict:
+        """
+        Initialize tracker state and compute template features of this track's object
+        :param frame: frame of box_wrapper, not used if template is given
+        :param box_wrapper:
+        :param template: template crop of box_wrapper, see crop_template
+        :return: template crop
+        """
+        if template is None:
+            template = crop_template(self.tracker, frame, box_wrapper.get_xywh())
+        if self.device != torch.device('cpu'):
+            with torch.cuda.device(self.cuda_id):
+                set_template(self.tracker, template)
+        else:
+            set_template(self.tracker, template)
+        # template() stores features on the shared network, keep our own reference
+        self.zf = self.tracker.model.zf
+        self.recent_boxes = []
+        self.skipped_frames = []
+        self.record_prediction(box_wrapper)
+        return template
+
+    def record_prediction(self, box_wrapper: BoxWrapper) -> None:
+        """
+        Remember a box predicted by the tracker (or an initialization box) for adaptive tracking
+        :param box_wrapper:
+        :return:
+        """
+        xmin, ymin, xmax, ymax = box_wrapper.get_xyxy()
+        self.recent_boxes = self.recent_boxes[-1:] + [
+            (box_wrapper.frame_id, np.array([(xmin + xmax) / 2, (ymin + ymax) / 2]),
+             box_wrapper.conf_score)]
+
+    def is_steady(self, min_conf: float, max_motion: float) -> bool:
+        """
+        Whether the last two predicted boxes are confident and the object barely moved between them
+        :param min_conf:
+        :param max_motion: center displacement in pixels per frame
+        :return:
+        """
+        if len(self.recent_boxes) < 2:
+            return False
+        (frame_a, center_a, conf_a), (frame_b, center_b, conf_b) = self.recent_boxes
+        motion = np.linalg.norm(center_b - center_a) / abs(frame_b - frame_a)
+        return min(conf_a, conf_b) >= min_conf and motion < max_motion
+
     def append_box_wrapper(self, box_wrapper: BoxWrapper) -> None:
         """
         Update boxes
@@ -97,13 +206,10 @@ class TrackerWrapper:
         """
         self.boxes.append(box_wrapper)
 
-    def re_init(self, box_wrapper: BoxWrapper, frame: np.ndarray) -> None:
+    def re_init(self, box_wrapper: BoxWrapper, frame: np.ndarray = None,
+                template: dict = None) -> None:
         self.active = True
-        if self.device != torch.device('cpu'):
-            with torch.cuda.device(self.cuda_id):
-                self.tracker.init(frame, box_wrapper.get_xywh())
-        else:
-            self.tracker.init(frame, box_wrapper.get_xywh())
+        self.init_template(frame, box_wrapper, template=template)
 
     def deactivate_track(self) -> None:
         self.active = False
@@ -113,13 +219,14 @@ class TrackerWrapper:
         self.terminate = True
         self.tracker.model = None
         self.tracker = None
+        self.zf = None
 
     def change_name(self, object_name: str) -> None:
         for box in self.boxes:
             box.object_name = object_name
 
     def sort_boxes(self) -> None:
-        self.boxes = sorted(self.boxes, key=lambda box_wrapper: box_wrapper.frame_id)
+        self.boxes.sort()
 
 
 class Context:
@@ -127,11 +234,22 @@ class Context:
     This class keep track of active tracks and inactive tracks
     """
 
-    def __init__(self, track_kwargs: dict, color_reference: ColorRef):
+    def __init__(self, track_kwargs: dict, color_reference: ColorRef, adaptive_kwargs: dict = None):
+        """
+        :param track_kwargs:
+        :param color_reference:
+        :param adaptive_kwargs: conf, motion and max_skip of adaptive tracking (see skip_tracking),
+        None to run the tracker on every frame
+        """
         self.tracks = dict()
         self.frame_results = dict()
         self.track_kwargs = track_kwargs
         self.color_reference = color_reference
+        self.adaptive_kwargs = adaptive_kwargs
+        self.n_tracker_calls = 0
+        # selective backward tracking: (object_type, row of the label frame) -> forward object_id
+        # whose forward track is kept, these rows are initialized but not tracked backward
+        self.kept_forward = dict()
 
     def matching(self, boxes: np.ndarray, object_type: str,
                  frame_wrapper: FrameWrapper) -> None:
@@ -168,8 +286,6 @@ class Context:
                 self.tracks[object_type][row].boxes[-1] = box_wrapper
                 self.frame_results[frame_wrapper.frame_id][object_type][
                     row] = box_wrapper.get_xyxy() + [box_wrapper.conf_score]
-                frame_wrapper.put_bbox(bbox=box_wrapper,
-                                       color=box_wrapper.color)
         # Creating new tracks
         for col, box in enumerate(boxes):
             if col not in col_ind or col not in matched_boxes:
@@ -183,18 +299,38 @@ class Context:
                                          object_name=object_name,
                                          conf_score=1.0, state='init',
                                          color=self.color_reference.color_dict['init'])
-                track_kwargs = self.track_kwargs
+                track_kwargs = dict(self.track_kwargs)
                 track_kwargs['frame'] = frame_wrapper.frame
                 track_kwargs['box_wrapper'] = box_wrapper
                 self.frame_results[frame_wrapper.frame_id][object_type][
                     (len(self.tracks[object_type]))] = boxes[col]
                 self.tracks[object_type][
                     (len(self.tracks[object_type]))] = TrackerWrapper(**track_kwargs)
-                frame_wrapper.put_bbox(bbox=box_wrapper,
-                                       color=box_wrapper.color)
+                if (object_type, col) in self.kept_forward:
+                    logger.info(f'Keep forward track {object_type}'
+                                f'{self.kept_forward[(object_type, col)]} for {object_name}')
+                    self.tracks[object_type][len(self.tracks[object_type]) - 1].deactivate_track()
+
+    def skip_tracking(self, track_wrapper: TrackerWrapper, frame_id: int, force=False) -> bool:
+        """
+        Adaptive tracking: a steady track (confident and barely moving over its last two predictions)
+        skips the tracker for up to max_skip frames in a row. Boxes of skipped frames are
+        interpolated once the tracker runs again.
+        :param track_wrapper:
+        :param frame_id:
+        :param force: run the tracker, e.g. on the last frame of a pass
+        :return: True if the tracker is skipped on this frame
+        """
+        if self.adaptive_kwargs is None or force or \
+                len(track_wrapper.skipped_frames) >= self.adaptive_kwargs['max_skip'] or \
+                not track_wrapper.is_steady(self.adaptive_kwargs['conf'],
+                                            self.adaptive_kwargs['motion']):
+            return False
+        track_wrapper.skipped_frames.append(frame_id)
+        return True
 
     def tracking(self, object_type: str, frame_wrapper: FrameWrapper,
-                 conf_threshold=0.4) -> None:
+                 conf_threshold=0.4, force=False) -> None:
         if object_type not in self.tracks:
             logger.debug(f'Tracking: no instance of {object_type} initialized')
             return
@@ -204,68 +340,411 @@ class Context:
         for object_id, track_wrapper in category_track.items():
             if not track_wrapper.active:
                 continue
+            if self.skip_tracking(track_wrapper, frame_wrapper.frame_id, force=force):
+                continue
             logger.debug(f'Tracking {object_type + str(object_id)}')
             outputs = track_wrapper.predict_next_box(frame_wrapper.frame)
-            object_name = object_type + str(object_id)
-            box_wrapper = BoxWrapper(xmin=outputs['bbox'][0], ymin=outputs['bbox'][1],
-                                     xmax=outputs['bbox'][0] + outputs['bbox'][2],
-                                     ymax=outputs['bbox'][1] + outputs['bbox'][3],
-                                     frame_id=frame_wrapper.frame_id, object_name=object_name,
-                                     conf_score=outputs['best_score'], state='track',
-                                     color=self.color_reference.color_dict['track'])
-            self.tracks[object_type][object_id].append_box_wrapper(box_wrapper)
-            if box_wrapper.conf_score < conf_threshold:
-                track_wrapper.no_hit += 1
-                if track_wrapper.no_hit > track_wrapper.no_hit_threshold:
-                    logger.info(f'FrameID {frame_wrapper.frame_id}: '
-                                f'deactivate track {object_type + str(object_id)}')
-                    track_wrapper.deactivate_track()
-                    box_wrapper.state = 'deactivate'
-                    box_wrapper.color = self.color_reference.color_dict['deactivate']
-            # else:
-            # reset count
-            # track_wrapper.no_hit = 0
-            self.frame_results[frame_wrapper.frame_id][object_type][
-                object_id] = box_wrapper.get_xyxy() + [box_wrapper.conf_score]
-            frame_wrapper.put_bbox(bbox=box_wrapper,
-                                   color=box_wrapper.color)
+            self.n_tracker_calls += 1
+            self.update_track(object_type, object_id, outputs, frame_wrapper,
+                              conf_threshold=conf_threshold)
+
+    def tracking_batched(self, frame_wrapper: FrameWrapper, conf_threshold=0.4,
+                         max_batch=64, force=False) -> None:
+        """
+        Track all active objects of all categories on a frame, search crops of tracks sharing
+        a network go through the backbone as one batch
+        :param frame_wrapper:
+        :param conf_threshold:
+        :param max_batch: maximum number of crops in a forward pass
+        :param force: don't skip the tracker (adaptive tracking)
+        :return:
+        """
+        active_tracks = []
+        for object_type, category_track in self.tracks.items():
+            self.frame_results[frame_wrapper.frame_id][object_type] = dict()
+            for object_id, track_wrapper in category_track.items():
+                if track_wrapper.active and \
+                        not self.skip_tracking(track_wrapper, frame_wrapper.frame_id, force=force):
+                    active_tracks.append((object_type, object_id, track_wrapper))
+        self.n_tracker_calls += len(active_tracks)
+        # tracks on different devices have different networks
+        model_to_tracks = dict()
+        for object_type, object_id, track_wrapper in active_tracks:
+            model_to_tracks.setdefault(id(track_wrapper.tracker.model), []).append(
+                (object_type, object_id, track_wrapper))
+        all_outputs = dict()
+        for model_tracks in model_to_tracks.values():
+            for start in range(0, len(model_tracks), max_batch):
+                batch = model_tracks[start: start + max_batch]
+                logger.debug(f'Tracking {len(batch)} objects in one batch')
+                crops = [track_wrapper.search_crop(frame_wrapper.frame)
+                         for _, _, track_wrapper in batch]
+                first_track = batch[0][2]
+                if first_track.device != torch.device('cpu'):
+                    with torch.cuda.device(first_track.cuda_id):
+                        cls, loc = batched_track(first_track.tracker.model,
+                                                 [x_crop for x_crop, _ in crops],
+                                                 [track_wrapper.zf for _, _, track_wrapper in batch])
+                else:
+                    cls, loc = batched_track(first_track.tracker.model,
+                                             [x_crop for x_crop, _ in crops],
+                                             [track_wrapper.zf for _, _, track_wrapper in batch])
+                for i, (object_type, object_id, track_wrapper) in enumerate(batch):
+                    all_outputs[(object_type, object_id)] = track_wrapper.apply_outputs(
+                        cls[i: i + 1], loc[i: i + 1], crops[i][1], frame_wrapper.frame)
+        for object_type, object_id, track_wrapper in active_tracks:
+            self.update_track(object_type, object_id, all_outputs[(object_type, object_id)],
+                              frame_wrapper, conf_threshold=conf_threshold)
+
+    def update_track(self, object_type: str, object_id: int, outputs: Dict,
+                     frame_wrapper: FrameWrapper, conf_threshold=0.4) -> None:
+        """
+        Append the tracker's prediction to a track and deactivate the track after too many
+        low-confidence predictions
+        :param object_type:
+        :param object_id:
+        :param outputs: tracker's prediction
+        :param frame_wrapper:
+        :param conf_threshold:
+        :return:
+        """
+        object_name = object_type + str(object_id)
+        box_wrapper = BoxWrapper(xmin=outputs['bbox'][0], ymin=outputs['bbox'][1],
+                                 xmax=outputs['bbox'][0] + outputs['bbox'][2],
+                                 ymax=outputs['bbox'][1] + outputs['bbox'][3],
+                                 frame_id=frame_wrapper.frame_id, object_name=object_name,
+                                 conf_score=outputs['best_score'], state='track',
+                                 color=self.color_reference.color_dict['track'])
+        track_wrapper = self.tracks[object_type][object_id]
+        if len(track_wrapper.skipped_frames):
+            self.interpolate_skipped(object_type, object_id, box_wrapper,
+                                     conf_threshold=conf_threshold)
+            if not track_wrapper.active:
+                return
+        self.add_tracked_box(object_type, object_id, box_wrapper, conf_threshold=conf_threshold)
+        track_wrapper.record_prediction(box_wrapper)
+
+    def interpolate_skipped(self, object_type: str, object_id: int, box_wrapper: BoxWrapper,
+                            conf_threshold=0.4) -> None:
+        """
+        Add boxes on frames skipped by adaptive tracking, linearly interpolated (coordinates and
+        confidence) between the last box of the track and box_wrapper
+        :param object_type:
+        :param object_id:
+        :param box_wrapper: the next predicted box
+        :param conf_threshold:
+        :return:
+        """
+        track_wrapper = self.tracks[object_type][object_id]
+        last_box = track_wrapper.boxes[-1]
+        start = np.array(last_box.get_xyxy() + [last_box.conf_score], dtype=float)
+        stop = np.array(box_wrapper.get_xyxy() + [box_wrapper.conf_score], dtype=float)
+        for frame_id in track_wrapper.skipped_frames:
+            if not track_wrapper.active:
+                break
+            weight = (frame_id - last_box.frame_id) / (box_wrapper.frame_id - last_box.frame_id)
+            xmin, ymin, xmax, ymax, conf_score = start + weight * (stop - start)
+            self.add_tracked_box(object_type, object_id,
+                                 BoxWrapper(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax,
+                                            frame_id=frame_id, object_name=box_wrapper.object_name,
+                                            conf_score=conf_score, state='track',
+                                            color=box_wrapper.color),
+                                 conf_threshold=conf_threshold)
+        track_wrapper.skipped_frames = []
+
+    def add_tracked_box(self, object_type: str, object_id: int, box_wrapper: BoxWrapper,
+                        conf_threshold=0.4) -> None:
+        """
+        Append a tracked box to a track, counting low-confidence boxes
+        :param object_type:
+        :param object_id:
+        :param box_wrapper:
+        :param conf_threshold:
+        :return:
+        """
+        track_wrapper = self.tracks[object_type][object_id]
+        track_wrapper.append_box_wrapper(box_wrapper)
+        if box_wrapper.conf_score < conf_threshold:
+            track_wrapper.no_hit += 1
+            if track_wrapper.no_hit > track_wrapper.no_hit_threshold:
+                logger.info(f'FrameID {box_wrapper.frame_id}: '
+                            f'deactivate track {object_type + str(object_id)}')
+                track_wrapper.deactivate_track()
+                box_wrapper.state = 'deactivate'
+                box_wrapper.color = self.color_reference.color_dict['deactivate']
+        # else:
+        # reset count
+        # track_wrapper.no_hit = 0
+        self.frame_results[box_wrapper.frame_id][object_type][
+            object_id] = box_wrapper.get_xyxy() + [box_wrapper.conf_score]
 
     def merge_bw_track(self, object_type: str, backward_track: TrackerWrapper):
         backward_track.change_name(object_type + str(len(self.tracks[object_type])))
         backward_track.sort_boxes()
-        backward_track.re_init(backward_track.boxes[-1], backward_track.first_frame)
+        backward_track.re_init(backward_track.boxes[-1], template=backward_track.first_template)
         self.tracks[object_type][len(self.tracks[object_type])] = backward_track
 
 
-def track_buffer(context: Context, buffer_frames: dict,
-                 label_df, labeled_frames, is_backward=False, fps=30) -> Context:
+def track_buffer(context: Context, buffer_frames: FrameRingBuffer,
+                 label_df, labeled_frames, is_backward=False, fps=30, batched=False,
+                 timer: StageTimer = None) -> Context:
+    """
+    Track objects over buffered frames, frames are only read (boxes are drawn later
+    by draw_context_on_frames)
+    :param context:
+    :param buffer_frames: frames since the last label frame, up to and including the current one
+    :param label_df:
+    :param labeled_frames:
+    :param is_backward:
+    :param fps:
+    :param batched:
+    :param timer: accumulates time of tracker calls (tracking) and label matching (matching)
+    :return:
+    """
+    if timer is None:
+        timer = StageTimer()
+    frame_ids = sorted(buffer_frames.keys())
     if not is_backward:
-        # Delete label frame while tracking forward
-        del buffer_frames[max(buffer_frames.keys())]
-    # Create video writer and reader
+        # Skip label frame while tracking forward
+        frame_ids = frame_ids[:-1]
 
-    for frame_id, frame in sorted(buffer_frames.items(), key=lambda kv: kv[0],
-                                  reverse=is_backward):
-        frame_wrapper = FrameWrapper(frame=frame, frame_id=frame_id)
+    # adaptive tracking: every track predicts on the last frame of a pass, so that all frames
+    # get a box before merging
+    last_frame_id = None
+    if len(frame_ids):
+        last_frame_id = frame_ids[0] if is_backward else frame_ids[-1]
+    for frame_id in (reversed(frame_ids) if is_backward else frame_ids):
+        frame_wrapper = FrameWrapper(frame=buffer_frames[frame_id], frame_id=frame_id)
+        force = frame_id == last_frame_id
         context.frame_results[frame_wrapper.frame_id] = dict()
         if frame_id in labeled_frames:  # If this is a label frame
             df_current = label_df[
                 (label_df['index'] == round(frame_id / fps))]
             object_types = set(df_current['class'].unique())
-            for object_type in object_types:
-                df_category = df_current[df_current['class'] == object_type]
-                boxes = df_category[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy()
-                # no need to run tracking, only backward go into this condition,
-                # and matching in this case only does initialization
-                # context.tracking(object_type, frame_wrapper)
-                context.matching(boxes, object_type, frame_wrapper)
+            with timer.stage('matching'):
+                for object_type in object_types:
+                    df_category = df_current[df_current['class'] == object_type]
+                    boxes = df_category[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy()
+                    # no need to run tracking, only backward go into this condition,
+                    # and matching in this case only does initialization
+                    # context.tracking(object_type, frame_wrapper)
+                    context.matching(boxes, object_type, frame_wrapper)
+        elif batched:  # If this is not a label frame, track all objects in batches
+            with timer.stage('tracking'):
+                context.tracking_batched(frame_wrapper, force=force)
         else:  # If this is not a label frame
-            for object_type in context.tracks.keys():
-                context.tracking(object_type, frame_wrapper)
+            with timer.stage('tracking'):
+                for object_type in context.tracks.keys():
+                    context.tracking(object_type, frame_wrapper, force=force)
 
     return context
 
 
+# arguments of tracking passes that are the same for every interval of a video,
+# set once per worker process by init_tracking_worker
+_worker_kwargs = dict()
+
+
+def init_tracking_worker(track_kwargs: dict, adaptive_kwargs: dict, label_df, labeled_frames, fps,
+                         batched, num_threads: int, video_path: str = '', prefetch: int = 0) -> None:
+    """
+    Initializer of processes running tracking passes
+    :param track_kwargs:
+    :param adaptive_kwargs:
+    :param label_df:
+    :param labeled_frames:
+    :param fps:
+    :param batched:
+    :param num_threads: torch threads of this process, other passes run at the same time
+    :param video_path: video to decode segments from, only for track_segment
+    :param prefetch: frames decoded ahead while reading segments, see CV2VideoReader
+    :return:
+    """
+    torch.set_num_threads(num_threads)
+    _worker_kwargs.update(track_kwargs=track_kwargs, adaptive_kwargs=adaptive_kwargs,
+                          label_df=label_df,
+                          labeled_frames=labeled_frames, fps=fps, batched=batched,
+                          video_path=video_path, prefetch=prefetch)
+
+
+def track_backward(buffer_frames: FrameRingBuffer) -> Context:
+    """
+    Run a backward pass in a worker process. Frames are read from the shared buffer, the resulting
+    context is pickled back without networks (see TrackerWrapper.__getstate__)
+    :param buffer_frames: a shared FrameRingBuffer
+    :return: context_backward
+    """
+    context_backward = Context(track_kwargs=_worker_kwargs['track_kwargs'],
+                               color_reference=ColorRef(ColorRef.backward_set),
+                               adaptive_kwargs=_worker_kwargs['adaptive_kwargs'])
+    return track_buffer(context=context_backward,
+                        buffer_frames=buffer_frames,
+                        label_df=_worker_kwargs['label_df'],
+                        labeled_frames=_worker_kwargs['labeled_frames'],
+                        is_backward=True, fps=_worker_kwargs['fps'],
+                        batched=_worker_kwargs['batched'])
+
+
+def segment_checksum(buffer_frames: FrameRingBuffer) -> Tuple:
+    """
+    Identify the frames of an interval, to check that a worker decoded the same frames
+    :param buffer_frames:
+    :return: first frame_id, last frame_id and crc32 of both frames
+    """
+    frame_ids = sorted(buffer_frames.keys())
+    return (frame_ids[0], frame_ids[-1],
+            buffer_frames.checksum(frame_ids[0]), buffer_frames.checksum(frame_ids[-1]))
+
+
+def track_segment(init_frame, label_frame: int):
+    """
+    Track one labeled interval in a worker process, from the label frame before it (or the start
+    of the video) to label_frame.
+    Forward: matching_and_merging leaves one active track per ground-truth box of the previous
+    label frame, re-initialized from that box, so the forward pass starts from those boxes here.
+    Tracks are numbered by ground-truth row, their no_hit count starts from 0.
+    Backward: same as sequential mode, a backward context starts empty at every interval.
+    :param init_frame: previous label frame, None for the first interval
+    :param label_frame:
+    :return: None if the video ends before label_frame, else a dict with
+    forward_tracks (object_type -> row -> dict(boxes, no_hit, active)),
+    context_backward, checksum (see segment_checksum) and n_tracker_calls of the forward pass
+    """
+    cv2_video_reader = CV2VideoReader(_worker_kwargs['video_path'],
+                                      prefetch=_worker_kwargs['prefetch'])
+    first_frame = 0 if init_frame is None else init_frame
+    cv2_video_reader.capture.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+    buffer_frames = FrameRingBuffer(height=cv2_video_reader.height, width=cv2_video_reader.width,
+                                    capacity=label_frame - first_frame + 1)
+    for frame_id in range(first_frame, label_frame + 1):
+        ret, frame = cv2_video_reader.read_frame(out=buffer_frames.next_slot())
+        if not ret:
+            logger.info(f'End of video stream before label frame {label_frame}')
+            cv2_video_reader.release()
+            return None
+        buffer_frames.append(frame_id, frame)
+    cv2_video_reader.release()
+
+    logger.info(f'Tracking segment from {first_frame} to {label_frame}')
+    pass_kwargs = dict(label_df=_worker_kwargs['label_df'],
+                       labeled_frames=_worker_kwargs['labeled_frames'],
+                       fps=_worker_kwargs['fps'], batched=_worker_kwargs['batched'])
+    # the previous label frame (matching only) is the first frame of the forward pass
+    context_forward = Context(track_kwargs=_worker_kwargs['track_kwargs'],
+                              color_reference=ColorRef(ColorRef.forward_set),
+                              adaptive_kwargs=_worker_kwargs['adaptive_kwargs'])
+    context_forward = track_buffer(context=context_forward, buffer_frames=buffer_frames,
+                                   is_backward=False, **pass_kwargs)
+    if init_frame is not None:
+        buffer_frames.popleft()
+    context_backward = Context(track_kwargs=_worker_kwargs['track_kwargs'],
+                               color_reference=ColorRef(ColorRef.backward_set),
+                               adaptive_kwargs=_worker_kwargs['adaptive_kwargs'])
+    context_backward = track_buffer(context=context_backward, buffer_frames=buffer_frames,
+                                    is_backward=True, **pass_kwargs)
+    # the first box of a forward track is its ground-truth box on the previous label frame
+    forward_tracks = {object_type: {object_id: dict(boxes=track_wrapper.boxes[1:],
+                                                    no_hit=track_wrapper.no_hit,
+                                                    active=track_wrapper.active)
+                                    for object_id, track_wrapper in category_track.items()}
+                      for object_type, category_track in context_forward.tracks.items()}
+    return dict(forward_tracks=forward_tracks, context_backward=context_backward,
+                checksum=segment_checksum(buffer_frames),
+                n_tracker_calls=context_forward.n_tracker_calls)
+
+
+def replay_forward_tracks(context: Context, label_context: Context, forward_tracks: dict,
+                          frame_ids: list, batched: bool, conf_threshold=0.4) -> bool:
+    """
+    Append forward boxes tracked by track_segment to the video's context, with the same bookkeeping
+    as tracking on this process. no_hit counts carry over intervals while the worker counted from 0,
+    so a track can deactivate earlier here than in the worker; its later boxes are dropped.
+    Tracks are independent, except that with batched inference a track deactivating earlier changes
+    the batches of other tracks; then the boxes are not used.
+    :param context: context_forward of the video, after merging the previous interval
+    :param label_context: context_backward of the previous interval, after merging (its tracks
+    are numbered by ground-truth row and named after the track they were merged into)
+    :param forward_tracks: see track_segment
+    :param frame_ids: frames of the forward pass
+    :param batched:
+    :param conf_threshold:
+    :return: False if the forward pass has to run on this process
+    """
+    # worker track -> track in context
+    row_to_object_id = dict()
+    if label_context is not None:
+        for object_type, category_track in label_context.tracks.items():
+            for row, label_track in category_track.items():
+                row_to_object_id[(object_type, row)] = int(
+                    label_track.get_track_name()[len(object_type):])
+    active_tracks = {(object_type, object_id)
+                     for object_type, category_track in context.tracks.items()
+                     for object_id, track_wrapper in category_track.items() if track_wrapper.active}
+    worker_tracks = {(object_type, row) for object_type, category_track in forward_tracks.items()
+                     for row in category_track}
+    if worker_tracks != set(row_to_object_id.keys()) or \
+            active_tracks != {(object_type, object_id)
+                              for (object_type, _), object_id in row_to_object_id.items()}:
+        logger.warning('Active tracks differ from ground-truth boxes of the previous label frame')
+        return False
+    object_id_to_boxes = dict()
+    for (object_type, row), object_id in row_to_object_id.items():
+        worker_track = forward_tracks[object_type][row]
+        track_wrapper = context.tracks[object_type][object_id]
+        if batched and track_wrapper.no_hit != 0 and \
+                not (worker_track['active'] and track_wrapper.no_hit + worker_track['no_hit']
+                     <= track_wrapper.no_hit_threshold):
+            logger.info(f'{track_wrapper.get_track_name()} deactivates earlier than in the '
+                        f'segment worker, batches differ')
+            return False
+        object_id_to_boxes[(object_type, object_id)] = worker_track['boxes']
+
+    for i, frame_id in enumerate(frame_ids):
+        context.frame_results[frame_id] = dict()
+        for object_type, category_track in context.tracks.items():
+            context.frame_results[frame_id][object_type] = dict()
+            for object_id, track_wrapper in category_track.items():
+                if not track_wrapper.active:
+                    continue
+                box_wrapper = object_id_to_boxes[(object_type, object_id)][i]
+                box_wrapper.object_name = object_type + str(object_id)
+                box_wrapper.state = 'track'
+                box_wrapper.color = context.color_reference.color_dict['track']
+                context.add_tracked_box(object_type, object_id, box_wrapper,
+                                        conf_threshold=conf_threshold)
+    return True
+
+
+def keep_forward_tracks(context_forward: Context, df_current: pd.DataFrame,
+                        iou_threshold=0.5) -> dict:
+    """
+    Selective backward tracking: find ground-truth boxes of the closing label frame that an active
+    forward track already follows (IoU of its last box with the box >= iou_threshold).
+    These boxes are not tracked backward, their forward tracks are kept and re-initialized.
+    :param context_forward: after the forward pass of the interval
+    :param df_current: labels of the closing label frame
+    :param iou_threshold:
+    :return: kept_forward: (object_type, row of the box in its category) -> forward object_id
+    """
+    kept_forward = dict()
+    for object_type in set(df_current['class'].unique()):
+        boxes = df_current[df_current['class'] == object_type][
+            ['xmin', 'ymin', 'xmax', 'ymax']].to_numpy()
+        object_ids = [object_id for object_id, track_wrapper
+                      in sorted(context_forward.tracks.get(object_type, dict()).items())
+                      if track_wrapper.active]
+        if not len(object_ids):
+            continue
+        last_boxes = np.array([context_forward.tracks[object_type][object_id].boxes.xyxy[-1]
+                               for object_id in object_ids])
+        iou = bbox_iou_array(boxes[:, None], last_boxes[None, :])
+        rows, cols = linear_sum_assignment(-iou)
+        for row, col in zip(rows, cols):
+            if iou[row, col] >= iou_threshold:
+                kept_forward[(object_type, row)] = object_ids[col]
+    return kept_forward
+
+
 def matching_and_merging(context_forward: Context, context_backward: Context,
                          agreement_threshold=0.5) -> Context:
     forward_categories = set(context_forward.tracks.keys())
@@ -280,15 +759,25 @@ def matching_and_merging(context_forward: Context, context_backward: Context,
         n_bw_tracks = len(context_backward.tracks[object_type])
         distance_matrix = np.full(shape=(n_fw_tracks, n_bw_tracks), fill_value=10000,
                                   dtype=np.float)
+        compared_fw_ids = []
         for fw_object_id, fw_track in context_forward.tracks[object_type].items():
             if fw_track.terminate:
                 logger.info(f'FW {object_type + str(fw_object_id)} terminated last interval')
                 continue
-            for bw_object_id, bw_track in context_backward.tracks[object_type].items():
-                logger.info(
-                    f'Compare FW {object_type + str(fw_object_id)} with BW {object_type + str(bw_object_id)}')
-                distance_matrix[fw_object_id][bw_object_id] = compare_tracks(fw_track,
-                                                                             bw_track)
+            compared_fw_ids.append(fw_object_id)
+        if len(compared_fw_ids):
+            distance_matrix[compared_fw_ids] = compare_track_sets(
+                [context_forward.tracks[object_type][fw_object_id]
+                 for fw_object_id in compared_fw_ids],
+                [context_backward.tracks[object_type][bw_object_id]
+                 for bw_object_id in range(n_bw_tracks)])
+        # selective backward tracking: kept forward tracks merge with their untracked bw box
+        for (kept_type, row), fw_object_id in context_backward.kept_forward.items():
+            if kept_type == object_type:
+                distance_matrix[fw_object_id, :] = distance_matrix[:, row] = 10000
+                distance_matrix[fw_object_id, row] = 0
+        logger.info(f'Distances between FW {compared_fw_ids} and BW {object_type} tracks:\n'
+                    f'{distance_matrix[compared_fw_ids]}')
         row_ind, col_ind = linear_sum_assignment(distance_matrix)
         matched_bw_tracks = []
         matched_fw_tracks = []
@@ -300,7 +789,7 @@ def matching_and_merging(context_forward: Context, context_backward: Context,
                     f'Matching score: {1 - distance_matrix[row][col]}')
                 bw_track = context_backward.tracks[object_type][col]
                 fw_track = context_forward.tracks[object_type][row]
-                fw_track.re_init(frame=bw_track.first_frame, box_wrapper=bw_track.boxes[0])
+                fw_track.re_init(box_wrapper=bw_track.boxes[0], template=bw_track.first_template)
                 fw_track.no_match_intervals = 0
                 bw_track.change_name(fw_track.get_track_name())
                 merge_boxes(context_forward.tracks[object_type][row],
@@ -373,10 +862,11 @@ def matching_and_merging(context_forward: Context, context_backward: Context,
     return context_forward
 
 
-def draw_context_on_frames(context: Context, buffer_frames: Dict,
+def draw_context_on_frames(context: Context, buffer_frames: FrameRingBuffer,
                            cv2_video_writer: CV2VideoWriter, labeled_frames=[]) -> None:
     """
-    This functions draw all tracks from a context on a list of frames
+    This functions draw all tracks from a context on a list of frames.
+    Buffered frames are read-only, each frame is copied into a single canvas before drawing.
     :param context:
     :param buffer_frames:
     :param cv2_video_writer:
@@ -384,22 +874,21 @@ def draw_context_on_frames(context: Context, buffer_frames: Dict,
     :return:
     """
     # going over all tracks
+    frame_to_boxes = dict()
     for object_type, category_track in context.tracks.items():
         for object_id, track_wrapper in category_track.items():
             for box_wrapper in track_wrapper.boxes:
                 if box_wrapper.frame_id in buffer_frames:
-                    frame = buffer_frames[box_wrapper.frame_id]
-                    frame_wrapper = FrameWrapper(frame, frame_id=box_wrapper.frame_id)
-                    frame_wrapper.put_bbox(box_wrapper,
-                                           color=box_wrapper.color)
+                    frame_to_boxes.setdefault(box_wrapper.frame_id, []).append(box_wrapper)
 
+    canvas = None
     for frame_id, frame in buffer_frames.items():
-        frame_wrapper = FrameWrapper(frame, frame_id=frame_id)
-        frame_wrapper.put_text(f'FrameID {frame_id}')
-        frame_wrapper.put_text(f'Second {frame_id // 30}')
-        if frame_id in labeled_frames:
-            frame_wrapper.put_text(f'LABEL!!!', color=ColorBGR.cyan)
-        cv2_video_writer.write_frame(frame)
+        if canvas is None:
+            canvas = np.empty_like(frame)
+        np.copyto(canvas, frame)
+        draw_tracked_frame(canvas, frame_id, frame_to_boxes.get(frame_id, []),
+                           labeled_frames=labeled_frames)
+        cv2_video_writer.write_frame(canvas)
 
 
 def print_context(context: Context):
@@ -438,6 +927,25 @@ def bbox_iou(boxA, boxB):
     return iou
 
 
+def bbox_iou_array(boxesA: np.ndarray, boxesB: np.ndarray) -> np.ndarray:
+    """
+    Same as bbox_iou for arrays of boxes (..., 4) in xyxy, broadcasting leading dimensions.
+    Missing boxes (nan) have nan iou.
+    :param boxesA:
+    :param boxesB:
+    :return: iou (...)
+    """
+    xA = np.maximum(boxesA[..., 0], boxesB[..., 0])
+    yA = np.maximum(boxesA[..., 1], boxesB[..., 1])
+    xB = np.minimum(boxesA[..., 2], boxesB[..., 2])
+    yB = np.minimum(boxesA[..., 3], boxesB[..., 3])
+    with np.errstate(invalid='ignore'):
+        interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+        boxAArea = (boxesA[..., 2] - boxesA[..., 0] + 1) * (boxesA[..., 3] - boxesA[..., 1] + 1)
+        boxBArea = (boxesB[..., 2] - boxesB[..., 0] + 1) * (boxesB[..., 3] - boxesB[..., 1] + 1)
+        return interArea / (boxAArea + boxBArea - interArea)
+
+
 def get_temporal_tracks(forward_track: TrackerWrapper,
                         backward_track: TrackerWrapper) -> Tuple:
     """
@@ -477,18 +985,72 @@ def compare_tracks(forward_track: TrackerWrapper, backward_track: TrackerWrapper
             f'No temporal overlap between FW {forward_track.get_track_name()} and BW {backward_track.get_track_name()}')
         return 1
     # calculate agreement within temporal intersection
-    agreement = 0
-    for frame_id in range(intersection_start, intersection_stop + 1):
-        fw_box = forward_track.boxes[frame_id - fw_start]
-        bw_box = backward_track.boxes[bw_start - frame_id - 1]
-        iou = bbox_iou(fw_box.get_xyxy(), bw_box.get_xyxy())
-        if iou > iou_threshold:
-            agreement += 1
+    fw_index, bw_index = aligned_indices(forward_track, backward_track,
+                                         intersection_start, intersection_stop)
+    iou = bbox_iou_array(forward_track.boxes.xyxy[fw_index], backward_track.boxes.xyxy[bw_index])
+    agreement = int(np.count_nonzero(iou > iou_threshold))
     logger.info(f'Agreement {agreement} over intersection {intersection}: '
                 f'{agreement / intersection}')
     return 1.0 - (agreement / intersection)
 
 
+def aligned_indices(forward_track: TrackerWrapper, backward_track: TrackerWrapper,
+                    start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions of frames start..stop in the boxes of forward_track (ascending frame_id) and
+    backward_track (descending frame_id, as tracked)
+    :param forward_track:
+    :param backward_track:
+    :param start:
+    :param stop:
+    :return: fw_index, bw_index
+    """
+    frame_ids = np.arange(start, stop + 1)
+    fw_index = frame_ids - forward_track.boxes[0].frame_id
+    bw_index = len(backward_track.boxes) + backward_track.boxes[-1].frame_id - 1 - frame_ids
+    return fw_index, bw_index
+
+
+def compare_track_sets(forward_tracks: list, backward_tracks: list,
+                       iou_threshold=0.2) -> np.ndarray:
+    """
+    compare_tracks for every pair of forward and backward tracks, boxes of all tracks are
+    aligned on the frames where any pair intersects
+    :param forward_tracks:
+    :param backward_tracks:
+    :param iou_threshold:
+    :return: distance matrix (len(forward_tracks), len(backward_tracks))
+    """
+    fw_starts = np.array([track.boxes[0].frame_id for track in forward_tracks])
+    fw_stops = np.array([track.boxes[-1].frame_id for track in forward_tracks])
+    bw_starts = np.array([track.boxes[-1].frame_id for track in backward_tracks])
+    bw_stops = np.array([track.boxes[0].frame_id for track in backward_tracks])
+    intersection_starts = np.maximum(fw_starts[:, None], bw_starts[None, :])
+    intersection_stops = np.minimum(fw_stops[:, None], bw_stops[None, :])
+    intersections = intersection_stops - intersection_starts + 1
+    distances = np.ones(intersections.shape)
+    overlap = intersections > 0
+    if not overlap.any():
+        return distances
+    frame_ids = np.arange(intersection_starts[overlap].min(), intersection_stops[overlap].max() + 1)
+    fw_boxes = np.full((len(forward_tracks), len(frame_ids), 4), np.nan)
+    for i, track in enumerate(forward_tracks):
+        in_track = (frame_ids >= fw_starts[i]) & (frame_ids <= fw_stops[i])
+        fw_boxes[i, in_track] = track.boxes.xyxy[frame_ids[in_track] - fw_starts[i]]
+    bw_boxes = np.full((len(backward_tracks), len(frame_ids), 4), np.nan)
+    for j, track in enumerate(backward_tracks):
+        in_track = (frame_ids >= bw_starts[j]) & (frame_ids <= bw_stops[j])
+        bw_boxes[j, in_track] = track.boxes.xyxy[
+            len(track.boxes) + bw_starts[j] - 1 - frame_ids[in_track]]
+    in_intersection = (frame_ids >= intersection_starts[..., None]) & \
+                      (frame_ids <= intersection_stops[..., None])
+    with np.errstate(invalid='ignore'):
+        hits = bbox_iou_array(fw_boxes[:, None], bw_boxes[None, :]) > iou_threshold
+    agreements = np.count_nonzero(hits & in_intersection, axis=-1)
+    distances[overlap] = 1.0 - agreements[overlap] / intersections[overlap]
+    return distances
+
+
 def merge_boxes(forward_track: TrackerWrapper, backward_track: TrackerWrapper) -> None:
     """
     This function merges boxes from backward_track to forward_track
@@ -500,15 +1062,11 @@ def merge_boxes(forward_track: TrackerWrapper, backward_track: TrackerWrapper) -
     # adding backward boxes to forward, using conf_score to judge
     fw_start, fw_stop, bw_start, bw_stop, intersection_start, intersection_stop = \
         get_temporal_tracks(forward_track, backward_track)
-    fw_votes = 0
-    bw_votes = 0
-    for frame_id in range(intersection_start, intersection_stop + 1):
-        fw_box = forward_track.boxes[frame_id - fw_start]
-        bw_box = backward_track.boxes[bw_start - frame_id - 1]
-        if fw_box.conf_score >= bw_box.conf_score:
-            fw_votes += 1
-        else:
-            bw_votes += 1
+    fw_index, bw_index = aligned_indices(forward_track, backward_track,
+                                         intersection_start, intersection_stop)
+    fw_votes = int(np.count_nonzero(
+        forward_track.boxes.conf[fw_index] >= backward_track.boxes.conf[bw_index]))
+    bw_votes = len(fw_index) - fw_votes
     logger.info(f'fw_votes {fw_votes} - bw_votes {bw_votes}')
     if fw_votes < bw_votes:
         logger.info(f'bw_votes win - '
@@ -517,24 +1075,65 @@ def merge_boxes(forward_track: TrackerWrapper, backward_track: TrackerWrapper) -
         logger.info(
             f'fw_votes win - Keep fw boxes from {intersection_start} to {intersection_stop}')
     logger.info(f'Append bw boxes from {fw_stop + 1} to {bw_stop} to fw')
-    for frame_id in range(intersection_start, bw_stop + 1):
-        if frame_id <= fw_stop:
-            if fw_votes >= bw_votes:
-                continue
-            else:
-                forward_track.boxes[frame_id - fw_start] = backward_track.boxes[
-                    bw_start - frame_id - 1]
-        else:
-            forward_track.append_box_wrapper(backward_track.boxes[bw_start - frame_id - 1])
+    if fw_votes < bw_votes:
+        forward_track.boxes.replace(fw_index, backward_track.boxes.take(bw_index))
+    _, bw_index = aligned_indices(forward_track, backward_track,
+                                  max(intersection_start, fw_stop + 1), bw_stop)
+    forward_track.boxes.extend(backward_track.boxes.take(bw_index))
 
 
-if __name__ == '__main__':
+# config keys that change tracking results, a checkpoint is only resumed with the same values
+CHECKPOINT_KEYS = ['model_config', 'model_path', 'input_video_dir', 'input_label_dir',
+                   'batch_tracking', 'adaptive_tracking', 'adaptive_conf', 'adaptive_motion',
+                   'adaptive_max_skip', 'selective_backward', 'selective_iou',
+                   'inference_precision', 'inference_trace']
+
+
+def save_checkpoint(checkpoint_path: str, **state) -> None:
+    """
+    Pickle tracking state after a labeled interval, replacing the previous checkpoint atomically
+    :param checkpoint_path:
+    :param state:
+    :return:
+    """
+    with open(checkpoint_path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path: str, settings: dict):
+    """
+    :param checkpoint_path:
+    :param settings: values of CHECKPOINT_KEYS of the current config
+    :return: state saved by save_checkpoint, None if there is no usable checkpoint
+    """
+    if not os.path.exists(checkpoint_path):
+        logger.info(f'No checkpoint {checkpoint_path}, tracking from the start')
+        return None
+    with open(checkpoint_path, 'rb') as f:
+        checkpoint = pickle.load(f)
+    if checkpoint['settings'] != settings:
+        logger.warning(f'Checkpoint {checkpoint_path} was made with {checkpoint["settings"]}, '
+                       f'current config is {settings}, tracking from the start')
+        return None
+    return checkpoint
+
+
+def track_video(args) -> Dict:
+    """
+    Track objects of args.run between its labeled frames, writing {run}_r50.csv and, unless
+    args.render_video is 0 (headless), the merged video
+    :param args: tracking config, see configs/config_tracking_to_correct_label.ini.
+    With args.resume, tracking continues after the last labeled interval saved in the run's
+    checkpoint, a completed run is not tracked again
+    :return: stats: context summary after the last labeled frame (log_str), number of frames,
+    number of tracker predictions and seconds spent in each stage of this call (stage_seconds)
+    """
+    buffer_frames = backward_executor = segment_executor = None
+    cv2_video_reader = cv2_video_writer_merged = None
+    log_str = ''
     try:
-        # Parse config file
-        args = parse_config()
-        logger.info(f'Config {args}')
         # Create video writer and reader
-        start = perf_counter()
         INPUT_VIDEO_PATH = os.path.join(args.input_video_dir, args.run + f'_trim.mp4')
         # INPUT_LABEL_PATH = os.path.join(args.input_label_dir, args.run + f'_labels_fixed.csv')
         INPUT_LABEL_PATH = os.path.join(args.input_label_dir, args.run + f'_labels.csv')
@@ -547,23 +1146,38 @@ if __name__ == '__main__':
         OUTPUT_VIDEO_MERGED = os.path.join(args.output_video_dir,
                                            f"{args.run}_{args.track_tag}_merged.avi")
         OUTPUT_CSV_PATH = os.path.join(args.output_csv_dir, args.run + f'_r50.csv')
+        CHECKPOINT_PATH = os.path.join(args.output_csv_dir, args.run + f'_r50_checkpoint.pkl')
+        settings = {key: getattr(args, key, None) for key in CHECKPOINT_KEYS}
+        checkpoint = load_checkpoint(CHECKPOINT_PATH, settings) if int(args.resume) else None
+        if checkpoint is not None and checkpoint['complete']:
+            logger.info(f'{args.run} was completely tracked, nothing to resume')
+            return checkpoint['stats']
 
-        cv2_video_reader = CV2VideoReader(INPUT_VIDEO_PATH)
+        # frames are decoded ahead in a background thread while tracking
+        cv2_video_reader = CV2VideoReader(INPUT_VIDEO_PATH, prefetch=int(args.prefetch_frames))
         # cv2_video_writer_fw = CV2VideoWriter(output_video_path=OUTPUT_VIDEO_FW,
         #                                      width=cv2_video_reader.width,
         #                                      height=cv2_video_reader.height, fps=120)
         # cv2_video_writer_bw = CV2VideoWriter(output_video_path=OUTPUT_VIDEO_BW,
         #                                      width=cv2_video_reader.width,
         #                                      height=cv2_video_reader.height, fps=120)
-        cv2_video_writer_merged = CV2VideoWriter(output_video_path=OUTPUT_VIDEO_MERGED,
-                                                 width=cv2_video_reader.width,
-                                                 height=cv2_video_reader.height, fps=120)
+        # headless: only the csv is written, src/tracking/render_tracking_video.py draws it later
+        render_video = int(args.render_video)
+        if render_video:
+            cv2_video_writer_merged = CV2VideoWriter(output_video_path=OUTPUT_VIDEO_MERGED,
+                                                     width=cv2_video_reader.width,
+                                                     height=cv2_video_reader.height, fps=120)
         width = cv2_video_reader.width
         height = cv2_video_reader.height
         csv_headers = ['frame', 'name', 'x', 'y', 'w', 'h', 'confidence', 'ground_truth', 'width', 'height']
-        with open(OUTPUT_CSV_PATH, 'w') as g:
-            writer = csv.writer(g)
-            writer.writerow(csv_headers)
+        if checkpoint is None:
+            with open(OUTPUT_CSV_PATH, 'w') as g:
+                writer = csv.writer(g)
+                writer.writerow(csv_headers)
+        else:
+            # drop rows written after the checkpoint
+            with open(OUTPUT_CSV_PATH, 'r+') as g:
+                g.truncate(checkpoint['csv_offset'])
         label_df = pd.read_csv(INPUT_LABEL_PATH)
         labeled_seconds = np.array(sorted(label_df['index'].unique()))
         labeled_frames = labeled_seconds * cv2_video_reader.fps
@@ -571,89 +1185,263 @@ if __name__ == '__main__':
         logger.info(f'Label frames: {labeled_frames}')
         cv2_video_reader.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
         frame_id = 0 - 1
-        buffer_frames = dict()
+        # first frame of the first interval to track
+        next_frame_id = 0 if checkpoint is None else checkpoint['next_frame_id']
+        # each labeled interval is tracked in its own worker, results are merged here in order
+        segment_workers = int(args.segment_workers)
+        # backward tracking only for boxes of the closing label frame that no forward track follows,
+        # needs the forward pass first, so passes run one after the other on this process
+        selective = int(args.selective_backward)
+        if selective:
+            segment_workers = 0
+        # forward and backward passes of an interval run at the same time, backward in a worker
+        concurrent = int(args.concurrent_passes) and not segment_workers and not selective
+        # frames since the last label frame, preallocated for a 10-second interval,
+        # in shared memory if the backward worker reads them
+        buffer_frames = FrameRingBuffer(height=height, width=width,
+                                        capacity=round(cv2_video_reader.fps * 10) + 2,
+                                        shared=bool(concurrent))
         track_kwargs = dict(model_config=args.model_config, model_path=args.model_path,
-                            tracker_type='siam')
+                            tracker_type='siam', precision=args.inference_precision,
+                            trace=bool(int(args.inference_trace)))
+        # search crops of all active tracks go through the backbone in one batch
+        batched = int(args.batch_tracking)
+        # steady tracks skip the tracker for a few frames, their boxes are interpolated
+        adaptive_kwargs = None
+        if int(args.adaptive_tracking):
+            adaptive_kwargs = dict(conf=float(args.adaptive_conf),
+                                   motion=float(args.adaptive_motion),
+                                   max_skip=int(args.adaptive_max_skip))
+        # tracker predictions of all passes
+        n_tracker_calls = 0 if checkpoint is None else checkpoint['n_tracker_calls']
+        # time of decode, tracking, matching, merging, csv, render... in this process
+        timer = StageTimer()
+        if concurrent:
+            # split cpu threads between the two passes
+            num_threads = max(1, torch.get_num_threads() // 2)
+            torch.set_num_threads(num_threads)
+            # spawn: forking a process that already initialized torch/cuda is unsafe
+            backward_executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_tracking_worker,
+                initargs=(track_kwargs, adaptive_kwargs, label_df, labeled_frames,
+                          cv2_video_reader.fps, batched, num_threads))
+        if segment_workers:
+            num_threads = max(1, torch.get_num_threads() // segment_workers)
+            segment_executor = ProcessPoolExecutor(
+                max_workers=segment_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_tracking_worker,
+                initargs=(track_kwargs, adaptive_kwargs, label_df, labeled_frames,
+                          cv2_video_reader.fps, batched, num_threads, INPUT_VIDEO_PATH,
+                          int(args.prefetch_frames)))
+            # (previous label frame, label frame) of each interval
+            segments = ((init_frame, label_frame) for init_frame, label_frame
+                        in zip([None] + labeled_frames[:-1], labeled_frames)
+                        if label_frame >= next_frame_id)
+            # submit a few segments ahead only, results hold frames and boxes until merged
+            segment_futures = {label_frame: segment_executor.submit(track_segment, init_frame,
+                                                                    label_frame)
+                               for init_frame, label_frame in islice(segments, 2 * segment_workers)}
+        context_backward = None
         color_reference = ColorRef(ColorRef.forward_set)
-        context_forward = Context(track_kwargs=track_kwargs, color_reference=color_reference)
+        context_forward = Context(track_kwargs=track_kwargs, color_reference=color_reference,
+                                  adaptive_kwargs=adaptive_kwargs)
+        if checkpoint is not None:
+            logger.info(f'Resuming {args.run} from frame {next_frame_id}')
+            context_forward = checkpoint['context_forward']
+            context_backward = checkpoint['context_backward']
+            log_str = checkpoint['log_str']
+            # the merged video is not resumable, draw tracked intervals again from the csv
+            # (the context only keeps boxes from the last label frame on)
+            if render_video:
+                frame_to_boxes = boxes_by_frame(pd.read_csv(OUTPUT_CSV_PATH), labeled_frames)
+            while frame_id + 1 < next_frame_id:
+                frame_id += 1
+                if not render_video:
+                    with timer.stage('decode'):
+                        cv2_video_reader.skip_frame()
+                    continue
+                with timer.stage('decode'):
+                    ret, frame = cv2_video_reader.read_frame()
+                with timer.stage('render'):
+                    draw_tracked_frame(frame, frame_id, frame_to_boxes.get(frame_id, []),
+                                       labeled_frames=labeled_frames)
+                    cv2_video_writer_merged.write_frame(frame)
         while cv2_video_reader.capture.isOpened():
             frame_id += 1
             # if frame_id > 400:
             #     break
-            ret, frame = cv2_video_reader.read_frame()
+            # decode directly into the buffer
+            with timer.stage('decode'):
+                ret, frame = cv2_video_reader.read_frame(out=buffer_frames.next_slot())
             if not ret:
                 logger.info('End of video stream, ret is False!')
                 break
-            buffer_frames[frame_id] = frame
+            buffer_frames.append(frame_id, frame)
             if frame_id in labeled_frames:  # If this is a label frame
-                # do forward tracking
-                logger.info(
-                    f'Forward tracking from {frame_id - len(buffer_frames) + 1} to {frame_id}')
-                context_forward = track_buffer(context=context_forward,
-                                               buffer_frames=deepcopy(buffer_frames),
-                                               label_df=label_df,
-                                               labeled_frames=labeled_frames,
-                                               is_backward=False, fps=cv2_video_reader.fps)
+                segment = None
+                if segment_workers:
+                    with timer.stage('workers'):
+                        segment = segment_futures.pop(frame_id).result()
+                    for init_frame, label_frame in islice(segments, 1):
+                        segment_futures[label_frame] = segment_executor.submit(
+                            track_segment, init_frame, label_frame)
+                    if segment is None or segment['checksum'] != segment_checksum(buffer_frames):
+                        logger.warning(f'Segment worker decoded different frames for interval '
+                                       f'ending at {frame_id}, tracking it here')
+                        segment = None
+                elif concurrent:
+                    # do backward tracking in the worker while tracking forward
+                    logger.info(
+                        f'Backward tracking from {frame_id} to {frame_id - len(buffer_frames) + 1}'
+                        f' in a worker process')
+                    backward_future = backward_executor.submit(track_backward, buffer_frames)
+                if segment is not None and replay_forward_tracks(
+                        context_forward, context_backward, segment['forward_tracks'],
+                        frame_ids=sorted(buffer_frames.keys())[:-1], batched=batched):
+                    logger.info(
+                        f'Forward tracks from {frame_id - len(buffer_frames) + 1} to {frame_id}'
+                        f' from segment worker')
+                    n_tracker_calls += segment['n_tracker_calls']
+                else:
+                    # do forward tracking
+                    logger.info(
+                        f'Forward tracking from {frame_id - len(buffer_frames) + 1} to {frame_id}')
+                    context_forward = track_buffer(context=context_forward,
+                                                   buffer_frames=buffer_frames,
+                                                   label_df=label_df,
+                                                   labeled_frames=labeled_frames,
+                                                   is_backward=False, fps=cv2_video_reader.fps,
+                                                   batched=batched, timer=timer)
                 # draw_context_on_frames(context_forward, deepcopy(buffer_frames),
                 #                        cv2_video_writer_fw, labeled_frames=labeled_frames)
-                # do backward tracking
-                logger.info(
-                    f'Backward tracking from {frame_id} to {frame_id - len(buffer_frames) + 1}')
-                # color_reference to assign color to boxes during bbox matching and tracking
-                color_reference = ColorRef(ColorRef.backward_set)
-                context_backward = Context(track_kwargs=track_kwargs,
-                                           color_reference=color_reference)
-                context_backward = track_buffer(context=context_backward,
-                                                buffer_frames=deepcopy(buffer_frames),
-                                                label_df=label_df,
-                                                labeled_frames=labeled_frames,
-                                                is_backward=True, fps=cv2_video_reader.fps)
+                if segment is not None:
+                    context_backward = segment['context_backward']
+                elif concurrent:
+                    # frames must not change until the worker is done with them
+                    with timer.stage('workers'):
+                        context_backward = backward_future.result()
+                else:
+                    # do backward tracking
+                    logger.info(
+                        f'Backward tracking from {frame_id} to {frame_id - len(buffer_frames) + 1}')
+                    # color_reference to assign color to boxes during bbox matching and tracking
+                    color_reference = ColorRef(ColorRef.backward_set)
+                    context_backward = Context(track_kwargs=track_kwargs,
+                                               color_reference=color_reference,
+                                               adaptive_kwargs=adaptive_kwargs)
+                    if selective:
+                        with timer.stage('matching'):
+                            context_backward.kept_forward = keep_forward_tracks(
+                                context_forward,
+                                label_df[label_df['index'] == round(frame_id / cv2_video_reader.fps)],
+                                iou_threshold=float(args.selective_iou))
+                    context_backward = track_buffer(context=context_backward,
+                                                    buffer_frames=buffer_frames,
+                                                    label_df=label_df,
+                                                    labeled_frames=labeled_frames,
+                                                    is_backward=True, fps=cv2_video_reader.fps,
+                                                    batched=batched, timer=timer)
                 # draw_context_on_frames(context_backward, deepcopy(buffer_frames),
                 #                        cv2_video_writer_bw, labeled_frames=labeled_frames)
                 # merge backward and forward, some tracks of context_forward.tracks[...]
                 # will be active after merging. context_merged is context_fw
-                context_forward = matching_and_merging(context_forward, context_backward)
+                n_tracker_calls += context_backward.n_tracker_calls
+                with timer.stage('merging'):
+                    context_forward = matching_and_merging(context_forward, context_backward)
                 logger.info(f"After merging")
                 log_str = print_context(context_forward)
-                draw_context_on_frames(context_forward, deepcopy(buffer_frames),
-                                       cv2_video_writer_merged, labeled_frames=labeled_frames)
+                if render_video:
+                    with timer.stage('render'):
+                        draw_context_on_frames(context_forward, buffer_frames,
+                                               cv2_video_writer_merged,
+                                               labeled_frames=labeled_frames)
                 # write csv tracking
-                with open(OUTPUT_CSV_PATH, 'a') as g:
+                with timer.stage('csv'), open(OUTPUT_CSV_PATH, 'a') as g:
                     for object_type, category_track in context_forward.tracks.items():
                         for object_id, track_wrapper in category_track.items():
                             for box_wrapper in track_wrapper.boxes:
                                 if box_wrapper.frame_id in buffer_frames:
                                     writer = csv.writer(g)
                                     writer.writerow(box_wrapper.get_csv_row() + [width, height])
+                    csv_offset = g.tell()
                 # reset buffer
-                buffer_frames = dict()
+                buffer_frames.clear()
                 # release backward tracks
                 logger.info('Release backward trackers')
                 for object_type, category_track in context_backward.tracks.items():
                     for object_id, track_wrapper in category_track.items():
                         if track_wrapper.terminate:
                             track_wrapper.release_tracker()
+                        track_wrapper.first_template = None
+                # keep memory flat over long videos: boxes before the label frame are in the csv,
+                # first templates are only used to merge the interval they start
+                for object_type, category_track in context_forward.tracks.items():
+                    for object_id, track_wrapper in category_track.items():
+                        track_wrapper.boxes.drop_before(frame_id)
+                        track_wrapper.first_template = None
+                context_forward.frame_results = dict()
                 torch.cuda.empty_cache()
+                with timer.stage('checkpoint'):
+                    save_checkpoint(CHECKPOINT_PATH, settings=settings, complete=False,
+                                    next_frame_id=frame_id + 1, csv_offset=csv_offset,
+                                    context_forward=context_forward,
+                                    context_backward=context_backward,
+                                    n_tracker_calls=n_tracker_calls, log_str=log_str)
 
+        stats = dict(log_str=log_str, n_frames=frame_id,
+                     n_tracker_calls=n_tracker_calls + context_forward.n_tracker_calls,
+                     stage_seconds=dict(timer.seconds))
+        save_checkpoint(CHECKPOINT_PATH, settings=settings, complete=True, stats=stats)
+        return stats
+    finally:
         # cv2_video_writer_bw.writer.release()
         # cv2_video_writer_fw.writer.release()
-        cv2_video_writer_merged.writer.release()
-        cv2_video_reader.capture.release()
+        if cv2_video_writer_merged is not None:
+            cv2_video_writer_merged.writer.release()
+        if cv2_video_reader is not None:
+            cv2_video_reader.release()
+        if backward_executor is not None:
+            backward_executor.shutdown(cancel_futures=True)
+        if segment_executor is not None:
+            # label frames past the end of the video
+            segment_executor.shutdown(cancel_futures=True)
+        if buffer_frames is not None:
+            buffer_frames.release()
+
 
+def track_and_record(args) -> Dict:
+    """
+    Track args.run, appending its stats to output/track_complete.txt,
+    or the error to output/track_error.txt
+    :param args: tracking config
+    :return: run, n_frames, seconds and status (complete or error)
+    """
+    start = perf_counter()
+    try:
+        stats = track_video(args)
         end = perf_counter()
         logger.info(f'Running time: {end - start}')
 
         with open('output/track_complete.txt', 'a') as f:
-            index = log_str.find('Stats')
+            index = stats['log_str'].find('Stats')
             if index != -1:
                 f.write(args.run + '\n')
-                f.write(log_str[index:] + '\n')
+                f.write(stats['log_str'][index:] + '\n')
+        return dict(run=args.run, n_frames=stats['n_frames'], seconds=end - start,
+                    status='complete')
 
     except Exception as error:
-        cv2_video_writer_merged.writer.release()
-        cv2_video_reader.capture.release()
         error_str = repr(error)
         with open('output/track_error.txt', 'a') as f:
             f.write(args.run + '\n')
             f.write(error_str + '\n')
             f.write(traceback.format_exc() + '\n')
+        return dict(run=args.run, n_frames=0, seconds=perf_counter() - start, status='error')
+
+
+if __name__ == '__main__':
+    # Parse config file
+    args = parse_config()
+    logger.info(f'Config {args}')
+    track_and_record(args)
@@ -2,6 +2,10 @@ import numpy as np
 import cv2
 import os
 import logging
+import queue
+import threading
+from contextlib import contextmanager
+from time import perf_counter
 
 import pandas as pd
 from matplotlib.backends.backend_agg import FigureCanvasAgg
@@ -62,6 +66,8 @@ def parse_config():
     parser.add_argument("--trigger")
     parser.add_argument("--threshold")
     parser.add_argument("--equal_sigma")
+    # --resume alone is --resume 1
+    parser.add_argument("--resume", nargs='?', const='1')
     args = parser.parse_args(remaining_argv)
 
     return args
@@ -279,13 +285,19 @@ class SegmentationVideo:
 class CV2VideoReader:
     """
     This class is a wrapper of opencv video-capturing stream. It stores some commonly used
-    variables and implements some commonly used method
+    variables and implements some commonly used method.
+    With prefetch > 0, a background thread decodes (and optionally downscales or converts to
+    grayscale) up to prefetch frames ahead into preallocated buffers, read_frame only waits for
+    a ready frame. Seek with capture.set before the first read_frame.
     """
 
-    def __init__(self, input_video_path):
+    def __init__(self, input_video_path, prefetch=0, resize=None, grayscale=False):
         """
         Initialize some commonly used variables, can be extended
         :param input_video_path: path to input video to read
+        :param prefetch: number of frames decoded ahead in a background thread, 0: decode in read_frame
+        :param resize: (width, height) to resize frames to while prefetching, None: keep size
+        :param grayscale: convert frames to grayscale while prefetching
         """
         logger.debug('Creating an instance of CV2VideoReader')
         self.capture = cv2.VideoCapture(input_video_path)
@@ -297,6 +309,15 @@ class CV2VideoReader:
         self.total_frames = self.capture.get(cv2.CAP_PROP_FRAME_COUNT)
         logger.info(f'CV2 Reader fps {input_video_path}={self.fps}')
         logger.info(f'CV2 Reader # frames {input_video_path}={self.total_frames}')
+        self.prefetch = int(prefetch)
+        self.resize = resize
+        self.grayscale = grayscale
+        if (resize is not None or grayscale) and not self.prefetch:
+            logger.error('resize and grayscale are only applied while prefetching')
+        self._thread = None
+        self._stopped = threading.Event()
+        # slot handed out by the last read_frame, recycled at the next call
+        self._reading_slot = None
 
     def __repr__(self) -> Dict:
         """
@@ -314,14 +335,92 @@ class CV2VideoReader:
         :return:
         """
         logger.debug('Destroying an instance of CV2VideoReader')
+        self.release()
+
+    def release(self) -> None:
+        """
+        Stop prefetching and release the video stream
+        :return:
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            # unblock the decoding thread if it waits for a free slot
+            self._free_slots.put(None)
+            self._thread.join()
+            self._thread = None
         self.capture.release()
 
-    def read_frame(self) -> Tuple:
+    def _start_prefetch(self) -> None:
+        width, height = self.resize if self.resize is not None else (self.width, self.height)
+        shape = (height, width) if self.grayscale else (height, width, 3)
+        # prefetch ready frames, one being read by the consumer, one being decoded
+        self._slots = np.empty((self.prefetch + 2,) + shape, dtype=np.uint8)
+        self._free_slots = queue.Queue()
+        for slot in range(len(self._slots)):
+            self._free_slots.put(slot)
+        self._ready = queue.Queue()
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+
+    def _decode(self) -> None:
+        """
+        Decoding thread: fill free slots with the next frames until the end of the stream
+        :return:
         """
-        Get next frame
+        decoded = None
+        while not self._stopped.is_set():
+            slot = self._free_slots.get()
+            if slot is None:
+                break
+            if self.resize is None and not self.grayscale:
+                ret, _ = self.capture.read(self._slots[slot])
+            else:
+                ret, decoded = self.capture.read(decoded)
+                if ret and self.resize is not None:
+                    decoded_small = cv2.resize(decoded, self.resize, interpolation=cv2.INTER_AREA)
+                else:
+                    decoded_small = decoded
+                if ret and self.grayscale:
+                    cv2.cvtColor(decoded_small, cv2.COLOR_BGR2GRAY, dst=self._slots[slot])
+                elif ret:
+                    np.copyto(self._slots[slot], decoded_small)
+            self._ready.put((ret, slot))
+            if not ret:
+                break
+
+    def read_frame(self, out=None) -> Tuple:
+        """
+        Get next frame. A prefetched frame is only valid until the next call, unless out is given
+        :param out: optional preallocated array to decode (or copy a prefetched frame) into
         :return: ret, frame
         """
-        return self.capture.read()
+        if not self.prefetch:
+            return self.capture.read(out)
+        if self._thread is None:
+            self._start_prefetch()
+        if self._reading_slot is not None:
+            self._free_slots.put(self._reading_slot)
+            self._reading_slot = None
+        ret, slot = self._ready.get()
+        if not ret:
+            # end of stream, every later call gets the same answer
+            self._ready.put((ret, slot))
+            return False, None
+        if out is None:
+            self._reading_slot = slot
+            return ret, self._slots[slot]
+        np.copyto(out, self._slots[slot])
+        self._free_slots.put(slot)
+        return ret, out
+
+    def skip_frame(self) -> bool:
+        """
+        Move to the next frame without using it
+        :return: ret
+        """
+        if not self.prefetch:
+            return self.capture.grab()
+        return self.read_frame()[0]
 
 
 class CV2VideoWriter:
@@ -380,6 +479,30 @@ class CV2VideoWriter:
         self.writer.write(frame)
 
 
+class StageTimer:
+    """
+    Accumulate wall time and number of calls of named stages of a pipeline
+    """
+
+    def __init__(self):
+        self.seconds = dict()
+        self.calls = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the body of a with statement as stage name
+        :param name:
+        :return:
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + perf_counter() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+
 class ColorBGR:
     """
     For explicit color
@@ -410,6 +533,9 @@ class BoxWrapper:
     This class keeps track of relevant variables for a bounding box and implements
     commonly used methods
     """
+    # one instance per tracked frame, keep instances small
+    __slots__ = ('xmin', 'xmax', 'ymin', 'ymax', 'frame_id', 'conf_score', 'object_name',
+                 'state', 'color')
 
     def __init__(self, xmin, xmax, ymin, ymax, frame_id, state='init',
                  object_name='unknown', conf_score=-1.0, color=(255, 255, 255)):